@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能基准测试
+
+在CPU上用随机初始化的Qwen3结构微型模型测量各热点路径的性能：
+- preprocess: preprocess_gpu_qa 处理 GPU-QA/train.jsonl 的速度（行/秒）
+- train_step: 不同序列长度和批大小下LoRA训练一步（前向、反向、优化器）的耗时和激活内存
+- generate: 不同批大小下 generate_answers 的批次延迟和生成吞吐量（含系统提示词前缀缓存）
+- metrics: BatchScorer 构建参考答案表和批量计算ROUGE/BLEU的速度
+
+结果写入JSON文件；指定 --baseline 时与基准结果逐项比较，变差超过 --tolerance 的指标视为性能回退，
+此时以非零状态退出，便于在CI中使用。
+
+用法:
+    python benchmarks/run_benchmarks.py --output benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --output current.json --baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --suites train_step generate --quick
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import torch
+from datasets import load_dataset
+from peft import get_peft_model
+
+import gpu_metrics
+from gpu_llm_finetune import build_generation_prompt, generate_answers, preprocess_gpu_qa, setup_lora_config
+from gpu_metrics import BatchScorer
+from gpu_prefix_cache import get_prefix_cache
+from tiny_model import create_tiny_model_and_tokenizer, create_tiny_tokenizer
+
+# 基准测试使用的微型模型：与Qwen3结构相同，只缩小尺寸
+BENCHMARK_MODEL_CONFIG = {
+    "hidden_size": 256,
+    "intermediate_size": 768,
+    "num_hidden_layers": 4,
+    "num_attention_heads": 8,
+    "num_key_value_heads": 4,
+    "head_dim": 32,
+}
+
+# 各指标的方向：True表示越大越好
+METRIC_DIRECTIONS = {
+    "rows_per_second": True,
+    "tokens_per_second": True,
+    "seconds": False,
+    "seconds_per_step": False,
+    "batch_latency_seconds": False,
+    "build_seconds": False,
+    "saved_activation_mb": False,
+    "peak_memory_mb": False,
+}
+
+def _median_seconds(fn, repeats, warmup=1):
+    """多次运行取中位数耗时"""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def _result(name, params, **metrics):
+    return {"name": name, "params": params, "metrics": metrics}
+
+def _load_split(split):
+    return load_dataset("json", data_files=os.path.join(REPO_ROOT, "GPU-QA", f"{split}.jsonl"), split="train")
+
+def bench_preprocess(args):
+    """preprocess_gpu_qa 对整个训练集的处理速度"""
+    dataset = _load_split("train")
+    tokenizer = create_tiny_tokenizer(list(dataset["question"]) + list(dataset["answer"]))
+
+    def run():
+        dataset.map(preprocess_gpu_qa, batched=True, remove_columns=dataset.column_names,
+                    fn_kwargs={"tokenizer": tokenizer, "max_length": 1024},
+                    load_from_cache_file=False, keep_in_memory=True)
+
+    seconds = _median_seconds(run, args.repeats)
+    return [_result("preprocess/train", {"rows": len(dataset)},
+                    seconds=seconds, rows_per_second=len(dataset) / seconds)]
+
+def _train_model(vocab_texts=()):
+    model, tokenizer = create_tiny_model_and_tokenizer(vocab_texts, **BENCHMARK_MODEL_CONFIG)
+    model = get_peft_model(model, setup_lora_config(8))
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    model.train()
+    return model, tokenizer
+
+def _saved_activation_mb(step):
+    """反向传播保存的张量总大小（MB），不受CPU内存分配器缓存影响"""
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        total += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    return total / 2 ** 20
+
+def bench_train_step(args):
+    """LoRA训练一步（梯度检查点，与 train_model 相同）的耗时、吞吐量和激活内存"""
+    results = []
+    seq_lengths = [128, 256] if args.quick else [128, 512, 1024]
+    batch_sizes = [1, 2] if args.quick else [1, 4]
+    model, tokenizer = _train_model()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+    generator = torch.Generator().manual_seed(0)
+
+    for seq_length in seq_lengths:
+        for batch_size in batch_sizes:
+            input_ids = torch.randint(len(tokenizer), (batch_size, seq_length), generator=generator)
+            labels = input_ids.clone()
+            # 与助手回答掩码类似，前半部分（提示）不参与损失
+            labels[:, :seq_length // 2] = -100
+            batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "labels": labels}
+
+            def forward_backward():
+                model(**batch).loss.backward()
+
+            def step():
+                forward_backward()
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            seconds = _median_seconds(step, args.repeats)
+            metrics = {
+                "seconds_per_step": seconds,
+                "tokens_per_second": batch_size * seq_length / seconds,
+                "saved_activation_mb": _saved_activation_mb(forward_backward),
+            }
+            optimizer.zero_grad(set_to_none=True)
+            if torch.cuda.is_available():
+                metrics["peak_memory_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+            results.append(_result(f"train_step/seq{seq_length}_bs{batch_size}",
+                                   {"seq_length": seq_length, "batch_size": batch_size}, **metrics))
+    return results
+
+def bench_generate(args):
+    """generate_answers 在不同批大小下的批次延迟和生成吞吐量"""
+    results = []
+    test = _load_split("test")
+    questions = list(test["question"])[:8 if args.quick else 16]
+    max_new_tokens = 16 if args.quick else 32
+    model, tokenizer = create_tiny_model_and_tokenizer(list(test["question"]), **BENCHMARK_MODEL_CONFIG)
+    # 不设置结束符，每个回答都恰好生成 max_new_tokens 个token，吞吐量可比
+    model.generation_config.eos_token_id = None
+
+    for prefix_cache in (False, True):
+        cache = get_prefix_cache(model, tokenizer, build_generation_prompt) if prefix_cache else None
+        for batch_size in ([1, 4] if args.quick else [1, 4, 8]):
+            def run():
+                generate_answers(model, tokenizer, questions, batch_size=batch_size,
+                                 max_new_tokens=max_new_tokens, prefix_cache=cache)
+
+            seconds = _median_seconds(run, args.repeats)
+            num_batches = -(-len(questions) // batch_size)
+            name = f"generate/bs{batch_size}" + ("_prefix_cache" if prefix_cache else "")
+            results.append(_result(name, {"batch_size": batch_size, "questions": len(questions),
+                                          "max_new_tokens": max_new_tokens, "prefix_cache": prefix_cache},
+                                   seconds=seconds,
+                                   batch_latency_seconds=seconds / num_batches,
+                                   tokens_per_second=len(questions) * max_new_tokens / seconds))
+    return results
+
+def bench_metrics(args):
+    """参考答案表的构建和ROUGE/BLEU批量打分速度"""
+    references = list(_load_split("train")["answer"])
+    # 错位一行作为“生成答案”，与参考答案部分重叠
+    hypotheses = references[1:] + references[:1]
+
+    def build():
+        # 清空内存缓存，测量的是参考答案表的真实构建时间
+        gpu_metrics._REFERENCE_TABLE_CACHE.clear()
+        BatchScorer(references)
+
+    build_seconds = _median_seconds(build, args.repeats)
+    scorer = BatchScorer(references)
+    seconds = _median_seconds(lambda: scorer.score(hypotheses), args.repeats)
+    return [_result("metrics/score", {"rows": len(references), "level": "char"},
+                    build_seconds=build_seconds, seconds=seconds, rows_per_second=len(references) / seconds)]
+
+SUITES = {
+    "preprocess": bench_preprocess,
+    "train_step": bench_train_step,
+    "generate": bench_generate,
+    "metrics": bench_metrics,
+}
+
+def compare_results(current, baseline, tolerance=0.1):
+    """
+    与基准结果逐项比较
+
+    Returns:
+        列表，每项为 {name, metric, baseline, current, change, regression}；
+        change 为按指标方向换算后的相对变化（正数表示变好），变差超过 tolerance 时 regression 为True
+    """
+    baseline_metrics = {r["name"]: r["metrics"] for r in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        previous = baseline_metrics.get(result["name"])
+        if previous is None:
+            continue
+        for metric, value in result["metrics"].items():
+            if metric not in previous or metric not in METRIC_DIRECTIONS or not previous[metric]:
+                continue
+            ratio = value / previous[metric]
+            change = ratio - 1 if METRIC_DIRECTIONS[metric] else 1 / ratio - 1 if ratio else float("inf")
+            rows.append({
+                "name": result["name"],
+                "metric": metric,
+                "baseline": previous[metric],
+                "current": value,
+                "change": change,
+                "regression": change < -tolerance,
+            })
+    return rows
+
+def print_comparison(rows):
+    print(f"{'基准项':<32} {'指标':<24} {'基准':>12} {'当前':>12} {'变化':>9}")
+    for row in rows:
+        flag = "  ← 回退" if row["regression"] else ""
+        print(f"{row['name']:<32} {row['metric']:<24} {row['baseline']:>12.4g} {row['current']:>12.4g} "
+              f"{row['change']:>+8.1%}{flag}")
+
+def run_benchmarks(suites, args):
+    """运行指定的基准测试，返回可写入JSON的结果"""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    results = []
+    for suite in suites:
+        print(f"运行基准测试: {suite}", flush=True)
+        results.extend(SUITES[suite](args))
+    return {
+        "metadata": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+            "device": torch.cuda.get_device_name() if torch.cuda.is_available() else "cpu",
+            "quick": args.quick,
+            "repeats": args.repeats,
+            "model_config": BENCHMARK_MODEL_CONFIG,
+        },
+        "results": results,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GPU知识助手性能基准测试")
+    parser.add_argument("--suites", nargs="+", default=list(SUITES), choices=list(SUITES),
+                        help="要运行的基准测试")
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="结果JSON文件")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="与该基准结果比较，出现回退时以非零状态退出")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="允许的相对变差比例，超过即视为回退")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="每项测量的重复次数（取中位数）")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="PyTorch CPU线程数，默认使用PyTorch的设置")
+    parser.add_argument("--quick", action="store_true",
+                        help="缩小测量规模，用于快速检查")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    current = run_benchmarks(args.suites, args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {args.output}")
+
+    if args.baseline is None:
+        for result in current["results"]:
+            metrics = ", ".join(f"{k}={v:.4g}" for k, v in result["metrics"].items())
+            print(f"  {result['name']}: {metrics}")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    rows = compare_results(current, baseline, args.tolerance)
+    print_comparison(rows)
+    regressions = [row for row in rows if row["regression"]]
+    if regressions:
+        print(f"发现 {len(regressions)} 项性能回退（容差 {args.tolerance:.0%}）")
+        return 1
+    print("未发现性能回退")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,8 @@
 
 import json
 import os
-from typing import List, Dict, Any
+
+from gpu_ingest import parse_line
 
 def convert_messages_to_qa(input_file: str, output_file: str) -> int:
     """
@@ -26,49 +27,27 @@ def convert_messages_to_qa(input_file: str, output_file: str) -> int:
     
     converted_count = 0
     
-    with open(input_file, 'r', encoding='utf-8') as infile, \
+    with open(input_file, 'rb') as infile, \
          open(output_file, 'w', encoding='utf-8') as outfile:
-        
+        # 逐行流式解析，messages格式规范为question-answer
         for line_num, line in enumerate(infile, 1):
-            try:
-                data = json.loads(line.strip())
-                
-                # 检查是否是messages格式
-                if "messages" in data:
-                    messages = data["messages"]
-                    question = ""
-                    answer = ""
-                    
-                    # 提取问题和答案
-                    for message in messages:
-                        if message.get("role") == "user":
-                            question = message.get("content", "")
-                        elif message.get("role") == "assistant":
-                            answer = message.get("content", "")
-                    
-                    if question and answer:
-                        # 创建新格式
-                        new_data = {
-                            "question": question,
-                            "answer": answer
-                        }
-                        outfile.write(json.dumps(new_data, ensure_ascii=False) + '\n')
-                        converted_count += 1
-                    else:
-                        print(f"⚠️  第{line_num}行缺少问题或答案，跳过")
-                
-                # 如果已经是question-answer格式，直接复制
-                elif "question" in data and "answer" in data:
-                    outfile.write(line)
-                    converted_count += 1
-                
+            if not line.strip():
+                continue
+            data, record, error = parse_line(line)
+            if error is not None:
+                kind, message = error
+                if kind in ("json", "encoding"):
+                    print(f"❌ 第{line_num}行{message}")
                 else:
-                    print(f"⚠️  第{line_num}行格式不识别，跳过")
-                    
-            except json.JSONDecodeError as e:
-                print(f"❌ 第{line_num}行JSON解析错误: {e}")
-            except Exception as e:
-                print(f"❌ 第{line_num}行处理错误: {e}")
+                    print(f"⚠️  第{line_num}行{message}，跳过")
+                continue
+            
+            # 如果已经是question-answer格式，直接复制（保留其他字段）
+            if "messages" not in data:
+                outfile.write(line.decode('utf-8').lstrip('\ufeff').rstrip('\r\n') + '\n')
+            else:
+                outfile.write(json.dumps(record, ensure_ascii=False) + '\n')
+            converted_count += 1
     
     return converted_count
 
@@ -5,10 +5,11 @@ GPU-QA数据集创建工具
 帮助用户将GPU问答数据转换为标准的训练格式
 """
 
-import json
 import os
 from typing import List, Dict, Any
 
+from gpu_ingest import write_jsonl
+
 def create_gpu_qa_entry(question: str, answer: str) -> Dict[str, Any]:
     """
     创建单个GPU问答条目
@@ -33,13 +34,8 @@ def save_dataset(data: List[Dict[str, Any]], filepath: str) -> None:
         data: 数据列表
         filepath: 输出文件路径
     """
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    
-    with open(filepath, 'w', encoding='utf-8') as f:
-        for entry in data:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
-    
-    print(f"✅ 已保存 {len(data)} 条数据到 {filepath}")
+    count = write_jsonl(data, filepath)
+    print(f"✅ 已保存 {count} 条数据到 {filepath}")
 
 def create_sample_gpu_dataset():
     """创建示例GPU数据集"""
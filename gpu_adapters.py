@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多LoRA适配器管理
+
+显存中只保留一份基础模型，多个在同一基础模型上训练的LoRA适配器按需从
+adapter_config.json / adapter_model.safetensors 加载，常驻适配器数量有上限，超出时按最近使用顺序（LRU）卸载。
+切换常驻适配器只是改变PEFT的激活标记，加载一个适配器只读取其LoRA权重，内存按适配器大小而不是模型大小增长。
+
+同一批次中的不同请求可以使用不同的适配器：前向时传入与批次各行对应的 adapter_names，
+PEFT在每个LoRA层按适配器把批次分组计算旁路。名称 BASE_ADAPTER 表示不套适配器的基础模型。
+
+用法:
+    manager = AdapterManager(base_model, {"qwen3": "qwen3-output", "v2": "outputs/qwen3-1.7b-gpu-assistant"})
+    model = manager.activate("v2")            # 单适配器评估
+    outputs = manager.model(input_ids, **manager.forward_kwargs(["qwen3", "v2", BASE_ADAPTER]))
+"""
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+
+# PEFT混合批次中表示"不使用适配器"的名称
+BASE_ADAPTER = "__base__"
+
+def _model_id(name_or_path):
+    """模型名称或路径的最后一段（忽略大小写），用于比较 Qwen/Qwen3-1.7B 与本地目录 /models/Qwen3-1.7B"""
+    return os.path.basename(os.path.normpath(name_or_path)).casefold() if name_or_path else ""
+
+def read_adapter_config(adapter_dir, base_model_name=None):
+    """
+    读取并检查适配器配置
+
+    Args:
+        adapter_dir: 适配器目录
+        base_model_name: 常驻基础模型的名称或路径，与适配器记录的基础模型不一致时报错；任一方为空时不检查
+
+    Returns:
+        adapter_config.json 的内容
+    """
+    path = os.path.join(adapter_dir, ADAPTER_CONFIG_FILE)
+    if not os.path.isfile(path):
+        raise ValueError(f"{adapter_dir} 不是LoRA适配器目录（缺少 {ADAPTER_CONFIG_FILE}）")
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("peft_type") != "LORA":
+        raise ValueError(f"{adapter_dir} 的适配器类型为 {config.get('peft_type')}，只支持LoRA")
+    adapter_base = config.get("base_model_name_or_path")
+    if _model_id(base_model_name) and _model_id(adapter_base) and _model_id(base_model_name) != _model_id(adapter_base):
+        raise ValueError(f"{adapter_dir} 是在 {adapter_base} 上训练的，与常驻的基础模型 {base_model_name} 不一致")
+    return config
+
+def parse_adapter_specs(specs):
+    """把命令行的 name=path 列表解析为有序字典；只给出路径时用目录名作为名称"""
+    adapters = OrderedDict()
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = os.path.basename(os.path.normpath(spec)), spec
+        if not name or not path:
+            raise ValueError(f"适配器参数 {spec!r} 应为 name=path")
+        if name in adapters or name == BASE_ADAPTER:
+            raise ValueError(f"适配器名称 {name} 重复或为保留名称")
+        adapters[name] = path
+    return adapters
+
+class AdapterManager:
+    """
+    常驻一份基础模型、按需加载并LRU卸载LoRA适配器
+
+    构造时检查全部已注册适配器的配置，并加载第一个适配器（之后 model 始终是同一个PeftModel）。
+    其余适配器在首次使用时加载，常驻数超过 max_resident 时卸载最久未使用且当前批次不需要的适配器。
+    所有方法都应在同一个线程中调用（推理服务中为引擎线程）。
+
+    Args:
+        base_model: 未套适配器的基础模型
+        adapters: 适配器名称到目录的映射，第一个为默认适配器
+        max_resident: 同时常驻的适配器数上限
+    """
+
+    def __init__(self, base_model, adapters, max_resident=4):
+        from peft import PeftModel
+
+        if not adapters:
+            raise ValueError("至少需要注册一个适配器")
+        if max_resident < 1:
+            raise ValueError(f"max_resident 必须为正整数，当前为 {max_resident}")
+        self.base_name = getattr(base_model.config, "_name_or_path", "")
+        self.paths = OrderedDict()
+        for name, path in adapters.items():
+            self.register(name, path)
+        self.max_resident = max_resident
+        self.default = next(iter(self.paths))
+        # 常驻适配器 -> LoRA权重字节数，按最近使用排序（末尾为最近）
+        self.resident = OrderedDict()
+        self.stats = {"loads": 0, "evictions": 0, "switches": 0, "mixed_forwards": 0, "load_seconds": 0.0}
+
+        start_time = time.perf_counter()
+        self.model = PeftModel.from_pretrained(base_model, self.paths[self.default], adapter_name=self.default)
+        self.model.eval()
+        self._loaded(self.default, time.perf_counter() - start_time)
+        self.active = self.default
+
+    def register(self, name, path):
+        """注册（或更新）一个适配器目录，加载推迟到首次使用"""
+        if name == BASE_ADAPTER:
+            raise ValueError(f"{BASE_ADAPTER} 是保留名称")
+        read_adapter_config(path, self.base_name)
+        self.paths[name] = path
+
+    @property
+    def names(self):
+        return list(self.paths)
+
+    def __contains__(self, name):
+        return name == BASE_ADAPTER or name in self.paths
+
+    def adapter_bytes(self):
+        """各常驻适配器的LoRA权重字节数"""
+        return dict(self.resident)
+
+    def fits(self, names):
+        """这些适配器能否同时常驻（即能否出现在同一批次中）"""
+        return len(set(names) - {BASE_ADAPTER}) <= self.max_resident
+
+    def _loaded(self, name, seconds):
+        marker = f".{name}."
+        self.resident[name] = sum(
+            p.numel() * p.element_size() for n, p in self.model.named_parameters() if "lora_" in n and marker in n)
+        self.stats["loads"] += 1
+        self.stats["load_seconds"] += seconds
+        logger.info(f"已加载适配器 {name}（{self.paths[name]}），用时 {seconds * 1000:.1f}ms，"
+                    f"权重 {self.resident[name] / 2**20:.2f}MB")
+
+    def acquire(self, names):
+        """
+        保证 names 中的适配器全部常驻，必要时加载并卸载其他适配器
+
+        Args:
+            names: 当前批次用到的适配器名称（可含 BASE_ADAPTER）
+        """
+        needed = set(names) - {BASE_ADAPTER}
+        unknown = needed - set(self.paths)
+        if unknown:
+            raise KeyError(f"未注册的适配器: {', '.join(sorted(unknown))}")
+        if not self.fits(needed):
+            raise ValueError(f"一个批次使用了 {len(needed)} 个适配器，超过常驻上限 {self.max_resident}")
+
+        missing = sorted(needed - set(self.resident))
+        for name in needed - set(missing):
+            self.resident.move_to_end(name)
+        for name in missing:
+            # 先加载再卸载，max_resident=1 时也总有一个适配器可以激活
+            start_time = time.perf_counter()
+            self.model.load_adapter(self.paths[name], adapter_name=name, low_cpu_mem_usage=True)
+            self._loaded(name, time.perf_counter() - start_time)
+            while len(self.resident) > self.max_resident:
+                self._evict(next(n for n in self.resident if n not in needed))
+
+    def _evict(self, name):
+        if name == self.active:
+            # PEFT删除激活的适配器时会另选一个激活，这里先切到另一个常驻适配器
+            self.active = next(n for n in reversed(self.resident) if n != name)
+            self.model.set_adapter(self.active, inference_mode=True)
+        self.model.delete_adapter(name)
+        del self.resident[name]
+        self.stats["evictions"] += 1
+        logger.info(f"已卸载适配器 {name}")
+
+    def forward_kwargs(self, names):
+        """
+        批次各行使用 names 中的适配器时，调用 model 前向或 generate 需附加的参数
+
+        全部行使用同一个适配器时直接切换激活的适配器（不需要额外参数），否则返回 adapter_names 交给PEFT分组计算。
+        """
+        self.acquire(names)
+        unique = set(names)
+        if len(unique) == 1 and BASE_ADAPTER not in unique:
+            name = unique.pop()
+            if name != self.active:
+                self.model.set_adapter(name, inference_mode=True)
+                self.active = name
+                self.stats["switches"] += 1
+            return {}
+        self.stats["mixed_forwards"] += 1
+        return {"adapter_names": list(names)}
+
+    def activate(self, name):
+        """切换到单个适配器并返回模型，用于逐个适配器评估"""
+        if name == BASE_ADAPTER:
+            raise ValueError("评估基础模型请使用 model.disable_adapter() 上下文")
+        self.forward_kwargs([name])
+        return self.model
+
+    def metrics(self):
+        """常驻适配器和加载统计"""
+        return {
+            **self.stats,
+            "resident": list(self.resident),
+            "resident_bytes": sum(self.resident.values()),
+            "registered": len(self.paths),
+            "max_resident": self.max_resident,
+        }
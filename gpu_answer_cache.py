@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+问答结果缓存
+
+放在推理前面的两级缓存：先按规范化后的问题精确匹配（忽略大小写、空白和全角/半角标点），
+可选再用字符n-gram的MinHash/LSH查找近似重复的问题，Jaccard相似度达到阈值才算命中。
+
+条目按最近使用顺序淘汰（LRU），可设置条目数上限和过期时间（TTL）。缓存可持久化为JSON文件，
+文件中记录生成时所用适配器的指纹（adapter_config.json 与 adapter_model.safetensors 的sha256），
+加载时适配器已变化则丢弃全部条目。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from gpu_minhash import MinHasher, MinHashLSH, char_ngrams, jaccard, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# 参与指纹计算的文件：LoRA适配器的配置和权重，或 gpu_export 导出目录中的标记文件
+FINGERPRINT_FILES = ["adapter_config.json", "adapter_model.safetensors", "merged_model.json"]
+
+CACHE_FORMAT_VERSION = 1
+
+def adapter_fingerprint(model_dir):
+    """适配器（或导出的合并模型）的sha256指纹，目录中没有相关文件时返回None"""
+    if model_dir is None:
+        return None
+    digest = hashlib.sha256()
+    found = False
+    for name in FINGERPRINT_FILES:
+        path = os.path.join(model_dir, name)
+        if not os.path.isfile(path):
+            continue
+        found = True
+        digest.update(name.encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest() if found else None
+
+class AnswerCache:
+    """
+    问答结果缓存
+
+    Args:
+        path: 持久化文件路径，None表示只在内存中缓存
+        max_entries: 条目数上限，超出时淘汰最久未使用的条目
+        ttl: 条目的有效期（秒），None表示不过期
+        near_duplicates: 是否启用近似重复匹配
+        threshold: 近似重复匹配的字符n-gram Jaccard相似度阈值
+        ngram: 近似重复匹配的n-gram字符数（中文问题较短，默认按2个字符切分）
+        fingerprint: 适配器指纹（见 adapter_fingerprint），与持久化文件中的不一致时丢弃已有条目
+        save_interval: put() 距上次保存超过该秒数时自动保存
+        clock: 返回当前时间（秒）的函数
+    """
+
+    def __init__(self, path=None, max_entries=10000, ttl=None, near_duplicates=False, threshold=0.8,
+                 ngram=2, fingerprint=None, save_interval=60.0, clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.fingerprint = fingerprint
+        self.save_interval = save_interval
+        self.clock = clock
+        self.hasher = MinHasher(ngram=ngram)
+        self.lsh = MinHashLSH(self.hasher.num_perm)
+        # 规范化问题 -> 条目，顺序即最近使用顺序
+        self.entries = OrderedDict()
+        self.ngrams = {}
+        self.stats = {"exact_hits": 0, "near_hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                      "latency_saved": 0.0}
+        self.last_saved = clock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _index(self, key):
+        grams = char_ngrams(key, self.hasher.ngram)
+        self.ngrams[key] = grams
+        self.lsh.add(key, self.hasher.signature(ngrams=grams))
+
+    def _remove(self, key):
+        del self.entries[key]
+        self.ngrams.pop(key, None)
+        self.lsh.remove(key)
+
+    def _expired(self, entry):
+        return self.ttl is not None and self.clock() - entry["created"] > self.ttl
+
+    def _live_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self._expired(entry):
+            self._remove(key)
+            self.stats["expirations"] += 1
+            return None
+        return entry
+
+    def _nearest(self, key):
+        """LSH候选中与问题最相似且达到阈值的条目键"""
+        grams = char_ngrams(key, self.hasher.ngram)
+        best_key, best_score = None, self.threshold
+        for candidate in self.lsh.query(self.hasher.signature(ngrams=grams)):
+            score = jaccard(grams, self.ngrams[candidate])
+            if score >= best_score and self._live_entry(candidate) is not None:
+                best_key, best_score = candidate, score
+        return best_key
+
+    def get(self, question):
+        """
+        查找问题的缓存回答
+
+        Returns:
+            命中时返回条目字典（含 question、answer 及 put() 时记录的其他字段），否则返回None
+        """
+        key = normalize_text(question)
+        entry = self._live_entry(key)
+        if entry is not None:
+            self.stats["exact_hits"] += 1
+        elif self.near_duplicates and key:
+            nearest = self._nearest(key)
+            if nearest is not None:
+                key, entry = nearest, self.entries[nearest]
+                self.stats["near_hits"] += 1
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["latency_saved"] += entry["latency"]
+        return entry
+
+    def put(self, question, answer, latency=0.0, **extra):
+        """
+        缓存问题的回答
+
+        Args:
+            question: 原始问题
+            answer: 生成的回答
+            latency: 生成该回答所用的秒数，命中时累计为节省的时间
+            extra: 随条目保存的其他字段（需可JSON序列化）
+        """
+        key = normalize_text(question)
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = {"question": question, "answer": answer, "latency": latency,
+                             "created": self.clock(), **extra}
+        self._index(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+        if self.path is not None and self.clock() - self.last_saved >= self.save_interval:
+            self.save()
+
+    def clear(self):
+        for key in list(self.entries):
+            self._remove(key)
+
+    def metrics(self):
+        """命中率、节省的生成时间等统计"""
+        hits = self.stats["exact_hits"] + self.stats["near_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+    def save(self):
+        """原子地写入持久化文件（按最近使用顺序，过期条目不写入）"""
+        entries = [{"key": key, **entry} for key, entry in self.entries.items() if not self._expired(entry)]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_FORMAT_VERSION, "fingerprint": self.fingerprint, "entries": entries},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.last_saved = self.clock()
+
+    def load(self):
+        """从持久化文件加载条目；格式或适配器指纹不一致时丢弃"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"无法读取问答缓存 {self.path}: {e}，从空缓存开始")
+            return
+        if data.get("version") != CACHE_FORMAT_VERSION:
+            logger.warning(f"问答缓存 {self.path} 的格式版本不一致，从空缓存开始")
+            return
+        if data.get("fingerprint") != self.fingerprint:
+            logger.info(f"适配器已变化，丢弃问答缓存 {self.path} 中的 {len(data.get('entries', []))} 条结果")
+            return
+        self.clear()
+        for entry in data["entries"]:
+            key = entry.pop("key")
+            if self._expired(entry):
+                continue
+            self.entries[key] = entry
+            self._index(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+        logger.info(f"从 {self.path} 加载 {len(self.entries)} 条问答缓存")
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练批次构造工具
+- 序列打包（packing）：把多条完整的问答样本拼接到同一条序列中，减少填充浪费
+- 按长度分桶采样：让同一批次内的样本长度相近，减少填充
+- 填充率统计：记录真实token数与填充后token数之比
+"""
+
+import bisect
+import random
+
+import torch
+from datasets import Dataset
+from torch.utils.data import Sampler
+
+# 不参与损失计算的标签值
+IGNORE_INDEX = -100
+
+def example_labels(feature):
+    """样本的训练标签：由 assistant_mask 生成，助手回答之外的位置为 IGNORE_INDEX"""
+    input_ids = feature["input_ids"]
+    if "assistant_mask" in feature:
+        return [token_id if keep else IGNORE_INDEX for token_id, keep in zip(input_ids, feature["assistant_mask"])]
+    if "labels" in feature:
+        return list(feature["labels"])
+    return list(input_ids)
+
+class AssistantMaskCollator:
+    """把样本右填充到批内最大长度，并由 assistant_mask 生成只覆盖助手回答的标签"""
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        input_ids, attention_mask, labels = [], [], []
+        for feature in features:
+            length = len(feature["input_ids"])
+            padding = max_length - length
+            input_ids.append(list(feature["input_ids"]) + [self.pad_token_id] * padding)
+            attention_mask.append([1] * length + [0] * padding)
+            labels.append(example_labels(feature) + [IGNORE_INDEX] * padding)
+        return {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long),
+            "attention_mask": torch.tensor(attention_mask, dtype=torch.long),
+            "labels": torch.tensor(labels, dtype=torch.long),
+        }
+
+def pack_sequences(lengths, max_length):
+    """
+    最佳适配递减（best-fit decreasing）装箱
+
+    Args:
+        lengths: 每条样本的token数
+        max_length: 每条打包序列的最大长度
+
+    Returns:
+        打包方案，每个元素是一条打包序列中的样本下标列表
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    bins = []
+    # 按剩余容量升序维护 (剩余容量, 箱子下标)，二分查找能放下当前样本的最小剩余容量
+    remaining = []
+    for i in order:
+        length = min(lengths[i], max_length)
+        position = bisect.bisect_left(remaining, (length, -1))
+        if position < len(remaining):
+            capacity, bin_index = remaining.pop(position)
+            bins[bin_index].append(i)
+        else:
+            capacity, bin_index = max_length, len(bins)
+            bins.append([i])
+        bisect.insort(remaining, (capacity - length, bin_index))
+    return bins
+
+def pack_dataset(dataset, max_length):
+    """
+    把预处理后的数据集打包为定长以内的序列
+
+    每条样本保持完整；position_ids 在每条样本开头重置为0，用来标记样本边界，
+    模型据此构造块对角的因果注意力掩码，样本之间互不可见。每条样本的第一个标签
+    置为 IGNORE_INDEX，避免用上一条样本的末尾预测下一条样本的开头。
+
+    Args:
+        dataset: 含 input_ids 以及 assistant_mask（或 labels）列的数据集
+        max_length: 打包序列的最大长度
+
+    Returns:
+        含 input_ids、labels、position_ids 列的打包数据集
+    """
+    columns = {name: list(dataset[name]) for name in ("input_ids", "assistant_mask", "labels")
+               if name in dataset.column_names}
+    examples = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    lengths = [len(example["input_ids"]) for example in examples]
+
+    packed = {"input_ids": [], "labels": [], "position_ids": []}
+    for bin_indices in pack_sequences(lengths, max_length):
+        input_ids, labels, position_ids = [], [], []
+        for i in bin_indices:
+            ids = list(examples[i]["input_ids"][:max_length])
+            input_ids.extend(ids)
+            labels.append(IGNORE_INDEX)
+            labels.extend(example_labels(examples[i])[1:len(ids)])
+            position_ids.extend(range(len(ids)))
+        packed["input_ids"].append(input_ids)
+        packed["labels"].append(labels)
+        packed["position_ids"].append(position_ids)
+
+    return Dataset.from_dict(packed)
+
+def packing_efficiency(dataset, max_length):
+    """打包后的序列平均填充率（真实token数 / 序列容量）"""
+    total_tokens = sum(len(ids) for ids in dataset["input_ids"])
+    return total_tokens / max(len(dataset) * max_length, 1)
+
+class PackedSequenceCollator:
+    """
+    打包序列的批次整理器
+
+    把打包序列右填充到批内最大长度。填充部分作为一段独立的“序列”继续编号 position_ids，
+    标签为 IGNORE_INDEX；不返回 attention_mask，由模型根据 position_ids 识别样本边界。
+    """
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        input_ids, labels, position_ids = [], [], []
+        for feature in features:
+            padding = max_length - len(feature["input_ids"])
+            input_ids.append(list(feature["input_ids"]) + [self.pad_token_id] * padding)
+            labels.append(list(feature["labels"]) + [IGNORE_INDEX] * padding)
+            position_ids.append(list(feature["position_ids"]) + list(range(padding)))
+        return {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long),
+            "labels": torch.tensor(labels, dtype=torch.long),
+            "position_ids": torch.tensor(position_ids, dtype=torch.long),
+        }
+
+def dataset_lengths(dataset):
+    """样本的token长度，优先使用预处理阶段写入的 length 列"""
+    if "length" in dataset.column_names:
+        return list(dataset["length"])
+    return [len(ids) for ids in dataset["input_ids"]]
+
+class LengthBucketSampler(Sampler):
+    """
+    按长度分桶的采样器
+
+    每个epoch先随机打乱样本，再按 batch_size * bucket_size_multiplier 切成若干大桶，
+    桶内按长度排序后切成批次，最后打乱批次顺序。这样同一批次内长度相近，
+    而不同批次、不同桶之间仍保持随机。
+
+    不足一个批次的剩余样本总是放在最后，因此配合 dataloader_drop_last 时只会丢弃这一批，
+    不会让后续批次错位；梯度累积按连续批次进行，不受影响。
+
+    数据并行时各进程以相同的种子得到相同的批次划分，再由accelerate按批次轮流分配给各进程，
+    每个进程只处理自己的那部分批次。
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=50, shuffle=True, seed=42):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """本epoch的批次划分，每个元素是一个批次的样本下标列表"""
+        indices = list(range(len(self.lengths)))
+        if not self.shuffle:
+            indices.sort(key=lambda i: self.lengths[i], reverse=True)
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        rng = random.Random(self.seed + self.epoch)
+        rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i], reverse=True)
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        full_batches = [batch for batch in batches if len(batch) == self.batch_size]
+        remainder = sorted((i for batch in batches if len(batch) < self.batch_size for i in batch),
+                           key=lambda i: self.lengths[i], reverse=True)
+        rng.shuffle(full_batches)
+        # 各桶的零头合并后放在最后
+        remainder_batches = [remainder[i:i + self.batch_size] for i in range(0, len(remainder), self.batch_size)]
+        return full_batches + remainder_batches
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def __len__(self):
+        return len(self.lengths)
+
+class PaddingStatsCollator:
+    """
+    包装任意批次整理器，统计真实token数与填充后的token数
+
+    统计在主进程中累计，需要 dataloader_num_workers=0（默认值）。
+    """
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def __call__(self, features):
+        batch = self.collator(features)
+        self.real_tokens += sum(len(feature["input_ids"]) for feature in features)
+        self.padded_tokens += batch["input_ids"].numel()
+        return batch
+
+    def pop_efficiency(self):
+        """返回自上次调用以来的填充率（真实token数 / 填充后token数）并清零，没有数据时返回None"""
+        if self.padded_tokens == 0:
+            return None
+        efficiency = self.real_tokens / self.padded_tokens
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        return efficiency
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步检查点保存
+
+Trainer默认在保存步停下训练，把适配器、分词器、training_args.bin、优化器、调度器和随机数状态逐个写盘。
+这里把保存分成两步：
+- 训练线程只把LoRA权重和优化器状态复制到CPU内存（快照），并写入很小的随机数状态和 trainer_state.json
+- 后台线程把快照写成与Trainer相同的文件（adapter_model.safetensors、optimizer.pt、scheduler.pt 等），
+  写完后把临时目录原子地改名为 checkpoint-N，其他进程看到的检查点总是完整的
+
+分词器文件和 training_args.bin 在整个训练中不变，只在 output_dir/checkpoint-shared 中保存一份，
+各检查点通过硬链接引用（文件系统不支持硬链接时复制）。每次保存后按保留策略删除旧检查点：
+保留最近的 keep_last 个，以及按验证损失最好的一个。
+"""
+
+import copy
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+# torch在用到它的函数内导入，gpu_sweep、gpu_export 等只用到这里的文件名常量时不必加载它
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = "checkpoint"
+
+# 各检查点共享的不变文件所在的子目录（名称不匹配 checkpoint-<步数>，不会被当作检查点）
+SHARED_DIR = "checkpoint-shared"
+
+ADAPTER_WEIGHTS_FILE = "adapter_model.safetensors"
+OPTIMIZER_FILE = "optimizer.pt"
+SCHEDULER_FILE = "scheduler.pt"
+SCALER_FILE = "scaler.pt"
+
+def checkpoint_step(name):
+    """checkpoint-<步数> 目录名对应的步数，其他名称返回None"""
+    prefix, _, step = name.rpartition("-")
+    return int(step) if prefix == CHECKPOINT_PREFIX and step.isdigit() else None
+
+def list_checkpoints(output_dir):
+    """output_dir 下已完成的检查点，按步数排序的 [(步数, 路径)]"""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        step = checkpoint_step(name)
+        if step is not None and os.path.isdir(os.path.join(output_dir, name)):
+            checkpoints.append((step, os.path.join(output_dir, name)))
+    return sorted(checkpoints)
+
+def checkpoints_to_delete(steps, keep_last, best_step=None):
+    """保留策略：保留步数最大的 keep_last 个检查点和 best_step，返回其余检查点的步数"""
+    steps = sorted(steps)
+    keep = set(steps[-keep_last:]) if keep_last else set(steps)
+    if best_step is not None:
+        keep.add(best_step)
+    return [step for step in steps if step not in keep]
+
+def rotate_checkpoints(output_dir, keep_last, best_step=None):
+    """按保留策略删除 output_dir 下的旧检查点，返回删除的个数"""
+    checkpoints = dict(list_checkpoints(output_dir))
+    deleted = checkpoints_to_delete(list(checkpoints), keep_last, best_step)
+    for step in deleted:
+        logger.info(f"按保留策略删除检查点 {checkpoints[step]}")
+        shutil.rmtree(checkpoints[step], ignore_errors=True)
+    return len(deleted)
+
+def snapshot(obj):
+    """把（嵌套的）状态字典中的张量复制到CPU，其余值深拷贝，训练继续修改原张量不影响快照"""
+    import torch
+
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+def link_or_copy(source, target):
+    """硬链接文件，跨文件系统或不支持硬链接时复制"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+class AsyncCheckpointer:
+    """
+    在后台线程中写检查点
+
+    同一时刻最多有一个检查点在写：上一个还没写完时，新的保存先等待它完成，快照占用的内存不超过一个检查点。
+    后台写入出错时，在下一次 save() 或 wait() 时抛出。
+
+    Args:
+        output_dir: 训练输出目录，检查点写入其下的 checkpoint-N
+        keep_last: 保留最近的检查点数，None表示全部保留
+    """
+
+    def __init__(self, output_dir, keep_last=None):
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self.shared_dir = os.path.join(output_dir, SHARED_DIR)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.stats = {"saved": 0, "deleted": 0, "write_seconds": 0.0, "wait_seconds": 0.0}
+
+    def staging_dir(self, step):
+        """保存第 step 步检查点时写入的临时目录，写完后改名为 checkpoint-N"""
+        return os.path.join(self.output_dir, f".{CHECKPOINT_PREFIX}-{step}.tmp")
+
+    def checkpoint_dir(self, step):
+        return os.path.join(self.output_dir, f"{CHECKPOINT_PREFIX}-{step}")
+
+    def has_shared_files(self):
+        return os.path.isdir(self.shared_dir)
+
+    def write_shared_files(self, write):
+        """第一次保存前调用 write(目录) 写入不变的文件（分词器、training_args.bin）"""
+        tmp_dir = f"{self.shared_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        write(tmp_dir)
+        shutil.rmtree(self.shared_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.shared_dir)
+
+    def save(self, step, tensors, objects, write_config, best_step=None):
+        """
+        提交第 step 步检查点的写入，立即返回
+
+        Args:
+            step: 全局步数
+            tensors: 写成safetensors的 {文件名: 状态字典}（已是CPU快照）
+            objects: 用torch.save写入的 {文件名: 对象}（已是CPU快照）
+            write_config: 在后台线程中调用 write_config(目录) 写入其他小文件（如 adapter_config.json）
+            best_step: 验证损失最好的检查点步数，保留策略不删除它
+        """
+        self.wait()
+        self.pending = self.executor.submit(self._write, step, tensors, objects, write_config, best_step)
+
+    def wait(self):
+        """等待正在写的检查点完成"""
+        if self.pending is None:
+            return
+        start_time = time.perf_counter()
+        try:
+            self.pending.result()
+        finally:
+            self.pending = None
+            self.stats["wait_seconds"] += time.perf_counter() - start_time
+
+    def _write(self, step, tensors, objects, write_config, best_step):
+        import torch
+        from safetensors.torch import save_file
+
+        start_time = time.perf_counter()
+        staging = self.staging_dir(step)
+        os.makedirs(staging, exist_ok=True)
+        for name, state_dict in tensors.items():
+            save_file({key: value.contiguous() for key, value in state_dict.items()},
+                      os.path.join(staging, name), metadata={"format": "pt"})
+        for name, obj in objects.items():
+            torch.save(obj, os.path.join(staging, name))
+        write_config(staging)
+        if self.has_shared_files():
+            for name in os.listdir(self.shared_dir):
+                target = os.path.join(staging, name)
+                if not os.path.exists(target):
+                    link_or_copy(os.path.join(self.shared_dir, name), target)
+
+        final = self.checkpoint_dir(step)
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(staging, final)
+        seconds = time.perf_counter() - start_time
+        self.stats["saved"] += 1
+        self.stats["write_seconds"] += seconds
+        logger.info(f"检查点已写入 {final}（后台用时 {seconds:.2f}s）")
+        self.stats["deleted"] += rotate_checkpoints(self.output_dir, self.keep_last, best_step)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分块交叉熵损失
+按序列分块计算LM head和交叉熵，不保留完整的 batch × seq × vocab logits
+
+Qwen3的词表约15万，完整logits是训练中最大的一块显存。这里让模型前向只输出最后一层的
+隐藏状态，只取标签有效（不为-100）的位置，每次对一块位置计算logits和损失，并对每块使用
+激活重计算：反向传播时重新计算该块的logits，因此任何时刻最多只存在一块logits。
+"""
+
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+# 不参与损失计算的标签值
+IGNORE_INDEX = -100
+
+def _chunk_loss_sum(hidden_states, weight, bias, targets):
+    """一块位置的交叉熵之和，logits升为float32计算，与transformers的默认损失一致"""
+    logits = F.linear(hidden_states, weight, bias).float()
+    return F.cross_entropy(logits, targets, reduction="sum")
+
+def chunked_cross_entropy(hidden_states, weight, labels, chunk_size=1024, bias=None, num_items_in_batch=None):
+    """
+    因果语言模型的分块交叉熵
+
+    Args:
+        hidden_states: 最后一层隐藏状态，形状 (batch, seq, hidden)
+        weight: LM head权重，形状 (vocab, hidden)
+        labels: 未移位的标签，形状 (batch, seq)，IGNORE_INDEX 表示不计算损失
+        chunk_size: 每块计算logits的位置数
+        bias: LM head偏置（Qwen3没有）
+        num_items_in_batch: 梯度累积内的有效标签总数；给定时返回 损失和/该数，否则返回均值
+
+    Returns:
+        标量损失
+    """
+    hidden_size = hidden_states.shape[-1]
+    hidden = hidden_states[:, :-1, :].reshape(-1, hidden_size)
+    targets = labels[:, 1:].reshape(-1).to(hidden.device)
+
+    # 只对有效标签的位置计算logits
+    keep = targets != IGNORE_INDEX
+    hidden = hidden[keep]
+    targets = targets[keep]
+
+    total = hidden_states.new_zeros((), dtype=torch.float32)
+    for start in range(0, targets.numel(), chunk_size):
+        total = total + checkpoint(
+            _chunk_loss_sum,
+            hidden[start:start + chunk_size],
+            weight,
+            bias,
+            targets[start:start + chunk_size],
+            use_reentrant=False,
+        )
+
+    if num_items_in_batch is not None:
+        if torch.is_tensor(num_items_in_batch):
+            num_items_in_batch = num_items_in_batch.to(total.device)
+        return total / num_items_in_batch
+    return total / keep.sum().clamp(min=1)
+
+def _causal_lm(model):
+    """剥去DDP等包装，返回带 get_output_embeddings 的模型（PeftModel会转发到基础模型）"""
+    while hasattr(model, "module") and not hasattr(model, "get_output_embeddings"):
+        model = model.module
+    return model
+
+@contextmanager
+def hidden_states_as_logits(model):
+    """临时把LM head替换为恒等映射，使模型前向的 logits 输出为最后一层隐藏状态"""
+    lm_head = _causal_lm(model).get_output_embeddings()
+    lm_head.forward = lambda hidden_states: hidden_states
+    try:
+        yield lm_head
+    finally:
+        del lm_head.forward
+
+def chunked_lm_loss(model, inputs, chunk_size=1024, num_items_in_batch=None):
+    """
+    以分块交叉熵计算模型在一个批次上的损失
+
+    模型前向经过原有的包装（PEFT、DDP），梯度同步和LoRA旁路都不受影响。
+
+    Args:
+        model: 因果语言模型，可以是PeftModel或被DDP包装
+        inputs: 含 labels 的批次
+        chunk_size: 每块计算logits的位置数
+        num_items_in_batch: 梯度累积内的有效标签总数
+
+    Returns:
+        (loss, outputs)，outputs.logits 为最后一层隐藏状态
+    """
+    labels = inputs["labels"]
+    model_inputs = {key: value for key, value in inputs.items() if key != "labels"}
+    with hidden_states_as_logits(model) as lm_head:
+        outputs = model(**model_inputs, use_cache=False)
+    loss = chunked_cross_entropy(
+        outputs.logits,
+        lm_head.weight,
+        labels,
+        chunk_size=chunk_size,
+        bias=lm_head.bias,
+        num_items_in_batch=num_items_in_batch,
+    )
+    return loss, outputs
+
+def sequence_nll(model, inputs, chunk_size=1024):
+    """
+    推理时每条序列在有效标签上的负对数似然之和与token数
+
+    与 chunked_lm_loss 一样只对有效标签位置分块计算logits（不需要反向，因此不做重计算），
+    批内填充和其他序列不影响每条序列的结果。
+
+    Args:
+        model: 因果语言模型，可以是PeftModel
+        inputs: 含 labels 的批次
+        chunk_size: 每块计算logits的位置数
+
+    Returns:
+        (nll_sums, token_counts)，形状均为 (batch,)，nll_sums 为float32
+    """
+    labels = inputs["labels"]
+    model_inputs = {key: value for key, value in inputs.items() if key != "labels"}
+    with hidden_states_as_logits(model) as lm_head:
+        outputs = model(**model_inputs, use_cache=False)
+    hidden = outputs.logits[:, :-1, :]
+    targets = labels[:, 1:].to(hidden.device)
+    keep = targets != IGNORE_INDEX
+    rows = torch.arange(targets.shape[0], device=hidden.device).unsqueeze(1).expand_as(targets)[keep]
+    hidden = hidden[keep]
+    targets = targets[keep]
+
+    totals = torch.zeros(labels.shape[0], dtype=torch.float32, device=hidden.device)
+    for start in range(0, targets.numel(), chunk_size):
+        logits = F.linear(hidden[start:start + chunk_size], lm_head.weight, lm_head.bias).float()
+        losses = F.cross_entropy(logits, targets[start:start + chunk_size], reduction="none")
+        totals.index_add_(0, rows[start:start + chunk_size], losses)
+    return totals, keep.sum(dim=1)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复检测与训练/测试泄漏索引
+
+对每条问答的“问题+回答”（规范化后）计算字符n-gram的MinHash签名（见 gpu_minhash），
+用LSH分段找出候选：每一段把全部签名按该段的哈希排序，哈希相同的一组记录都与组内第一条比较，
+签名估计的Jaccard相似度达到阈值即视为近似重复。可选地把规范化后问题完全相同的记录也视为重复
+（同一问题配不同的回答同样会造成泄漏）。重复关系经并查集合并成簇，排序使总耗时约为 O(N log N)，
+签名以 uint32 矩阵保存（64个分量时每条256字节），百万级问答可在单机内存中完成。
+
+数据源按优先级顺序加入（默认 test > validation > train > training_data > 基础题集），
+每个簇只保留优先级最高、最靠前的一条：训练集中与验证/测试集重复的样本被去掉，
+评估集本身只在内部或与更高优先级的评估集重复时才去重。
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gpu_ingest import iter_dataset_records, write_jsonl
+from gpu_minhash import MinHasher, normalize_text
+
+# 默认的数据源（按优先级从高到低）及其中的评估集
+DEFAULT_SOURCES = ["test.jsonl", "validation.jsonl", "train.jsonl", "training_data.jsonl", "基础题集"]
+EVAL_SOURCES = ["test", "validation"]
+
+def source_name(path):
+    """数据源名称：去掉 .jsonl 后缀的文件名"""
+    name = os.path.basename(path)
+    return name[:-len(".jsonl")] if name.endswith(".jsonl") else name
+
+def iter_valid_records(path):
+    """数据源中格式正确的记录，逐条产出 (行号, record)；格式错误的行由 gpu_ingest 校验时报告，这里跳过"""
+    for line_number, record, error in iter_dataset_records(path):
+        if error is None:
+            yield line_number, record
+
+def question_hash(question):
+    """规范化后问题的64位哈希"""
+    digest = hashlib.blake2b(normalize_text(question).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+def _signature_batch(records, num_perm, ngram, seed):
+    """一批记录的 (签名矩阵, 问题哈希)，在工作进程中运行"""
+    hasher = MinHasher(num_perm, ngram, seed)
+    signatures = np.stack([hasher.signature(normalize_text(question + answer)) for question, answer in records])
+    hashes = np.array([question_hash(question) for question, _ in records], dtype=np.uint64)
+    return signatures.astype(np.uint32), hashes
+
+def _band_keys(columns):
+    """把一段签名分量合成一个64位键（FNV风格，按2^64回绕）"""
+    keys = np.full(len(columns), 0xcbf29ce484222325, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in columns.T:
+            keys = (keys ^ column.astype(np.uint64)) * np.uint64(0x100000001b3)
+    return keys
+
+def _group_pairs(keys):
+    """
+    键相同的记录分为一组，返回 (组内第一条, 其余各条) 的下标对
+
+    稳定排序保证组内第一条是下标最小的记录。
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0))
+    return order[group_start][~first], order[~first]
+
+class DedupIndex:
+    """
+    跨数据源的近似重复索引
+
+    Args:
+        threshold: 签名估计的Jaccard相似度达到该值视为近似重复
+        num_perm: MinHash签名长度
+        bands: LSH分段数，须整除 num_perm；相似度为s的两条记录成为候选的概率为 1-(1-s^(num_perm/bands))^bands
+        ngram: 字符n-gram长度
+        match_questions: 规范化后问题相同的记录也视为重复
+        workers: 计算签名的进程数，为1时在当前进程中计算
+        batch_size: 每个任务计算签名的记录数
+        seed: MinHash种子
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, ngram=3, match_questions=True, workers=1,
+                 batch_size=4096, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"bands ({bands}) 必须整除 num_perm ({num_perm})")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.ngram = ngram
+        self.match_questions = match_questions
+        self.workers = workers
+        self.batch_size = batch_size
+        self.seed = seed
+        self.names = []
+        self.paths = []
+        self._signatures = []
+        self._question_hashes = []
+        self._lines = []
+        self.roots = None
+
+    def __len__(self):
+        return sum(len(lines) for lines in self._lines)
+
+    def _batches(self, path):
+        batch, lines = [], []
+        for line_number, record in iter_valid_records(path):
+            batch.append((record["question"], record["answer"]))
+            lines.append(line_number)
+            if len(batch) >= self.batch_size:
+                yield batch, lines
+                batch, lines = [], []
+        if batch:
+            yield batch, lines
+
+    def add_source(self, path, name=None, executor=None):
+        """流式读取一个数据源并计算签名；数据源按优先级从高到低依次加入"""
+        name = name or source_name(path)
+        if name in self.names:
+            raise ValueError(f"数据源名称重复: {name}")
+        options = (self.num_perm, self.ngram, self.seed)
+        signatures, hashes, lines = [], [], []
+        if executor is None:
+            for batch, batch_lines in self._batches(path):
+                batch_signatures, batch_hashes = _signature_batch(batch, *options)
+                signatures.append(batch_signatures)
+                hashes.append(batch_hashes)
+                lines.extend(batch_lines)
+        else:
+            # 同时提交的任务数有上限，读取速度快于签名计算时不会把整个文件读进内存
+            pending = deque()
+            for batch, batch_lines in self._batches(path):
+                pending.append((executor.submit(_signature_batch, batch, *options), batch_lines))
+                while len(pending) > 2 * self.workers or (pending and pending[0][0].done()):
+                    future, done_lines = pending.popleft()
+                    batch_signatures, batch_hashes = future.result()
+                    signatures.append(batch_signatures)
+                    hashes.append(batch_hashes)
+                    lines.extend(done_lines)
+            for future, done_lines in pending:
+                batch_signatures, batch_hashes = future.result()
+                signatures.append(batch_signatures)
+                hashes.append(batch_hashes)
+                lines.extend(done_lines)
+
+        self.names.append(name)
+        self.paths.append(path)
+        self._signatures.append(np.concatenate(signatures) if signatures
+                                else np.empty((0, self.num_perm), dtype=np.uint32))
+        self._question_hashes.append(np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64))
+        self._lines.append(np.array(lines, dtype=np.int64))
+        self.roots = None
+
+    def add_sources(self, paths):
+        """按顺序加入多个数据源，workers大于1时用进程池并行计算签名"""
+        if self.workers <= 1:
+            for path in paths:
+                self.add_source(path)
+            return
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            for path in paths:
+                self.add_source(path, executor=executor)
+
+    def build(self):
+        """查找全部重复关系并合并成簇，self.roots[i] 为记录i所在簇中下标最小的记录；没有任何记录时为空数组"""
+        signatures = np.concatenate(self._signatures) if self._signatures \
+            else np.empty((0, self.num_perm), dtype=np.uint32)
+        num_records = len(signatures)
+        # 并查集：合并时总把较大的根指向较小的根，因此每个簇的根是其中下标最小的记录
+        parent = np.arange(num_records)
+
+        def compress():
+            nonlocal parent
+            while True:
+                grandparent = parent[parent]
+                if np.array_equal(grandparent, parent):
+                    return
+                parent = grandparent
+
+        def union(anchors, members):
+            # 先去掉已在同一簇中的对，剩下的逐对合并后立即压缩路径
+            compress()
+            roots_a, roots_b = parent[anchors], parent[members]
+            different = roots_a != roots_b
+            for a, b in zip(roots_a[different].tolist(), roots_b[different].tolist()):
+                while parent[a] != a:
+                    a = parent[a]
+                while parent[b] != b:
+                    b = parent[b]
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        self.stats = {"candidate_pairs": 0, "near_duplicate_pairs": 0, "same_question_pairs": 0}
+        if num_records:
+            rows = self.num_perm // self.bands
+            for band in range(self.bands):
+                anchors, members = _group_pairs(_band_keys(signatures[:, band * rows:(band + 1) * rows]))
+                self.stats["candidate_pairs"] += len(anchors)
+                # 分块比较签名，中间结果的内存有上限
+                for start in range(0, len(anchors), 1 << 16):
+                    a, b = anchors[start:start + (1 << 16)], members[start:start + (1 << 16)]
+                    similar = (signatures[a] == signatures[b]).mean(axis=1) >= self.threshold
+                    self.stats["near_duplicate_pairs"] += int(similar.sum())
+                    union(a[similar], b[similar])
+            if self.match_questions:
+                anchors, members = _group_pairs(np.concatenate(self._question_hashes))
+                self.stats["same_question_pairs"] = len(anchors)
+                union(anchors, members)
+
+        compress()
+        self.roots = parent
+        self.signatures = signatures
+        return self
+
+    def _source_ids(self):
+        return np.repeat(np.arange(len(self.names)), [len(lines) for lines in self._lines])
+
+    def _offsets(self):
+        return np.cumsum([0] + [len(lines) for lines in self._lines])
+
+    def keep_mask(self):
+        """每个簇只保留下标最小（优先级最高的数据源中最靠前）的记录"""
+        if self.roots is None:
+            self.build()
+        return self.roots == np.arange(len(self.roots))
+
+    def _read_records(self, indices):
+        """按全局下标重新读取记录（用于报告示例，避免在内存中保存全部文本）"""
+        wanted = {}
+        offsets = self._offsets()
+        for index in sorted(set(indices)):
+            source = int(np.searchsorted(offsets, index, side="right") - 1)
+            wanted.setdefault(source, set()).add(index - offsets[source])
+        records = {}
+        for source, positions in wanted.items():
+            for position, (_, record) in enumerate(iter_valid_records(self.paths[source])):
+                if position in positions:
+                    records[offsets[source] + position] = record
+        return records
+
+    def report(self, max_examples=20, eval_sources=EVAL_SOURCES):
+        """
+        去重与泄漏报告
+
+        overlap[a][b] 为数据源a中与数据源b的某条记录同簇（近似重复或问题相同）的记录数；
+        示例优先列出评估集记录在其他数据源中的重复。
+        """
+        keep = self.keep_mask()
+        roots = self.roots
+        sources = self._source_ids()
+        offsets = self._offsets()
+        present = []
+        for s in range(len(self.names)):
+            mask = np.zeros(len(roots), dtype=bool)
+            mask[roots[sources == s]] = True
+            present.append(mask)
+
+        summary = {}
+        overlap = {}
+        for s, name in enumerate(self.names):
+            source_roots = roots[sources == s]
+            counts = np.bincount(source_roots, minlength=len(roots))
+            summary[name] = {
+                "path": self.paths[s],
+                "records": int(len(source_roots)),
+                "kept": int(keep[sources == s].sum()),
+                "duplicates_within": int((counts[source_roots] > 1).sum()),
+            }
+            overlap[name] = {other: int(present[t][source_roots].sum())
+                             for t, other in enumerate(self.names) if t != s}
+
+        # 示例：被去掉的记录及其所在簇的保留记录，评估集相关的优先
+        duplicates = np.flatnonzero(~keep)
+        eval_ids = [s for s, name in enumerate(self.names) if name in eval_sources]
+        involves_eval = np.isin(sources[duplicates], eval_ids) | np.isin(sources[roots[duplicates]], eval_ids)
+        chosen = np.concatenate([duplicates[involves_eval], duplicates[~involves_eval]])[:max_examples]
+        records = self._read_records(list(chosen) + list(roots[chosen]))
+        hashes = np.concatenate(self._question_hashes) if self._question_hashes else np.empty(0, dtype=np.uint64)
+
+        def describe(index):
+            source = int(sources[index])
+            return {"source": self.names[source], "line": int(self._lines[source][index - offsets[source]]),
+                    "question": records[index]["question"]}
+
+        examples = []
+        for index in chosen.tolist():
+            root = int(roots[index])
+            examples.append({
+                **describe(index),
+                "duplicate_of": describe(root),
+                "similarity": float((self.signatures[index] == self.signatures[root]).mean()),
+                "same_question": bool(hashes[index] == hashes[root]),
+            })
+
+        return {
+            "config": {"threshold": self.threshold, "num_perm": self.num_perm, "bands": self.bands,
+                       "ngram": self.ngram, "match_questions": self.match_questions},
+            "records": int(len(roots)),
+            "kept": int(keep.sum()),
+            "duplicate_clusters": int(np.count_nonzero(np.bincount(roots, minlength=len(roots)) > 1)),
+            **self.stats,
+            "sources": summary,
+            "overlap": overlap,
+            "leakage": {name: overlap[name] for name in self.names if name in eval_sources},
+            "examples": examples,
+        }
+
+    def write_deduplicated(self, output_dir):
+        """把每个数据源保留的记录写入 output_dir/<数据源名>.jsonl（question-answer格式），返回各自的条数"""
+        keep = self.keep_mask()
+        offsets = self._offsets()
+        counts = {}
+        for s, name in enumerate(self.names):
+            source_keep = keep[offsets[s]:offsets[s + 1]]
+            records = (record for position, (_, record) in enumerate(iter_valid_records(self.paths[s]))
+                       if source_keep[position])
+            counts[name] = write_jsonl(records, os.path.join(output_dir, f"{name}.jsonl"))
+        return counts
+
+def format_report(report):
+    """可读的报告摘要"""
+    lines = [f"记录数: {report['records']}，去重后: {report['kept']}，重复簇: {report['duplicate_clusters']}",
+             f"候选对: {report['candidate_pairs']}，近似重复对: {report['near_duplicate_pairs']}，"
+             f"问题相同对: {report['same_question_pairs']}"]
+    for name, info in report["sources"].items():
+        lines.append(f"  {name}: {info['records']} 条，保留 {info['kept']}，内部重复 {info['duplicates_within']}")
+    for name, row in report["leakage"].items():
+        lines.append(f"泄漏 {name}: " + "，".join(f"{other} {count}" for other, count in row.items()))
+    for example in report["examples"]:
+        original = example["duplicate_of"]
+        lines.append(f"  {example['source']}:{example['line']} ≈ {original['source']}:{original['line']} "
+                     f"(相似度 {example['similarity']:.2f}{'，问题相同' if example['same_question'] else ''}) "
+                     f"{example['question'][:40]}")
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GPU-QA近似重复检测与训练/测试泄漏报告")
+    parser.add_argument("files", nargs="*",
+                        help="数据源（JSONL或题集文本），按优先级从高到低；默认为dataset_path下的test、validation、"
+                             "train、training_data和基础题集")
+    parser.add_argument("--dataset_path", type=str, default="GPU-QA",
+                        help="未指定文件时使用的数据集目录")
+    parser.add_argument("--threshold", type=float, default=0.8,
+                        help="近似重复的Jaccard相似度阈值")
+    parser.add_argument("--num_perm", type=int, default=64,
+                        help="MinHash签名长度")
+    parser.add_argument("--bands", type=int, default=16,
+                        help="LSH分段数")
+    parser.add_argument("--ngram", type=int, default=3,
+                        help="字符n-gram长度")
+    parser.add_argument("--no_question_match", action="store_true",
+                        help="问题相同但回答不相似的记录不视为重复")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="计算签名的进程数，默认CPU核数")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="写出去重后的各数据源（<数据源名>.jsonl）")
+    parser.add_argument("--report", type=str, default=None,
+                        help="泄漏报告的JSON输出路径")
+    parser.add_argument("--max_examples", type=int, default=20,
+                        help="报告中的重复示例条数")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = args.files or [os.path.join(args.dataset_path, name) for name in DEFAULT_SOURCES
+                           if os.path.exists(os.path.join(args.dataset_path, name))]
+    if not files:
+        raise SystemExit(f"没有可检查的数据源：未指定文件，且 {args.dataset_path} 下没有 {'、'.join(DEFAULT_SOURCES)}")
+    missing = [path for path in files if not os.path.exists(path)]
+    if missing:
+        raise SystemExit(f"数据源不存在: {'、'.join(missing)}")
+    index = DedupIndex(threshold=args.threshold, num_perm=args.num_perm, bands=args.bands, ngram=args.ngram,
+                       match_questions=not args.no_question_match, workers=args.workers or os.cpu_count() or 1)
+    index.add_sources(files)
+    report = index.build().report(args.max_examples)
+    print(format_report(report))
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已保存到 {args.report}")
+    if args.output_dir:
+        counts = index.write_deduplicated(args.output_dir)
+        print(f"去重后的数据已写入 {args.output_dir}: " + "，".join(f"{k} {v}" for k, v in counts.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据并行工具
+支持通过 torchrun 或 accelerate launch 以多进程（多卡/多机）方式运行训练和评估
+
+进程信息读取自启动器设置的 RANK、LOCAL_RANK、WORLD_SIZE 环境变量；
+有GPU时使用nccl后端并把每个进程绑定到各自的GPU，纯CPU时使用gloo后端。
+单进程运行时所有函数退化为无操作。
+"""
+
+import os
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+
+def get_world_size():
+    """进程总数"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+def get_rank():
+    """全局进程编号"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return int(os.environ.get("RANK", 0))
+
+def get_local_rank():
+    """本机内的进程编号"""
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+def is_distributed():
+    return get_world_size() > 1
+
+def is_main_process():
+    """是否为0号进程，只有它写入参数文件、评估结果等共享输出"""
+    return get_rank() == 0
+
+def init_distributed():
+    """
+    在多进程启动时初始化进程组，并把当前进程绑定到本机的第 LOCAL_RANK 块GPU
+
+    Trainer（accelerate）会复用已初始化的进程组，因此仅评估时也能使用分布式评估。
+    """
+    if not is_distributed() or dist.is_initialized():
+        return
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_local_rank())
+        backend = "nccl"
+    else:
+        backend = "gloo"
+    dist.init_process_group(backend=backend)
+
+def distributed_device_map():
+    """
+    模型加载时的 device_map
+
+    单进程时沿用 "auto"；数据并行时每个进程在自己的GPU上加载一份完整模型，
+    纯CPU时不指定 device_map。
+    """
+    if not is_distributed():
+        return "auto"
+    if torch.cuda.is_available():
+        return {"": get_local_rank()}
+    return None
+
+def barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+@contextmanager
+def main_process_first():
+    """0号进程先执行（如预处理并写入缓存），其他进程等它完成后再执行（直接命中缓存）"""
+    if not is_main_process():
+        barrier()
+    try:
+        yield
+    finally:
+        if is_main_process():
+            barrier()
+
+def shard_indices(num_items, rank=None, world_size=None):
+    """当前进程负责的样本下标，按进程编号交错划分，各进程的工作量相近"""
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    return list(range(rank, num_items, world_size))
+
+def gather_objects(obj):
+    """收集所有进程的对象（需可pickle），按进程编号返回列表；单进程时返回 [obj]"""
+    if not (dist.is_available() and dist.is_initialized()):
+        return [obj]
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
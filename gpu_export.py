@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合并LoRA适配器并导出推理模型
+
+把LoRA权重合并进基础模型，导出为单个safetensors文件和分词器文件，可选量化。
+推理时不再经过LoRA旁路，也不需要原始基础模型。评估和服务代码会自动识别导出目录。
+
+用法:
+    python gpu_export.py --model_type qwen3-1.7b --adapter_dir outputs/qwen3-1.7b
+    python gpu_export.py --model_type qwen3-0.6b --adapter_dir outputs/qwen3-0.6b --quantize nf4
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+from gpu_checkpoint import ADAPTER_WEIGHTS_FILE
+
+logger = logging.getLogger(__name__)
+
+# 导出目录中的标记文件，记录导出来源和量化方式
+MERGED_MODEL_MARKER = "merged_model.json"
+
+# 导出目录的默认位置：适配器目录下的 merged 子目录
+DEFAULT_EXPORT_SUBDIR = "merged"
+
+QUANTIZE_CHOICES = ["none", "fp16", "bf16", "int8", "nf4"]
+
+def _hash_adapter(adapter_dir):
+    """适配器权重文件的sha256，用于判断导出的模型是否过期；没有权重文件时返回None"""
+    path = os.path.join(adapter_dir, ADAPTER_WEIGHTS_FILE)
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def is_merged_model_dir(path):
+    """目录是否为 gpu_export 导出的合并模型"""
+    return path is not None and os.path.isfile(os.path.join(path, MERGED_MODEL_MARKER))
+
+def find_merged_model(path):
+    """
+    查找可直接加载的合并模型目录
+
+    path 本身是导出目录时直接返回；path 是适配器目录时返回其下与当前适配器权重一致的
+    merged 子目录，适配器重新训练后旧的导出会被忽略。找不到时返回None。
+    """
+    if is_merged_model_dir(path):
+        return path
+    export_dir = os.path.join(path, DEFAULT_EXPORT_SUBDIR)
+    if not is_merged_model_dir(export_dir):
+        return None
+    with open(os.path.join(export_dir, MERGED_MODEL_MARKER), "r", encoding="utf-8") as f:
+        marker = json.load(f)
+    if marker.get("adapter_sha256") != _hash_adapter(path):
+        logger.warning(f"{export_dir} 与 {path} 中的适配器不一致，忽略该导出，请重新导出")
+        return None
+    return export_dir
+
+def export_merged_model(model, tokenizer, export_dir, quantize="none", adapter_dir=None, base_model=None):
+    """
+    合并LoRA权重并导出
+
+    Args:
+        model: 套有LoRA适配器的PeftModel
+        tokenizer: 分词器，与模型一起保存
+        export_dir: 导出目录
+        quantize: none 保持原精度；fp16/bf16 转换权重精度；int8/nf4 使用bitsandbytes量化（需要GPU）
+        adapter_dir: 适配器目录，记录其权重哈希用于判断导出是否过期
+        base_model: 基础模型名称，记录在标记文件中
+
+    Returns:
+        导出目录
+    """
+    if quantize not in QUANTIZE_CHOICES:
+        raise ValueError(f"不支持的量化方式: {quantize}，可选: {QUANTIZE_CHOICES}")
+    if quantize in ("int8", "nf4") and not torch.cuda.is_available():
+        raise ValueError(f"{quantize} 量化依赖bitsandbytes，需要在GPU上导出")
+
+    merged = model.merge_and_unload()
+    if quantize == "fp16":
+        merged = merged.to(torch.float16)
+    elif quantize == "bf16":
+        merged = merged.to(torch.bfloat16)
+
+    os.makedirs(export_dir, exist_ok=True)
+    # 足够大的分片上限保证写出单个safetensors文件
+    merged.save_pretrained(export_dir, safe_serialization=True, max_shard_size="1000GB")
+    tokenizer.save_pretrained(export_dir)
+
+    if quantize in ("int8", "nf4"):
+        # 以bitsandbytes配置重新加载合并后的权重，再保存量化后的权重覆盖原文件
+        if quantize == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+        quantized = AutoModelForCausalLM.from_pretrained(
+            export_dir, quantization_config=quantization_config, device_map={"": 0}
+        )
+        quantized.save_pretrained(export_dir, safe_serialization=True, max_shard_size="1000GB")
+
+    marker = {
+        "base_model": base_model,
+        "adapter_dir": adapter_dir,
+        "adapter_sha256": _hash_adapter(adapter_dir) if adapter_dir else None,
+        "quantize": quantize,
+    }
+    with open(os.path.join(export_dir, MERGED_MODEL_MARKER), "w", encoding="utf-8") as f:
+        json.dump(marker, f, ensure_ascii=False, indent=2)
+
+    logger.info(f"合并后的模型已导出到 {export_dir}")
+    return export_dir
+
+def load_merged_model(export_dir, device_map=None):
+    """
+    加载导出的合并模型和分词器
+
+    量化配置保存在config.json中，加载时自动生效；CPU上以float32加载。
+    """
+    tokenizer = AutoTokenizer.from_pretrained(export_dir)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(
+        export_dir,
+        torch_dtype="auto" if torch.cuda.is_available() else torch.float32,
+        device_map=device_map,
+    )
+    model.eval()
+    logger.info(f"已加载合并模型 {export_dir}")
+    return model, tokenizer
+
+def parse_args():
+    from gpu_llm_finetune import SUPPORTED_MODELS
+
+    parser = argparse.ArgumentParser(description="合并LoRA适配器并导出推理模型")
+    parser.add_argument("--model_type", type=str, default="qwen3-1.7b", choices=SUPPORTED_MODELS.keys(),
+                        help="基础模型类型")
+    parser.add_argument("--adapter_dir", type=str, default="outputs",
+                        help="LoRA适配器目录（训练的output_dir或检查点目录）")
+    parser.add_argument("--export_dir", type=str, default=None,
+                        help="导出目录，默认为adapter_dir/merged，评估时会自动识别")
+    parser.add_argument("--quantize", type=str, default="none", choices=QUANTIZE_CHOICES,
+                        help="导出权重的精度或量化方式")
+    return parser.parse_args()
+
+def main():
+    from peft import PeftModel
+
+    from gpu_llm_finetune import SUPPORTED_MODELS, create_model_and_tokenizer
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    export_dir = args.export_dir or os.path.join(args.adapter_dir, DEFAULT_EXPORT_SUBDIR)
+
+    # 在CPU上合并，不占用显存
+    model, tokenizer = create_model_and_tokenizer(args.model_type, device_map="cpu")
+    model = PeftModel.from_pretrained(model, args.adapter_dir)
+    export_merged_model(
+        model,
+        tokenizer,
+        export_dir,
+        quantize=args.quantize,
+        adapter_dir=args.adapter_dir,
+        base_model=SUPPORTED_MODELS[args.model_type]["name"],
+    )
+
+if __name__ == "__main__":
+    main()
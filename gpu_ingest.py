@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPU-QA语料的流式读取与校验
+
+逐行解析JSONL，同时支持 question/answer 格式和 messages 格式（system/user/assistant），
+也可读取“N.问题：/答案：”形式的题集文本（如 GPU-QA/基础题集）。数据集验证（test_dataset.py）、格式转换（convert_dataset_format.py）和数据集创建
+（create_gpu_dataset.py）共用这里的解析与写入逻辑。
+
+校验时把文件按字节区间切成若干块（块边界对齐到行首），由多个进程并行处理，每个进程只持有
+一个分词批次的数据，内存占用与文件大小无关。每条记录检查：
+- 编码与JSON格式、字段是否齐全（schema）、问题或回答是否为空——计为错误
+- 按目标分词器渲染完整训练对话后的token数是否超过 max_length（会被截断）——计为警告
+- 是否包含GPU相关关键词——统计覆盖率，不含关键词的记录计为警告
+各块的统计合并为一份汇总报告，错误和警告各保留前若干条示例（带全局行号）。
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+GPU_KEYWORDS = ["GPU", "显卡", "图形处理器", "CUDA", "OpenCL", "显存", "渲染", "计算", "并行"]
+
+# 错误使记录无法用于训练，警告只提示数据质量问题
+ERROR_TYPES = ["encoding", "json", "schema", "empty_question", "empty_answer"]
+WARNING_TYPES = ["too_long", "no_keyword"]
+
+# token长度直方图的桶上界，最后一个桶收纳更长的样本
+LENGTH_BUCKETS = [128, 256, 512, 1024, 2048, 4096]
+
+def parse_record(data):
+    """
+    把一条JSON对象规范为 {"question", "answer"}
+
+    Returns:
+        (record, error)：成功时error为None；失败时record为None，error为 (错误类型, 说明)
+    """
+    if not isinstance(data, dict):
+        return None, ("schema", "记录不是JSON对象")
+    if "messages" in data:
+        question = answer = None
+        for message in data["messages"] if isinstance(data["messages"], list) else []:
+            if not isinstance(message, dict):
+                continue
+            if message.get("role") == "user":
+                question = message.get("content")
+            elif message.get("role") == "assistant":
+                answer = message.get("content")
+        if question is None or answer is None:
+            return None, ("schema", "messages中缺少user或assistant消息")
+    elif "question" in data and "answer" in data:
+        question, answer = data["question"], data["answer"]
+    else:
+        return None, ("schema", f"缺少question/answer字段，实际字段: {sorted(data)[:5]}")
+
+    if not isinstance(question, str) or not isinstance(answer, str):
+        return None, ("schema", "question/answer不是字符串")
+    if not question.strip():
+        return None, ("empty_question", "问题为空")
+    if not answer.strip():
+        return None, ("empty_answer", "回答为空")
+    return {"question": question, "answer": answer}, None
+
+def parse_line(line):
+    """
+    解析一行（bytes或str），忽略行首的UTF-8 BOM（文件开头）
+
+    Returns:
+        (data, record, error)：data为解析出的JSON对象（编码或JSON错误时为None），record和error含义同 parse_record
+    """
+    if isinstance(line, bytes):
+        try:
+            line = line.decode("utf-8")
+        except UnicodeDecodeError as e:
+            return None, None, ("encoding", f"不是有效的UTF-8: {e}")
+    try:
+        data = json.loads(line.lstrip("\ufeff"))
+    except json.JSONDecodeError as e:
+        return None, None, ("json", f"JSON解析错误: {e}")
+    return (data, *parse_record(data))
+
+def iter_records(path):
+    """
+    流式读取JSONL文件，逐条产出 (行号, record, error)，跳过空行
+
+    行号从1开始；解析失败的行 record 为None，由调用方决定跳过还是报告。
+    """
+    with open(path, "rb") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            _, record, error = parse_line(line)
+            yield line_number, record, error
+
+# 题集文本格式：“第N章 标题”、“N.问题：...”、“答案：...”，答案可以跨多行
+_CHAPTER = re.compile(r"^第.+章")
+_QUESTION = re.compile(r"^\s*\d+\s*[.．、]\s*问题\s*[：:]\s*(.*)$")
+_ANSWER = re.compile(r"^\s*答案\s*[：:]\s*(.*)$")
+
+def iter_question_bank(path):
+    """
+    流式读取题集文本（如 GPU-QA/基础题集），逐条产出 (问题所在行号, record, error)
+
+    没有答案的问题和问题之外的孤立答案报告为schema错误。
+    """
+    question = answer = None
+    question_line = 0
+
+    def finish():
+        if question is None:
+            return None
+        if answer is None:
+            return question_line, None, ("schema", "问题缺少答案")
+        record = {"question": question.strip(), "answer": answer.strip()}
+        return (question_line, *parse_record(record))
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.rstrip("\n")
+            match = _QUESTION.match(line)
+            if match or _CHAPTER.match(line):
+                entry = finish()
+                if entry is not None:
+                    yield entry
+                question = answer = None
+                if match:
+                    question, question_line = match.group(1), line_number
+                continue
+            match = _ANSWER.match(line)
+            if match:
+                if question is None:
+                    yield line_number, None, ("schema", "答案之前没有问题")
+                else:
+                    answer = match.group(1)
+            elif answer is not None and line.strip():
+                answer += "\n" + line.strip()
+            elif question is not None and line.strip():
+                question += line.strip()
+    entry = finish()
+    if entry is not None:
+        yield entry
+
+def iter_dataset_records(path):
+    """按文件类型流式读取问答记录：.jsonl 按JSONL解析，其他文件按题集文本格式解析"""
+    if path.endswith(".jsonl"):
+        return iter_records(path)
+    return iter_question_bank(path)
+
+def write_jsonl(records, path):
+    """
+    把问答记录写入JSONL文件，返回写入的条数
+
+    先写临时文件再改名，中断时不会留下写了一半的数据集。
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+def chunk_ranges(path, num_chunks):
+    """把文件切成约 num_chunks 个字节区间 [start, end)，每个区间从行首开始、在行尾结束"""
+    size = os.path.getsize(path)
+    num_chunks = max(1, min(num_chunks, size))
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, num_chunks):
+            target = size * i // num_chunks
+            if target <= boundaries[-1]:
+                continue
+            # 从目标位置前一个字节开始读到行尾，若目标位置恰好是行首则不移动
+            f.seek(target - 1)
+            f.readline()
+            position = f.tell()
+            if boundaries[-1] < position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+class ValidationReport:
+    """
+    校验统计，可由多个块的报告按文件顺序合并
+
+    Args:
+        max_length: 训练的最大序列长度（token），为None时不检查长度
+        keywords: 统计覆盖率的关键词
+        max_examples: 每种错误/警告保留的示例条数
+    """
+
+    def __init__(self, max_length=None, keywords=GPU_KEYWORDS, max_examples=20):
+        self.max_length = max_length
+        self.keywords = list(keywords)
+        self.max_examples = max_examples
+        self.lines = 0
+        self.records = 0
+        self.valid = 0
+        self.errors = {name: 0 for name in ERROR_TYPES}
+        self.warnings = {name: 0 for name in WARNING_TYPES}
+        self.examples = []
+        self.keyword_counts = {keyword: 0 for keyword in self.keywords}
+        self.with_keyword = 0
+        self.tokens = {"count": 0, "total": 0, "max": 0, "histogram": [0] * (len(LENGTH_BUCKETS) + 1)}
+
+    def _example(self, kind, line_number, message):
+        same_kind = sum(1 for example in self.examples if example["type"] == kind)
+        if same_kind < self.max_examples:
+            self.examples.append({"type": kind, "line": line_number, "message": message})
+
+    def add_error(self, line_number, error):
+        kind, message = error
+        self.errors[kind] += 1
+        self._example(kind, line_number, message)
+
+    def add_record(self, line_number, record, num_tokens=None):
+        """统计一条格式正确的记录"""
+        self.valid += 1
+        text = record["question"] + record["answer"]
+        found = [keyword for keyword in self.keywords if keyword in text]
+        for keyword in found:
+            self.keyword_counts[keyword] += 1
+        if found:
+            self.with_keyword += 1
+        else:
+            self.warnings["no_keyword"] += 1
+            self._example("no_keyword", line_number, f"未包含GPU相关关键词: {record['question'][:50]}")
+
+        if num_tokens is None:
+            return
+        tokens = self.tokens
+        tokens["count"] += 1
+        tokens["total"] += num_tokens
+        tokens["max"] = max(tokens["max"], num_tokens)
+        bucket = next((i for i, bound in enumerate(LENGTH_BUCKETS) if num_tokens <= bound), len(LENGTH_BUCKETS))
+        tokens["histogram"][bucket] += 1
+        if self.max_length is not None and num_tokens > self.max_length:
+            self.warnings["too_long"] += 1
+            self._example("too_long", line_number, f"{num_tokens} tokens，超过 {self.max_length}，训练时会被截断")
+
+    def merge(self, other, line_offset=0):
+        """合并紧接在本报告之后的一段（other中的行号加上 line_offset）"""
+        self.lines += other.lines
+        self.records += other.records
+        self.valid += other.valid
+        for name in ERROR_TYPES:
+            self.errors[name] += other.errors[name]
+        for name in WARNING_TYPES:
+            self.warnings[name] += other.warnings[name]
+        for example in other.examples:
+            self._example(example["type"], example["line"] + line_offset, example["message"])
+        for keyword in self.keywords:
+            self.keyword_counts[keyword] += other.keyword_counts[keyword]
+        self.with_keyword += other.with_keyword
+        self.tokens["count"] += other.tokens["count"]
+        self.tokens["total"] += other.tokens["total"]
+        self.tokens["max"] = max(self.tokens["max"], other.tokens["max"])
+        self.tokens["histogram"] = [a + b for a, b in zip(self.tokens["histogram"], other.tokens["histogram"])]
+        return self
+
+    @property
+    def num_errors(self):
+        return sum(self.errors.values())
+
+    def to_dict(self):
+        tokens = self.tokens
+        labels = [f"<={bound}" for bound in LENGTH_BUCKETS] + [f">{LENGTH_BUCKETS[-1]}"]
+        return {
+            "lines": self.lines,
+            "records": self.records,
+            "valid": self.valid,
+            "errors": dict(self.errors),
+            "warnings": dict(self.warnings),
+            "keyword_coverage": self.with_keyword / self.valid if self.valid else 0.0,
+            "keyword_counts": dict(self.keyword_counts),
+            "tokens": {
+                "max_length": self.max_length,
+                "max": tokens["max"],
+                "mean": tokens["total"] / tokens["count"] if tokens["count"] else 0.0,
+                "histogram": dict(zip(labels, tokens["histogram"])),
+            } if tokens["count"] else None,
+            "examples": sorted(self.examples, key=lambda example: example["line"]),
+        }
+
+    def format(self):
+        """可读的汇总文本"""
+        summary = self.to_dict()
+        lines = [
+            f"记录数: {summary['records']}，格式正确: {summary['valid']}，错误: {self.num_errors}",
+            "错误: " + "，".join(f"{name} {count}" for name, count in summary["errors"].items()),
+            "警告: " + "，".join(f"{name} {count}" for name, count in summary["warnings"].items()),
+            f"关键词覆盖率: {summary['keyword_coverage']:.2%}（" +
+            "，".join(f"{k} {v}" for k, v in summary["keyword_counts"].items()) + "）",
+        ]
+        if summary["tokens"] is not None:
+            tokens = summary["tokens"]
+            lines.append(f"token长度: 平均 {tokens['mean']:.1f}，最大 {tokens['max']}，分布 " +
+                         "，".join(f"{k}: {v}" for k, v in tokens["histogram"].items()))
+        for example in summary["examples"]:
+            lines.append(f"  第{example['line']}行 [{example['type']}] {example['message']}")
+        return "\n".join(lines)
+
+_worker_tokenizer = None
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _count_tokens(tokenizer, records):
+    """按训练时的对话格式渲染后计算token数"""
+    from gpu_llm_finetune import build_training_text
+
+    texts = [build_training_text(tokenizer, record["question"], record["answer"]) for record in records]
+    return [len(ids) for ids in tokenizer(texts)["input_ids"]]
+
+def validate_range(path, start, end, max_length=None, keywords=GPU_KEYWORDS, max_examples=20, tokenizer=None,
+                   batch_size=256):
+    """
+    校验文件中 [start, end) 字节区间内的行，行号从该区间的第一行起算
+
+    tokenizer 为None时使用工作进程初始化时传入的分词器（都没有则不统计token数）；
+    记录按 batch_size 条一批分词，内存占用只与批大小有关。
+    """
+    tokenizer = tokenizer if tokenizer is not None else _worker_tokenizer
+    report = ValidationReport(max_length, keywords, max_examples)
+    pending = []
+
+    def flush():
+        if not pending:
+            return
+        lengths = _count_tokens(tokenizer, [record for _, record in pending]) if tokenizer is not None else None
+        for i, (line_number, record) in enumerate(pending):
+            report.add_record(line_number, record, lengths[i] if lengths is not None else None)
+        pending.clear()
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            report.lines += 1
+            if not line.strip():
+                continue
+            report.records += 1
+            _, record, error = parse_line(line)
+            if error is not None:
+                report.add_error(report.lines, error)
+                continue
+            pending.append((report.lines, record))
+            if len(pending) >= batch_size:
+                flush()
+    flush()
+    return report
+
+def validate_file(path, tokenizer=None, max_length=1024, keywords=GPU_KEYWORDS, num_workers=None,
+                  chunk_size=64 << 20, max_examples=20):
+    """
+    并行校验一个JSONL文件
+
+    Args:
+        path: JSONL文件
+        tokenizer: 目标模型的分词器，为None时不检查token长度
+        max_length: 训练的最大序列长度
+        keywords: 统计覆盖率的关键词
+        num_workers: 进程数，默认CPU核数；为1时在当前进程中顺序处理
+        chunk_size: 每块的目标字节数，块数至少为进程数（文件足够大时）
+        max_examples: 每种错误/警告保留的示例条数
+
+    Returns:
+        ValidationReport，示例中的行号为文件中的行号
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    size = os.path.getsize(path)
+    num_chunks = max(math.ceil(size / chunk_size), num_workers if size >= num_workers * (1 << 20) else 1)
+    ranges = chunk_ranges(path, num_chunks)
+    options = {"max_length": max_length if tokenizer is not None else None, "keywords": keywords,
+               "max_examples": max_examples}
+
+    report = ValidationReport(options["max_length"], keywords, max_examples)
+    if num_workers == 1 or len(ranges) == 1:
+        for start, end in ranges:
+            report.merge(validate_range(path, start, end, tokenizer=tokenizer, **options), report.lines)
+        return report
+
+    # 使用spawn启动，与并行评估一致；分词器在每个工作进程初始化时传入一次
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(ranges)), mp_context=context,
+                             initializer=_init_worker, initargs=(tokenizer,)) as executor:
+        futures = [executor.submit(validate_range, path, start, end, **options) for start, end in ranges]
+        for future in futures:
+            report.merge(future.result(), report.lines)
+    return report
+
+def load_tokenizer(name):
+    """按模型类型（如 qwen3-1.7b）或分词器名称/路径加载分词器"""
+    from transformers import AutoTokenizer
+    from gpu_llm_finetune import SUPPORTED_MODELS, load_tokenizer as load_model_tokenizer
+
+    if name in SUPPORTED_MODELS:
+        return load_model_tokenizer(name)
+    return AutoTokenizer.from_pretrained(name, trust_remote_code=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="流式校验GPU-QA格式的JSONL语料")
+    parser.add_argument("files", nargs="+", help="要校验的JSONL文件")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="目标模型类型（如qwen3-1.7b）或分词器路径，指定后检查token长度")
+    parser.add_argument("--max_seq_length", type=int, default=1024,
+                        help="训练的最大序列长度，超过的样本计为警告")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="并行进程数，默认CPU核数")
+    parser.add_argument("--chunk_size_mb", type=int, default=64,
+                        help="每个并行块的大小（MB）")
+    parser.add_argument("--max_examples", type=int, default=20,
+                        help="每种错误/警告打印的示例条数")
+    parser.add_argument("--report", type=str, default=None,
+                        help="汇总报告的JSON输出路径")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    tokenizer = load_tokenizer(args.tokenizer) if args.tokenizer else None
+
+    reports = {}
+    total = ValidationReport(args.max_seq_length if tokenizer is not None else None, max_examples=0)
+    for path in args.files:
+        report = validate_file(path, tokenizer, args.max_seq_length, num_workers=args.workers,
+                               chunk_size=args.chunk_size_mb << 20, max_examples=args.max_examples)
+        print(f"\n📁 {path}\n{report.format()}")
+        reports[path] = report.to_dict()
+        total.merge(report)
+
+    print(f"\n📊 汇总\n{total.format()}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"files": reports, "total": total.to_dict()}, f, ensure_ascii=False, indent=2)
+        print(f"报告已保存到 {args.report}")
+    return 1 if total.num_errors else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
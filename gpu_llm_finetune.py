@@ -1,20 +1,15 @@
 import os
 import argparse
+import hashlib
 import json
-import torch
-from datasets import load_dataset, Dataset
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    TrainingArguments,
-    DataCollatorForSeq2Seq,
-)
-from trl import SFTTrainer
-from peft import get_peft_model, prepare_model_for_kbit_training, PeftModel, LoraConfig as LoRAConfig
-from evaluate import load
+import math
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
-from rouge import Rouge
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+# torch、transformers、datasets、peft等较重的依赖在用到它们的函数内导入，
+# 使 --help 和参数检查不必加载它们；导入本模块不会访问网络
+from gpu_metrics import BatchScorer, METRIC_NAMES
 
 # 设置日志
 import logging
@@ -23,6 +18,7 @@ logger = logging.getLogger(__name__)
 
 def is_bfloat16_supported():
     """检查是否支持bfloat16"""
+    import torch
     if not torch.cuda.is_available():
         return False
     try:
@@ -30,12 +26,15 @@ def is_bfloat16_supported():
         return torch.cuda.is_bf16_supported()
     except:
         return False
-try:
-    import nltk
-    nltk.data.path.append("/tmp/nltk_data")
-    nltk.download('punkt', quiet=True, download_dir="/tmp/nltk_data")
-except Exception as e:
-    logger.warning(f"下载nltk punkt失败: {e}，可能影响中文分词效果")
+
+# 训练、评估共用的系统提示词
+SYSTEM_PROMPT = "你是一个专业的GPU知识助手，能够准确回答关于GPU硬件、软件、应用等各方面的问题。"
+
+# 训练吞吐量指标的输出格式（见 gpu_training_metrics）
+METRICS_FORMATS = ["jsonl", "csv", "none"]
+
+# 评估方式：generate 生成回答后计算ROUGE/BLEU，loss 以教师强制计算参考答案的负对数似然和困惑度
+EVAL_MODES = ["generate", "loss"]
 
 # 支持的模型列表
 SUPPORTED_MODELS = {
@@ -51,7 +50,7 @@ SUPPORTED_MODELS = {
     }
 }
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="基于GPU-QA数据集微调GPU知识助手大模型")
     parser.add_argument("--model_type", type=str, default="qwen3-1.7b", 
                         choices=SUPPORTED_MODELS.keys(), help="选择要微调的模型类型")
@@ -83,10 +82,81 @@ def parse_args():
                         help="是否进行评估")
     parser.add_argument("--resume_from_checkpoint", type=str, default=None, 
                         help="从检查点恢复训练")
-    return parser.parse_args()
+    parser.add_argument("--packing", action="store_true", 
+                        help="将多条完整对话打包到同一序列中训练，对话之间互不可见")
+    parser.add_argument("--group_by_length_buckets", action="store_true", 
+                        help="按token长度分桶组成批次，减少批内填充")
+    parser.add_argument("--chunked_loss", action="store_true", 
+                        help="分块计算LM head与交叉熵，不保留完整词表的logits")
+    parser.add_argument("--loss_chunk_size", type=int, default=1024, 
+                        help="分块交叉熵每块的token数")
+    parser.add_argument("--training_metrics", type=str, default="jsonl", choices=METRICS_FORMATS, 
+                        help="每步吞吐量、时间分解、峰值显存和MFU写入output_dir/training_metrics.{jsonl,csv}")
+    parser.add_argument("--training_metrics_breakdown", action="store_true", 
+                        help="GPU上在每个阶段边界同步CUDA以记录数据加载/前向/反向/优化器的耗时（会拖慢训练）")
+    parser.add_argument("--metrics_port", type=int, default=None, 
+                        help="训练时在该端口提供Prometheus文本格式的 /metrics")
+    parser.add_argument("--metrics_host", type=str, default="127.0.0.1", 
+                        help="/metrics 的监听地址，供其他机器抓取时设为 0.0.0.0")
+    parser.add_argument("--peak_tflops", type=float, default=None, 
+                        help="计算MFU所用的设备峰值算力（TFLOPS），默认按GPU型号查表")
+    parser.add_argument("--sync_checkpoints", action="store_true", 
+                        help="按Trainer默认方式同步保存完整检查点，默认只保存适配器和训练状态并在后台线程写盘")
+    parser.add_argument("--keep_last_checkpoints", type=int, default=3, 
+                        help="保留最近的检查点数，验证损失最好的检查点另外保留")
+    parser.add_argument("--eval_mode", type=str, default="generate", choices=EVAL_MODES, 
+                        help="评估方式：generate生成回答并计算ROUGE/BLEU，loss只做一次前向计算参考答案的NLL和困惑度")
+    parser.add_argument("--eval_batch_size", type=int, default=8, 
+                        help="评估时批量生成的批次大小，1表示逐条生成")
+    parser.add_argument("--max_new_tokens", type=int, default=512, 
+                        help="评估时每个回答最多生成的token数")
+    parser.add_argument("--eval_workers", type=int, default=1, 
+                        help="并行评估的工作进程数，每个进程加载一份模型并评估一部分测试集")
+    parser.add_argument("--prefix_cache", action="store_true", 
+                        help="生成时复用系统提示词的KV缓存，只编码问题部分")
+    parser.add_argument("--draft_model_type", type=str, default="qwen3-0.6b",
+                        choices=SUPPORTED_MODELS.keys(), help="投机解码的草稿模型类型")
+    parser.add_argument("--draft_output_dir", type=str, default=None, 
+                        help="草稿模型的微调输出目录，指定后评估时使用投机解码")
+    parser.add_argument("--num_draft_tokens", type=int, default=4, 
+                        help="投机解码每轮的草稿token数")
+    parser.add_argument("--stream_eval", action="store_true", 
+                        help="流式评估：逐条写入evaluation_results.jsonl，中断后可续评")
+    parser.add_argument("--metric_level", type=str, default="char", choices=["char", "word"], 
+                        help="ROUGE/BLEU的计算粒度：char按字符，word按空格分词")
+    parser.add_argument("--cache_dir", type=str, default=None, 
+                        help="缓存目录，默认为output_dir/cache")
+    args = parser.parse_args(argv)
+    validate_args(parser, args)
+    return args
+
+def validate_args(parser, args):
+    """在加载模型和数据之前检查参数取值，出错时由argparse打印用法并退出"""
+    for name in ("per_device_train_batch_size", "gradient_accumulation_steps", "max_seq_length", "eval_steps",
+                 "save_steps", "loss_chunk_size", "eval_batch_size", "max_new_tokens", "eval_workers",
+                 "num_draft_tokens", "lora_rank", "keep_last_checkpoints"):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name} 必须为正整数")
+    if args.learning_rate <= 0:
+        parser.error("--learning_rate 必须大于0")
+    if args.metrics_port is not None and not 0 <= args.metrics_port <= 65535:
+        parser.error("--metrics_port 必须在0到65535之间")
+    if args.resume_from_checkpoint is not None and not os.path.isdir(args.resume_from_checkpoint):
+        parser.error(f"检查点目录不存在: {args.resume_from_checkpoint}")
+    if args.draft_output_dir is not None and not os.path.isdir(args.draft_output_dir):
+        parser.error(f"草稿模型目录不存在: {args.draft_output_dir}")
+    if args.eval_mode == "loss":
+        # 损失评估只做一次前向，不使用并行评估进程、流式写入和生成加速
+        generation_options = [name for name, enabled in (
+            ("eval_workers", args.eval_workers > 1), ("stream_eval", args.stream_eval),
+            ("draft_output_dir", args.draft_output_dir is not None), ("prefix_cache", args.prefix_cache)) if enabled]
+        if generation_options:
+            parser.error("--eval_mode loss 不支持 " + "、".join(f"--{name}" for name in generation_options))
 
 def load_gpu_qa_dataset(dataset_path, split="train"):
     """加载GPU-QA知识问答数据集"""
+    from datasets import load_dataset
+    
     try:
         # 尝试从Hugging Face Hub加载
         dataset = load_dataset(dataset_path, split=split)
@@ -111,47 +181,207 @@ def load_gpu_qa_dataset(dataset_path, split="train"):
     logger.info(f"加载{split}数据集成功，样本数: {len(dataset)}")
     return dataset
 
+def preprocessed_features():
+    """预处理结果的列类型：助手掩码以bool存储，每个token只占1字节"""
+    from datasets import Features, Sequence, Value
+    
+    return Features({
+        "input_ids": Sequence(Value("int32")),
+        "assistant_mask": Sequence(Value("bool")),
+        "length": Value("int32"),
+    })
+
+def _assistant_char_span(text, prompt, answer):
+    """
+    助手回答在完整对话文本中的字符区间 [start, end)
+    
+    起点为生成提示（到 "<|im_start|>assistant\n" 为止）之后，包含模板在回答前插入的内容
+    （如Qwen3的空思考块）；终点包含回答后的 <|im_end|>，使模型学会结束回答。
+    """
+    start = len(prompt) if text.startswith(prompt) else max(text.rfind(answer.strip()), 0)
+    core = answer.strip()
+    position = text.find(core, start) if core else -1
+    end = position + len(core) if position >= 0 else len(text)
+    
+    rest = text[end:]
+    stripped = rest.lstrip()
+    if stripped.startswith("<|im_end|>"):
+        end += len(rest) - len(stripped) + len("<|im_end|>")
+    return start, end
+
+def build_training_text(tokenizer, question, answer):
+    """渲染一条问答的完整训练对话（含系统提示词），预处理和数据校验时的token长度都以它为准"""
+    # 使用更标准的对话格式，适合Instruct模型
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": answer}
+    ]
+    
+    # 使用tokenizer的chat template
+    if hasattr(tokenizer, 'apply_chat_template') and tokenizer.chat_template is not None:
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    # 备用格式
+    return f"<|im_start|>system\n{SYSTEM_PROMPT}<|im_end|>\n<|im_start|>user\n{question}<|im_end|>\n<|im_start|>assistant\n{answer}<|im_end|>"
+
 def preprocess_gpu_qa(examples, tokenizer, max_length=1024):
-    """预处理GPU-QA数据集，转换为模型可接受的格式"""
+    """
+    预处理GPU-QA数据集，转换为模型可接受的格式
+    
+    除 input_ids 外同时生成 assistant_mask：只有助手回答部分的token为True，
+    系统提示词和用户问题不参与损失计算。掩码由对话模板渲染后各token的字符偏移确定。
+    """
     texts = []
+    spans = []
+    prompts = []
     
     # 处理简单的question-answer格式
     for question, answer in zip(examples["question"], examples["answer"]):
-        # 使用更标准的对话格式，适合Instruct模型
-        messages = [
-            {"role": "system", "content": "你是一个专业的GPU知识助手，能够准确回答关于GPU硬件、软件、应用等各方面的问题。"},
-            {"role": "user", "content": question},
-            {"role": "assistant", "content": answer}
-        ]
-        
-        # 使用tokenizer的chat template
-        if hasattr(tokenizer, 'apply_chat_template') and tokenizer.chat_template is not None:
-            text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
-        else:
-            # 备用格式
-            text = f"<|im_start|>system\n你是一个专业的GPU知识助手，能够准确回答关于GPU硬件、软件、应用等各方面的问题。<|im_end|>\n<|im_start|>user\n{question}<|im_end|>\n<|im_start|>assistant\n{answer}<|im_end|>"
-        
+        text = build_training_text(tokenizer, question, answer)
+        prompt = build_generation_prompt(tokenizer, question)
         texts.append(text)
+        prompts.append(prompt)
+        spans.append(_assistant_char_span(text, prompt, answer))
     
-    # 直接tokenize并返回
-    model_inputs = tokenizer(
+    # 快速分词器直接返回每个token的字符偏移
+    use_offsets = getattr(tokenizer, "is_fast", False)
+    encoded = tokenizer(
         texts, 
         max_length=max_length, 
         truncation=True, 
         padding=False,
-        return_tensors=None
+        return_tensors=None,
+        return_offsets_mapping=use_offsets
     )
     
-    # 设置labels为input_ids的副本（用于语言建模）
-    model_inputs["labels"] = model_inputs["input_ids"].copy()
+    assistant_masks = []
+    for i, input_ids in enumerate(encoded["input_ids"]):
+        if use_offsets:
+            start, end = spans[i]
+            mask = [start <= token_start < end and token_end > token_start
+                    for token_start, token_end in encoded["offset_mapping"][i]]
+        else:
+            # 慢速分词器没有偏移信息，以生成提示的token数作为边界
+            prompt_length = len(tokenizer(prompts[i])["input_ids"])
+            mask = [position >= prompt_length for position in range(len(input_ids))]
+        assistant_masks.append(mask)
     
-    return model_inputs
+    return {
+        "input_ids": encoded["input_ids"],
+        "assistant_mask": assistant_masks,
+        # 记录token长度，供按长度分桶采样使用
+        "length": [len(ids) for ids in encoded["input_ids"]],
+    }
 
-def create_model_and_tokenizer(model_type, load_in_4bit=False):
-    """创建模型和分词器"""
-    model_config = SUPPORTED_MODELS[model_type]
+def check_assistant_mask(tokenizer, example, answer):
+    """
+    检查助手掩码的边界：系统提示词和问题不在掩码内，回答在掩码内
+    （回答可能被截断，因此只要求回答开头出现在掩码部分）
+    """
+    input_ids, mask = example["input_ids"], example["assistant_mask"]
+    masked_text = tokenizer.decode([t for t, keep in zip(input_ids, mask) if keep], skip_special_tokens=True)
+    unmasked_text = tokenizer.decode([t for t, keep in zip(input_ids, mask) if not keep], skip_special_tokens=True)
     
-    # 加载分词器
+    ok = SYSTEM_PROMPT in unmasked_text and answer.strip()[:16] in masked_text
+    if not ok:
+        logger.warning(f"助手掩码边界可能不正确，掩码部分解码为: {masked_text[:100]!r}")
+    return ok
+
+def get_cache_dir(args):
+    """缓存目录，未指定 --cache_dir 时使用 output_dir/cache"""
+    return args.cache_dir or os.path.join(args.output_dir, "cache")
+
+# 预处理逻辑的版本号，修改 preprocess_gpu_qa 的输出时需要递增以使旧缓存失效
+PREPROCESS_VERSION = 3
+
+def _hash_file(path):
+    """计算文件内容的sha256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _tokenizer_fingerprint(tokenizer):
+    """
+    分词器指纹
+    
+    快速分词器按词表与规则的完整内容计算，因此共享同一分词器的模型（如两个Qwen3模型）
+    会得到相同的指纹；其他分词器退化为名称加版本号。
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return hashlib.sha256(backend.to_str().encode("utf-8")).hexdigest()
+    revision = tokenizer.init_kwargs.get("_commit_hash") or tokenizer.init_kwargs.get("revision")
+    return f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{revision}"
+
+def preprocessing_cache_key(source_fingerprint, tokenizer, max_length):
+    """预处理结果的缓存键：数据内容、分词器、对话模板、系统提示词和最大长度共同决定"""
+    chat_template = getattr(tokenizer, "chat_template", None)
+    payload = json.dumps({
+        "version": PREPROCESS_VERSION,
+        "source": source_fingerprint,
+        "tokenizer": _tokenizer_fingerprint(tokenizer),
+        "special_tokens": tokenizer.special_tokens_map,
+        "chat_template": chat_template,
+        "system_prompt": SYSTEM_PROMPT,
+        "max_length": max_length,
+    }, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def load_preprocessed_dataset(dataset_path, split, tokenizer, args):
+    """
+    加载预处理后的数据集
+    
+    预处理结果以Arrow格式保存在 cache_dir/preprocessed 下，命中缓存时直接内存映射加载，
+    跳过对话模板渲染和分词。
+    """
+    from datasets import load_from_disk
+    
+    data_file = os.path.join(dataset_path, f"{split}.jsonl")
+    raw_dataset = None
+    if os.path.isfile(data_file):
+        source_fingerprint = _hash_file(data_file)
+    else:
+        raw_dataset = load_gpu_qa_dataset(dataset_path, split=split)
+        source_fingerprint = raw_dataset._fingerprint
+    
+    key = preprocessing_cache_key(source_fingerprint, tokenizer, args.max_seq_length)
+    cache_path = os.path.join(get_cache_dir(args), "preprocessed", f"{split}-{key[:16]}")
+    if os.path.isdir(cache_path):
+        dataset = load_from_disk(cache_path)
+        logger.info(f"从缓存加载预处理后的{split}数据集: {cache_path}，样本数: {len(dataset)}")
+        return dataset
+    
+    if raw_dataset is None:
+        raw_dataset = load_gpu_qa_dataset(dataset_path, split=split)
+    
+    dataset = raw_dataset.map(
+        preprocess_gpu_qa,
+        batched=True,
+        fn_kwargs={"tokenizer": tokenizer, "max_length": args.max_seq_length},
+        remove_columns=raw_dataset.column_names,
+        features=preprocessed_features()
+    )
+    check_assistant_mask(tokenizer, dataset[0], raw_dataset[0]["answer"])
+    
+    # 先写临时目录再改名，避免中断或并发运行留下不完整的缓存
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    dataset.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # 其他进程已写入相同的缓存
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    logger.info(f"预处理后的{split}数据集已缓存到 {cache_path}")
+    
+    return load_from_disk(cache_path)
+
+def load_tokenizer(model_type):
+    """加载模型类型对应的分词器，没有pad_token时使用eos_token"""
+    from transformers import AutoTokenizer
+    
+    model_config = SUPPORTED_MODELS[model_type]
     tokenizer = AutoTokenizer.from_pretrained(
         model_config["name"],
         **model_config["tokenizer_kwargs"]
@@ -160,13 +390,31 @@ def create_model_and_tokenizer(model_type, load_in_4bit=False):
     # 确保分词器有pad_token
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def create_model_and_tokenizer(model_type, load_in_4bit=False, device_map=None):
+    """
+    创建模型和分词器
+    
+    device_map 为None时，单进程自动分配设备，数据并行时每个进程在自己的设备上加载完整模型。
+    """
+    import torch
+    from peft import prepare_model_for_kbit_training
+    from transformers import AutoModelForCausalLM
+    from gpu_distributed import distributed_device_map
+    
+    model_config = SUPPORTED_MODELS[model_type]
+    
+    # 加载分词器
+    tokenizer = load_tokenizer(model_type)
     
     # 加载模型
     model = AutoModelForCausalLM.from_pretrained(
         model_config["name"],
-        torch_dtype=torch.bfloat16 if is_bfloat16_supported() else torch.float16,
+        # CPU上的半精度计算很慢，使用float32
+        torch_dtype=torch.bfloat16 if is_bfloat16_supported() else (torch.float16 if torch.cuda.is_available() else torch.float32),
         load_in_4bit=load_in_4bit,
-        device_map="auto",
+        device_map=device_map if device_map is not None else distributed_device_map(),
         **model_config["model_kwargs"]
     )
     
@@ -179,6 +427,8 @@ def create_model_and_tokenizer(model_type, load_in_4bit=False):
 
 def setup_lora_config(rank=16):
     """设置LoRA配置"""
+    from peft import LoraConfig as LoRAConfig
+    
     return LoRAConfig(
         r=rank,
         lora_alpha=32,  # 增加alpha值，通常是rank的2倍
@@ -188,8 +438,32 @@ def setup_lora_config(rank=16):
         target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
     )
 
+def create_training_metrics(model, tokenizer, args):
+    """按 --training_metrics/--metrics_port 创建吞吐量监控回调，都未开启时返回None"""
+    if args.training_metrics == "none" and args.metrics_port is None:
+        return None
+    from gpu_training_metrics import TrainingMetricsCallback
+    
+    return TrainingMetricsCallback(
+        model,
+        args.output_dir,
+        tokenizer.pad_token_id,
+        metrics_format=args.training_metrics,
+        prometheus_port=args.metrics_port,
+        prometheus_host=args.metrics_host,
+        peak_tflops=args.peak_tflops,
+        run_name=getattr(args, "model_type", None),
+        detailed_timing=args.training_metrics_breakdown,
+    )
+
 def train_model(model, tokenizer, train_dataset, eval_dataset, args):
     """训练模型"""
+    import torch
+    from peft import get_peft_model
+    from trl import SFTConfig
+    from gpu_batching import AssistantMaskCollator, PackedSequenceCollator, pack_dataset, packing_efficiency
+    from gpu_trainer import GPUQATrainer
+    
     # 设置LoRA配置
     lora_config = setup_lora_config(args.lora_rank)
     
@@ -200,18 +474,19 @@ def train_model(model, tokenizer, train_dataset, eval_dataset, args):
     model.print_trainable_parameters()
     
     # 设置训练参数
-    training_args = TrainingArguments(
+    training_args = SFTConfig(
         per_device_train_batch_size=args.per_device_train_batch_size,
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         warmup_steps=100,  # 增加warmup步数
         max_steps=args.max_steps,
         learning_rate=args.learning_rate,
-        fp16=not is_bfloat16_supported(),
+        fp16=torch.cuda.is_available() and not is_bfloat16_supported(),
         bf16=is_bfloat16_supported(),
         logging_steps=10,
         eval_steps=args.eval_steps if eval_dataset is not None else None,
         save_steps=args.save_steps,
-        optim="paged_adamw_8bit",
+        optim="paged_adamw_8bit" if torch.cuda.is_available() else "adamw_torch",
+        use_cpu=not torch.cuda.is_available(),  # 无GPU时在CPU上训练，多进程时使用gloo后端
         weight_decay=0.01,
         lr_scheduler_type="cosine",
         seed=42,
@@ -223,126 +498,273 @@ def train_model(model, tokenizer, train_dataset, eval_dataset, args):
         dataloader_drop_last=True,  # 确保批次大小一致
         remove_unused_columns=False,  # 保留所有列
         gradient_checkpointing=True,  # 启用梯度检查点节省内存
+        # 非重入式梯度检查点可与DDP及冻结的基础模型参数配合使用
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        ddp_find_unused_parameters=False,
+        max_length=args.max_seq_length,
+        dataset_text_field="text",
+        packing=False,  # 不使用TRL内置的packing，打包由 --packing 按对话边界完成
     )
     
+    # 只有助手回答参与损失计算，标签由预处理阶段的 assistant_mask 生成
+    data_collator = AssistantMaskCollator(tokenizer.pad_token_id)
+    
+    # 序列打包：多条完整对话拼接成一条序列，通过position_ids隔离注意力
+    if args.packing:
+        num_examples = len(train_dataset)
+        train_dataset = pack_dataset(train_dataset, args.max_seq_length)
+        logger.info(f"序列打包: {num_examples} 条样本 -> {len(train_dataset)} 条序列，"
+                    f"填充率 {packing_efficiency(train_dataset, args.max_seq_length):.2%}")
+        if eval_dataset is not None:
+            eval_dataset = pack_dataset(eval_dataset, args.max_seq_length)
+        data_collator = PackedSequenceCollator(tokenizer.pad_token_id)
+        # 模型仅在不使用KV缓存时根据position_ids构造分段注意力掩码
+        model.config.use_cache = False
+    
     # 创建训练器
-    trainer = SFTTrainer(
+    trainer = GPUQATrainer(
         model=model,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         args=training_args,
-        max_source_length=args.max_seq_length,
-        dataset_text_field="text" if "text" in train_dataset.column_names else None,
-        packing=False,  # 不使用packing，保持对话完整性
+        data_collator=data_collator,
+        processing_class=tokenizer,
+        group_by_length_buckets=args.group_by_length_buckets,
+        chunked_loss=args.chunked_loss,
+        loss_chunk_size=args.loss_chunk_size,
+        training_metrics=create_training_metrics(model, tokenizer, args),
+        async_checkpoints=not args.sync_checkpoints,
+        keep_last_checkpoints=args.keep_last_checkpoints,
     )
     
     # 开始训练
     logger.info("开始训练模型...")
     trainer.train(resume_from_checkpoint=args.resume_from_checkpoint)
     
-    # 保存模型
+    # 保存模型（多进程时Trainer只在0号进程写入）
     logger.info(f"训练完成，保存模型到 {args.output_dir}")
     trainer.save_model(args.output_dir)
     
     return model
 
+def build_generation_prompt(tokenizer, question):
+    """构建用于生成回答的对话提示，与训练时的对话格式保持一致"""
+    return build_chat_prompt(tokenizer, [{"role": "user", "content": question}])
+
+def build_chat_prompt(tokenizer, messages):
+    """
+    构建多轮对话的生成提示
+    
+    没有系统消息时补上训练使用的系统提示词；分词器没有对话模板时使用与训练相同的
+    <|im_start|>格式。
+    """
+    if not messages or messages[0]["role"] != "system":
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + list(messages)
+    
+    if hasattr(tokenizer, 'apply_chat_template') and tokenizer.chat_template is not None:
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    turns = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return turns + "<|im_start|>assistant\n"
+
+def iter_generated_answers(model, tokenizer, questions, batch_size=8, max_new_tokens=512, prefix_cache=None,
+                           speculative=None):
+    """
+    批量生成回答，每完成一个批次即逐条产出 (原始下标, 回答)
+    
+    按提示的token长度排序后左填充组成批次，减少填充浪费；
+    使用贪心解码，与逐条生成的输出一致。
+    传入 prefix_cache（见 gpu_prefix_cache）时复用系统提示词的KV缓存，只编码问题部分。
+    传入 speculative（见 gpu_speculative）时逐条进行投机解码，输出与贪心解码相同。
+    """
+    import torch
+    from gpu_speculative import eos_token_ids
+    
+    prompts = [build_generation_prompt(tokenizer, question) for question in questions]
+    prompt_ids = tokenizer(prompts)["input_ids"]
+    if speculative is not None:
+        eos_ids = eos_token_ids(model, tokenizer)
+        for i, ids in enumerate(prompt_ids):
+            generated_ids = speculative.generate(ids, max_new_tokens, eos_ids)
+            if (i + 1) % batch_size == 0 or i + 1 == len(prompt_ids):
+                logger.info(f"已生成 {i + 1}/{len(prompt_ids)} 个回答")
+            yield i, tokenizer.decode(generated_ids, skip_special_tokens=True).strip()
+        return
+    prompt_lengths = [len(ids) for ids in prompt_ids]
+    order = sorted(range(len(prompts)), key=lambda i: prompt_lengths[i])
+    
+    # 生成时需要左填充，保证所有序列从同一位置开始续写
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            inputs = None
+            if prefix_cache is not None:
+                inputs = prefix_cache.prepare_inputs([prompt_ids[i] for i in batch_indices], tokenizer.pad_token_id)
+            if inputs is None:
+                inputs = tokenizer(
+                    [prompts[i] for i in batch_indices],
+                    return_tensors="pt",
+                    padding=True
+                ).to(model.device)
+            
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    num_return_sequences=1,
+                    pad_token_id=tokenizer.pad_token_id
+                )
+            
+            logger.info(f"已生成 {min(start + batch_size, len(order))}/{len(order)} 个回答")
+            
+            # 只解码新生成的部分
+            generated_ids = outputs[:, inputs["input_ids"].shape[1]:]
+            for i, ids in zip(batch_indices, generated_ids):
+                yield i, tokenizer.decode(ids, skip_special_tokens=True).strip()
+    finally:
+        tokenizer.padding_side = padding_side
+
+def eval_prefix_cache(model, tokenizer, args):
+    """启用 --prefix_cache 时返回模型的系统提示词前缀缓存"""
+    if not args.prefix_cache:
+        return None
+    from gpu_prefix_cache import get_prefix_cache
+    
+    return get_prefix_cache(model, tokenizer, build_generation_prompt)
+
+def load_draft_model(args, device_map=None):
+    """加载投机解码的草稿模型（--draft_model_type 基础模型加上 --draft_output_dir 中的适配器或合并模型）"""
+    draft_args = argparse.Namespace(**{
+        **vars(args),
+        "model_type": args.draft_model_type,
+        "output_dir": args.draft_output_dir,
+        "resume_from_checkpoint": None,
+        "do_train": False,
+    })
+    return load_model_for_eval(draft_args, device_map=device_map)
+
+def eval_speculative_decoder(model, args):
+    """指定 --draft_output_dir 时加载草稿模型（与目标模型放在同一设备上），返回投机解码器"""
+    if not args.draft_output_dir:
+        return None
+    from gpu_speculative import SpeculativeDecoder
+    
+    logger.info(f"使用投机解码: 草稿模型 {args.draft_model_type} ({args.draft_output_dir})")
+    draft_model, _ = load_draft_model(args, device_map={"": model.device})
+    return SpeculativeDecoder(model, draft_model, args.num_draft_tokens)
+
+def log_speculative_metrics(speculative, output_dir=None):
+    """输出投机解码的草稿接受率和生成速度，指定 output_dir 时写入 speculative_metrics.json"""
+    metrics = speculative.metrics()
+    logger.info(f"投机解码: 草稿接受率 {metrics['acceptance_rate']:.2%}，"
+                f"每次目标模型前向 {metrics['tokens_per_target_forward']:.2f} 个token，"
+                f"{metrics['tokens_per_second']:.1f} tokens/s")
+    if output_dir is not None:
+        with open(os.path.join(output_dir, "speculative_metrics.json"), "w", encoding="utf-8") as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=2)
+
+def generate_answers(model, tokenizer, questions, batch_size=8, max_new_tokens=512, prefix_cache=None,
+                     speculative=None):
+    """批量生成回答，结果按输入顺序返回"""
+    answers = [None] * len(questions)
+    for i, answer in iter_generated_answers(model, tokenizer, questions, batch_size, max_new_tokens, prefix_cache,
+                                            speculative):
+        answers[i] = answer
+    return answers
+
+def create_scorer(eval_dataset, args):
+    """为评估集的参考答案创建批量打分器，参考答案n-gram表缓存在缓存目录中"""
+    return BatchScorer(eval_dataset["answer"], level=args.metric_level, cache_dir=get_cache_dir(args))
+
+class RunningMetrics:
+    """以常数内存累计各项指标的平均值"""
+    
+    def __init__(self, names=METRIC_NAMES):
+        self.names = list(names)
+        self.count = 0
+        self.totals = {name: 0.0 for name in self.names}
+    
+    def update(self, record):
+        self.count += 1
+        for name in self.names:
+            self.totals[name] += float(record.get(name, 0))
+    
+    def averages(self):
+        if self.count == 0:
+            return {name: 0.0 for name in self.names}
+        return {name: self.totals[name] / self.count for name in self.names}
+
+def log_evaluation_summary(averages):
+    """打印评估结果"""
+    logger.info(f"评估结果:")
+    logger.info(f"  ROUGE-1: {averages['rouge-1']:.4f}")
+    logger.info(f"  ROUGE-2: {averages['rouge-2']:.4f}")
+    logger.info(f"  ROUGE-L: {averages['rouge-l']:.4f}")
+    logger.info(f"  BLEU: {averages['bleu']:.4f}")
+
 def evaluate_model(model, tokenizer, eval_dataset, args):
-    """评估模型性能"""
+    """
+    评估模型性能
+    
+    数据并行运行时每个进程只为自己的一份问题生成回答，由0号进程收集全部回答后
+    统一打分并写入结果；其他进程返回None。
+    """
+    from gpu_distributed import gather_objects, is_main_process, shard_indices
+    
     logger.info("开始评估模型...")
     
+    # 批量生成本进程负责的回答
+    questions = eval_dataset["question"]
+    indices = shard_indices(len(questions))
+    speculative = eval_speculative_decoder(model, args)
+    local_answers = generate_answers(
+        model,
+        tokenizer,
+        [questions[i] for i in indices],
+        batch_size=args.eval_batch_size,
+        max_new_tokens=args.max_new_tokens,
+        prefix_cache=eval_prefix_cache(model, tokenizer, args),
+        speculative=speculative
+    )
+    if speculative is not None:
+        log_speculative_metrics(speculative, args.output_dir if is_main_process() else None)
+    
+    # 按原始顺序合并所有进程的回答
+    generated_answers = [None] * len(questions)
+    for shard, answers in gather_objects((indices, local_answers)):
+        for i, answer in zip(shard, answers):
+            generated_answers[i] = answer
+    
+    if not is_main_process():
+        return None
+    
+    return save_evaluation_results(eval_dataset, generated_answers, args)
+
+def save_evaluation_results(eval_dataset, generated_answers, args):
+    """对按测试集顺序排列的全部回答统一打分，写入 evaluation_results.json 并返回平均分"""
     # 加载评估指标
-    rouge = Rouge()
-    bleu_smoothing = SmoothingFunction().method4
+    scorer = create_scorer(eval_dataset, args)
     
     # 准备评估结果列表
     results = []
     
-    # 为每个样本生成回答并评估
-    for example in eval_dataset:
-        # 从简单格式中提取问题和答案
-        question = example["question"]
-        reference_answer = example["answer"]
-        
-        # 构建输入提示
-        messages = [
-            {"role": "system", "content": "你是一个专业的GPU知识助手，能够准确回答关于GPU硬件、软件、应用等各方面的问题。"},
-            {"role": "user", "content": question}
-        ]
-        
-        if hasattr(tokenizer, 'apply_chat_template') and tokenizer.chat_template is not None:
-            prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        else:
-            prompt = f"<|im_start|>system\n你是一个专业的GPU知识助手，能够准确回答关于GPU硬件、软件、应用等各方面的问题。<|im_end|>\n<|im_start|>user\n{question}<|im_end|>\n<|im_start|>assistant\n"
-        
-        # 编码输入
-        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-        
-        # 生成回答
-        with torch.no_grad():
-            outputs = model.generate(
-                inputs.input_ids,
-                max_length=args.max_seq_length,
-                temperature=0.1,
-                top_p=0.9,
-                top_k=40,
-                num_return_sequences=1
-            )
-        
-        # 解码生成的回答
-        generated_answer = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        # 移除提示部分
-        generated_answer = generated_answer.replace(prompt, "").strip()
-        
-        # 计算评估指标
-        try:
-            # ROUGE分数
-            rouge_scores = rouge.get_scores(generated_answer, reference_answer)[0]
-            
-            # BLEU分数 (处理中文需要分词)
-            # 简单的中文字符分词
-            gen_tokens = [char for char in generated_answer]
-            ref_tokens = [char for char in reference_answer]
-            
-            bleu_score = sentence_bleu(
-                [ref_tokens], 
-                gen_tokens,
-                smoothing_function=bleu_smoothing
-            )
-            
-            # 保存结果
-            results.append({
-                "question": question,
-                "reference_answer": reference_answer,
-                "generated_answer": generated_answer,
-                "rouge-1": rouge_scores["rouge-1"]["f"],
-                "rouge-2": rouge_scores["rouge-2"]["f"],
-                "rouge-l": rouge_scores["rouge-l"]["f"],
-                "bleu": bleu_score
-            })
-        except Exception as e:
-            logger.error(f"评估样本时出错: {e}")
-            results.append({
-                "question": question,
-                "reference_answer": reference_answer,
-                "generated_answer": generated_answer,
-                "rouge-1": 0,
-                "rouge-2": 0,
-                "rouge-l": 0,
-                "bleu": 0
-            })
+    # 一次性计算所有样本的评估指标
+    scores = scorer.score(generated_answers)
     
-    # 计算平均分数
-    avg_rouge_1 = np.mean([r["rouge-1"] for r in results])
-    avg_rouge_2 = np.mean([r["rouge-2"] for r in results])
-    avg_rouge_l = np.mean([r["rouge-l"] for r in results])
-    avg_bleu = np.mean([r["bleu"] for r in results])
+    for i, (example, generated_answer) in enumerate(zip(eval_dataset, generated_answers)):
+        # 保存结果
+        results.append({
+            "question": example["question"],
+            "reference_answer": example["answer"],
+            "generated_answer": generated_answer,
+            **{name: float(scores[name][i]) for name in METRIC_NAMES}
+        })
     
-    # 打印评估结果
-    logger.info(f"评估结果:")
-    logger.info(f"  ROUGE-1: {avg_rouge_1:.4f}")
-    logger.info(f"  ROUGE-2: {avg_rouge_2:.4f}")
-    logger.info(f"  ROUGE-L: {avg_rouge_l:.4f}")
-    logger.info(f"  BLEU: {avg_bleu:.4f}")
+    # 计算平均分数
+    averages = {name: float(np.mean([r[name] for r in results])) for name in METRIC_NAMES}
+    log_evaluation_summary(averages)
     
     # 保存详细结果
     results_file = os.path.join(args.output_dir, "evaluation_results.json")
@@ -351,62 +773,360 @@ def evaluate_model(model, tokenizer, eval_dataset, args):
     
     logger.info(f"详细评估结果已保存到 {results_file}")
     
-    return {
-        "rouge-1": avg_rouge_1,
-        "rouge-2": avg_rouge_2,
-        "rouge-l": avg_rouge_l,
-        "bleu": avg_bleu
-    }
+    return averages
+
+def compute_example_nll(model, tokenizer, questions, answers, batch_size=8, max_length=1024):
+    """
+    教师强制下每个问答在助手回答token上的负对数似然之和与token数，按输入顺序返回
+    
+    复用训练的预处理（preprocess_gpu_qa）和标签构造，损失范围与训练完全相同；
+    样本按长度排序后右填充组批，只做一次前向，不逐token生成。
+    """
+    import torch
+    from gpu_batching import AssistantMaskCollator
+    from gpu_chunked_loss import sequence_nll
+    
+    features = preprocess_gpu_qa({"question": list(questions), "answer": list(answers)}, tokenizer, max_length)
+    examples = [{"input_ids": ids, "assistant_mask": mask}
+                for ids, mask in zip(features["input_ids"], features["assistant_mask"])]
+    order = sorted(range(len(examples)), key=lambda i: features["length"][i], reverse=True)
+    collator = AssistantMaskCollator(tokenizer.pad_token_id)
+    
+    nll_sums = [0.0] * len(examples)
+    token_counts = [0] * len(examples)
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch_indices = order[start:start + batch_size]
+                batch = collator([examples[i] for i in batch_indices])
+                sums, counts = sequence_nll(model, {key: value.to(model.device) for key, value in batch.items()})
+                for i, nll_sum, count in zip(batch_indices, sums.tolist(), counts.tolist()):
+                    nll_sums[i] = nll_sum
+                    token_counts[i] = count
+                logger.info(f"已计算 {min(start + batch_size, len(order))}/{len(order)} 个样本的损失")
+    finally:
+        model.train(was_training)
+    return nll_sums, token_counts
+
+def _perplexity(nll):
+    try:
+        return math.exp(nll)
+    except OverflowError:
+        return float("inf")
+
+def save_loss_results(eval_dataset, nll_sums, token_counts, args):
+    """
+    写入逐条的NLL/困惑度（evaluation_results.json）和汇总（evaluation_summary.json），返回汇总指标
+    
+    汇总的 nll 按token加权（全部回答token的平均负对数似然），perplexity = exp(nll)；
+    回答被 --max_seq_length 完全截断的样本没有token，其指标为null，不计入汇总。
+    """
+    results = []
+    for example, nll_sum, count in zip(eval_dataset, nll_sums, token_counts):
+        nll = nll_sum / count if count else None
+        results.append({
+            "question": example["question"],
+            "reference_answer": example["answer"],
+            "num_tokens": count,
+            "nll": nll,
+            "perplexity": _perplexity(nll) if count else None,
+        })
+    
+    total_tokens = sum(token_counts)
+    nll = sum(nll_sums) / total_tokens if total_tokens else float("nan")
+    averages = {"nll": nll, "perplexity": _perplexity(nll)}
+    logger.info(f"评估结果（教师强制，{total_tokens} 个回答token）:")
+    logger.info(f"  NLL: {averages['nll']:.4f}")
+    logger.info(f"  困惑度: {averages['perplexity']:.4f}")
+    
+    results_file = os.path.join(args.output_dir, "evaluation_results.json")
+    with open(results_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    summary_file = os.path.join(args.output_dir, "evaluation_summary.json")
+    with open(summary_file, "w", encoding="utf-8") as f:
+        json.dump({"num_examples": len(results), "num_tokens": total_tokens, **averages}, f, ensure_ascii=False, indent=2)
+    logger.info(f"逐条评估结果已保存到 {results_file}，汇总结果已保存到 {summary_file}")
+    
+    return averages
+
+def evaluate_loss(model, tokenizer, eval_dataset, args):
+    """
+    以教师强制的损失评估模型（--eval_mode loss）
+    
+    与 evaluate_model 相同，数据并行运行时每个进程计算自己的一份样本，由0号进程合并后写入结果；
+    其他进程返回None。
+    """
+    from gpu_distributed import gather_objects, is_main_process, shard_indices
+    
+    logger.info("开始评估模型（教师强制损失）...")
+    
+    indices = shard_indices(len(eval_dataset))
+    local = compute_example_nll(
+        model,
+        tokenizer,
+        [eval_dataset[i]["question"] for i in indices],
+        [eval_dataset[i]["answer"] for i in indices],
+        batch_size=args.eval_batch_size,
+        max_length=args.max_seq_length
+    )
+    
+    nll_sums = [0.0] * len(eval_dataset)
+    token_counts = [0] * len(eval_dataset)
+    for shard, (sums, counts) in gather_objects((indices, local)):
+        for i, nll_sum, count in zip(shard, sums, counts):
+            nll_sums[i] = nll_sum
+            token_counts[i] = count
+    
+    if not is_main_process():
+        return None
+    
+    return save_loss_results(eval_dataset, nll_sums, token_counts, args)
+
+def get_adapter_path(args):
+    """评估时加载的LoRA适配器目录：训练后为输出目录，仅评估时可指定检查点"""
+    if getattr(args, "do_train", False) or args.resume_from_checkpoint is None:
+        return args.output_dir
+    return args.resume_from_checkpoint
+
+def load_model_for_eval(args, device_map=None):
+    """
+    加载微调后的模型
+    
+    适配器目录本身或其 merged 子目录是 gpu_export 导出的合并模型时直接加载，
+    否则加载基础模型并套上LoRA适配器。
+    """
+    from peft import PeftModel
+    from gpu_distributed import distributed_device_map
+    from gpu_export import find_merged_model, load_merged_model
+    
+    merged_dir = find_merged_model(get_adapter_path(args))
+    if merged_dir is not None:
+        return load_merged_model(merged_dir, device_map if device_map is not None else distributed_device_map())
+    
+    model, tokenizer = create_model_and_tokenizer(args.model_type, args.load_in_4bit, device_map=device_map)
+    model = PeftModel.from_pretrained(model, get_adapter_path(args))
+    model.eval()
+    return model, tokenizer
+
+def _evaluate_shard(load_model, args, worker_index, num_workers, questions):
+    """评估工作进程：加载一次模型，为交错划分到本进程的问题生成回答"""
+    import torch
+    from gpu_distributed import shard_indices
+    
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    if torch.cuda.is_available():
+        device_map = {"": worker_index % torch.cuda.device_count()}
+    else:
+        device_map = "cpu"
+    model, tokenizer = load_model(args, device_map=device_map)
+    
+    indices = shard_indices(len(questions), worker_index, num_workers)
+    speculative = eval_speculative_decoder(model, args)
+    answers = generate_answers(
+        model,
+        tokenizer,
+        [questions[i] for i in indices],
+        batch_size=args.eval_batch_size,
+        max_new_tokens=args.max_new_tokens,
+        prefix_cache=eval_prefix_cache(model, tokenizer, args),
+        speculative=speculative
+    )
+    if speculative is not None:
+        log_speculative_metrics(speculative)
+    return indices, answers
+
+def evaluate_model_parallel(eval_dataset, args, num_workers, load_model=load_model_for_eval):
+    """
+    多进程并行评估
+    
+    测试集按下标交错划分为 num_workers 份，每个工作进程加载一次基础模型和适配器并生成
+    自己那份回答；主进程按原始顺序合并后统一打分，结果文件与 evaluate_model 相同。
+    无GPU时各工作进程平分CPU线程；有GPU时工作进程轮流分配到各块GPU。
+    
+    Args:
+        eval_dataset: 含 question、answer 列的测试集
+        args: 命令行参数
+        num_workers: 工作进程数
+        load_model: 加载模型的函数 (args, device_map) -> (model, tokenizer)，需可pickle
+    """
+    logger.info(f"开始并行评估模型，工作进程数: {num_workers}")
+    
+    questions = list(eval_dataset["question"])
+    generated_answers = [None] * len(questions)
+    # 使用spawn启动，避免fork后的子进程继承父进程的CUDA和线程池状态
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+        futures = [
+            executor.submit(_evaluate_shard, load_model, args, worker_index, num_workers, questions)
+            for worker_index in range(num_workers)
+        ]
+        for future in futures:
+            indices, answers = future.result()
+            for i, answer in zip(indices, answers):
+                generated_answers[i] = answer
+    
+    return save_evaluation_results(eval_dataset, generated_answers, args)
+
+def _truncate_partial_line(path):
+    """截掉上次中断时写了一半的最后一行，保证后续追加的记录从新行开始"""
+    with open(path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+def evaluate_model_streaming(model, tokenizer, eval_dataset, args):
+    """
+    流式评估模型性能
+    
+    每个样本打分后立即追加一条JSONL记录到 evaluation_results.jsonl（index 为样本在评估集中的行号），
+    平均分以常数内存累计；若结果文件已存在，则跳过其中已打分的行继续评估（重复的问题各自评估），
+    最终汇总写入 evaluation_summary.json。
+    """
+    logger.info("开始流式评估模型...")
+    
+    scorer = create_scorer(eval_dataset, args)
+    
+    results_file = os.path.join(args.output_dir, "evaluation_results.jsonl")
+    metrics = RunningMetrics()
+    scored_indices = set()
+    unindexed_questions = []
+    
+    # 从已有的部分结果恢复
+    if os.path.exists(results_file):
+        _truncate_partial_line(results_file)
+        with open(results_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "index" in record:
+                    scored_indices.add(record["index"])
+                else:
+                    unindexed_questions.append(record["question"])
+                metrics.update(record)
+        logger.info(f"从 {results_file} 恢复 {metrics.count} 条已评估结果")
+    
+    questions = list(eval_dataset["question"])
+    if unindexed_questions:
+        # 旧版本写的记录没有 index：按问题文本依次对应到尚未打分的行，重复的问题每条记录只对应一行
+        remaining = {}
+        for question in unindexed_questions:
+            remaining[question] = remaining.get(question, 0) + 1
+        for i, question in enumerate(questions):
+            if remaining.get(question) and i not in scored_indices:
+                scored_indices.add(i)
+                remaining[question] -= 1
+    pending = [i for i in range(len(questions)) if i not in scored_indices]
+    logger.info(f"待评估样本数: {len(pending)}")
+    
+    speculative = eval_speculative_decoder(model, args)
+    with open(results_file, "a", encoding="utf-8") as f:
+        answers = iter_generated_answers(
+            model,
+            tokenizer,
+            [questions[i] for i in pending],
+            batch_size=args.eval_batch_size,
+            max_new_tokens=args.max_new_tokens,
+            prefix_cache=eval_prefix_cache(model, tokenizer, args),
+            speculative=speculative
+        )
+        for j, generated_answer in answers:
+            example = eval_dataset[pending[j]]
+            scores = scorer.score([generated_answer], indices=[pending[j]])
+            record = {
+                "index": pending[j],
+                "question": example["question"],
+                "reference_answer": example["answer"],
+                "generated_answer": generated_answer,
+                **{name: float(scores[name][0]) for name in METRIC_NAMES}
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            metrics.update(record)
+    
+    if speculative is not None:
+        log_speculative_metrics(speculative, args.output_dir)
+    
+    averages = metrics.averages()
+    log_evaluation_summary(averages)
+    
+    # 汇总结果由流式记录累计得到
+    summary_file = os.path.join(args.output_dir, "evaluation_summary.json")
+    with open(summary_file, "w", encoding="utf-8") as f:
+        json.dump({"num_examples": metrics.count, **averages}, f, ensure_ascii=False, indent=2)
+    
+    logger.info(f"逐条评估结果已保存到 {results_file}，汇总结果已保存到 {summary_file}")
+    
+    return averages
 
 def main():
     args = parse_args()
     
+    import torch
+    from gpu_distributed import init_distributed, is_distributed, is_main_process, main_process_first
+    
     # 检查输出目录
     if not os.path.exists(args.output_dir):
-        os.makedirs(args.output_dir)
+        os.makedirs(args.output_dir, exist_ok=True)
     
-    # 记录参数
-    params_file = os.path.join(args.output_dir, "training_params.json")
-    with open(params_file, "w") as f:
-        json.dump(vars(args), f, indent=2)
+    # 使用torchrun/accelerate多进程启动时初始化进程组
+    init_distributed()
     
-    # 创建模型和分词器
-    model, tokenizer = create_model_and_tokenizer(args.model_type, args.load_in_4bit)
+    # 记录参数（只由0号进程写入）
+    if is_main_process():
+        params_file = os.path.join(args.output_dir, "training_params.json")
+        with open(params_file, "w") as f:
+            json.dump(vars(args), f, indent=2)
     
     # 加载数据集
     if args.do_train:
-        train_dataset = load_gpu_qa_dataset(args.dataset_path, split="train")
-        eval_dataset = load_gpu_qa_dataset(args.dataset_path, split="validation")
+        # 创建模型和分词器
+        model, tokenizer = create_model_and_tokenizer(args.model_type, args.load_in_4bit)
         
-        # 预处理数据集
-        train_dataset = train_dataset.map(
-            lambda x: preprocess_gpu_qa(x, tokenizer, args.max_seq_length),
-            batched=True,
-            remove_columns=train_dataset.column_names
-        )
-        
-        eval_dataset = eval_dataset.map(
-            lambda x: preprocess_gpu_qa(x, tokenizer, args.max_seq_length),
-            batched=True,
-            remove_columns=eval_dataset.column_names
-        )
+        # 加载预处理后的数据集（命中缓存时跳过预处理）；多进程时由0号进程先写缓存
+        with main_process_first():
+            train_dataset = load_preprocessed_dataset(args.dataset_path, "train", tokenizer, args)
+            eval_dataset = load_preprocessed_dataset(args.dataset_path, "validation", tokenizer, args)
         
         # 训练模型
         model = train_model(model, tokenizer, train_dataset, eval_dataset, args)
     
     # 评估模型
     if args.do_eval:
+        eval_dataset = load_gpu_qa_dataset(args.dataset_path, split="test")
+        
+        if args.eval_mode == "loss":
+            # 一次前向即可完成，不需要并行评估进程、流式写入或生成加速
+            if not args.do_train:
+                model, tokenizer = load_model_for_eval(args)
+            evaluate_loss(model, tokenizer, eval_dataset, args)
+            return
+        
+        if args.eval_workers > 1 and not is_distributed():
+            # 工作进程各自从保存的适配器加载模型，释放训练时的模型
+            if args.do_train:
+                del model
+                torch.cuda.empty_cache()
+            if args.stream_eval:
+                logger.warning("并行评估不支持流式写入，结果统一写入evaluation_results.json")
+            evaluate_model_parallel(eval_dataset, args, args.eval_workers)
+            return
+        
         # 如果没有训练，加载微调后的模型
         if not args.do_train:
-            model = PeftModel.from_pretrained(
-                model, 
-                args.output_dir if args.resume_from_checkpoint is None else args.resume_from_checkpoint
-            )
-        
-        eval_dataset = load_gpu_qa_dataset(args.dataset_path, split="test")
+            model, tokenizer = load_model_for_eval(args)
         
         # 评估模型
-        evaluate_model(model, tokenizer, eval_dataset, args)
+        if args.stream_eval:
+            # 流式评估的结果文件只能由一个进程追加
+            if is_distributed():
+                logger.warning("流式评估不支持数据并行，仅由0号进程评估")
+            if is_main_process():
+                evaluate_model_streaming(model, tokenizer, eval_dataset, args)
+        else:
+            evaluate_model(model, tokenizer, eval_dataset, args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量评估指标
+以字符（或空格分词）为单位，对整个评估集一次性计算ROUGE-1/2/L和BLEU
+
+- n-gram以整数编码，所有样本的n-gram计数通过排序和分组一次完成
+- ROUGE-L的最长公共子序列使用位并行算法，每个生成token只需常数次大整数运算
+- 参考答案的n-gram表按内容哈希缓存在内存和磁盘中，对同一测试集重复评估时无需重新计算
+
+ROUGE按ROUGE原始定义以多重集统计：ROUGE-N的匹配数为截断计数 sum(min(生成中出现次数, 参考中出现次数))，
+精确率/召回率的分母为n-gram总数；ROUGE-L为token序列的最长公共子序列。这与旧版逐样本评估使用的 rouge 库不同：
+rouge 库按去重后的n-gram集合统计（ROUGE-L还按句号分句后取并集），文本中有重复token时两者分数不同，
+因此不能与旧版本的评估结果直接比较；没有重复token（且不含句号）时两者一致。
+BLEU与 nltk 的 sentence_bleu + SmoothingFunction().method4 一致。
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+# 评估指标名称
+METRIC_NAMES = ["rouge-1", "rouge-2", "rouge-l", "bleu"]
+
+# --eval_mode loss 的指标名称：助手回答token上的平均负对数似然及困惑度，越小越好
+LOSS_METRIC_NAMES = ["nll", "perplexity"]
+
+# BLEU最高n-gram阶数
+MAX_ORDER = 4
+
+# nltk method4 平滑使用的常数K
+SMOOTHING_K = 5
+
+# 打分方式或 ReferenceTable 的格式变化时递增，写入参考答案表的缓存键，使旧的磁盘缓存失效
+SCORER_VERSION = 2
+
+# 参考答案n-gram表的内存缓存
+_REFERENCE_TABLE_CACHE = {}
+
+def tokenize(text, level="char"):
+    """按字符或空格切分文本"""
+    if level == "char":
+        return list(text)
+    if level == "word":
+        return text.split()
+    raise ValueError(f"不支持的分词粒度: {level}")
+
+def _code_points(text):
+    """文本的Unicode码位数组，与 list(text) 逐一对应"""
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+def _count_pairs(examples, keys):
+    """统计 (样本下标, n-gram编码) 对的出现次数，返回按样本、编码排序的去重结果"""
+    order = np.lexsort((keys, examples))
+    examples, keys = examples[order], keys[order]
+    boundary = np.ones(len(examples), dtype=bool)
+    boundary[1:] = (examples[1:] != examples[:-1]) | (keys[1:] != keys[:-1])
+    starts = np.flatnonzero(boundary)
+    counts = np.diff(np.append(starts, len(examples)))
+    return examples[starts], keys[starts], counts
+
+def _count_packed(examples, keys, span):
+    """
+    与 _count_pairs 相同，但把样本下标和编码合并为单个uint64后排序，
+    要求 span（编码取值范围）乘以样本数不超过64位
+    """
+    packed = np.sort(examples.astype(np.uint64) * np.uint64(span) + keys)
+    boundary = np.ones(len(packed), dtype=bool)
+    boundary[1:] = packed[1:] != packed[:-1]
+    starts = np.flatnonzero(boundary)
+    counts = np.diff(np.append(starts, len(packed)))
+    unique = packed[starts]
+    return (unique // np.uint64(span)).astype(np.int64), unique % np.uint64(span), counts
+
+def _packed_span(base, n, num_examples):
+    """n-gram编码的取值范围；无法与样本下标一起放进64位时返回None"""
+    span = base ** n
+    if span * max(num_examples, 1) >= 2 ** 64:
+        return None
+    return span
+
+def _ngram_pairs(flat_ids, lengths, n, base):
+    """
+    对拼接在一起的所有样本提取n-gram编码
+
+    编码为 base 进制的uint64，base**n 超出64位时按模回绕（退化为哈希，冲突概率可忽略）。
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    example_of_pos = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    offset_in_example = np.arange(len(flat_ids), dtype=np.int64) - starts[example_of_pos]
+    valid = offset_in_example + n <= lengths[example_of_pos]
+    positions = np.flatnonzero(valid)
+
+    padded = np.concatenate([flat_ids, np.zeros(n, dtype=np.uint64)])
+    keys = np.zeros(len(positions), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for k in range(n):
+            keys = keys * np.uint64(base) + padded[positions + k]
+
+    span = _packed_span(base, n, len(lengths))
+    if span is not None:
+        return _count_packed(example_of_pos[positions], keys, span)
+    return _count_pairs(example_of_pos[positions], keys)
+
+def _clipped_matches(hyp_pairs, ref_pairs, num_examples, span=None):
+    """按样本累加截断后的n-gram匹配数 sum(min(hyp_count, ref_count))"""
+    if span is not None:
+        # 两侧都已按 (样本, 编码) 排序去重，直接二分查找
+        hyp_packed = hyp_pairs[0].astype(np.uint64) * np.uint64(span) + hyp_pairs[1]
+        ref_packed = ref_pairs[0].astype(np.uint64) * np.uint64(span) + ref_pairs[1]
+        positions = np.minimum(np.searchsorted(ref_packed, hyp_packed), max(len(ref_packed) - 1, 0))
+        found = ref_packed[positions] == hyp_packed if len(ref_packed) else np.zeros(len(hyp_packed), dtype=bool)
+        matched = np.minimum(hyp_pairs[2][found], ref_pairs[2][positions[found]])
+        return np.bincount(hyp_pairs[0][found], weights=matched, minlength=num_examples)
+
+    examples = np.concatenate([hyp_pairs[0], ref_pairs[0]])
+    keys = np.concatenate([hyp_pairs[1], ref_pairs[1]])
+    counts = np.concatenate([hyp_pairs[2], ref_pairs[2]])
+    order = np.lexsort((keys, examples))
+    examples, keys, counts = examples[order], keys[order], counts[order]
+    same = (examples[1:] == examples[:-1]) & (keys[1:] == keys[:-1])
+    matched = np.minimum(counts[1:][same], counts[:-1][same])
+    return np.bincount(examples[1:][same], weights=matched, minlength=num_examples)
+
+def _lcs_length(match_masks, ref_length, hyp_ids):
+    """位并行最长公共子序列长度（Hyyrö算法），match_masks为参考答案中每个token出现位置的位掩码"""
+    if ref_length == 0:
+        return 0
+    full = (1 << ref_length) - 1
+    v = full
+    for token_id in hyp_ids:
+        mask = match_masks.get(token_id)
+        if mask is None:
+            continue
+        u = v & mask
+        v = ((v + u) | (v - u)) & full
+    return ref_length - bin(v).count("1")
+
+class ReferenceTable:
+    """参考答案的编码结果、n-gram计数表和LCS位掩码"""
+
+    def __init__(self, references, level="char", max_order=MAX_ORDER):
+        self.level = level
+        self.max_order = max_order
+
+        if level == "char":
+            # 字符级直接按Unicode码位编码，避免逐字符查字典
+            codes = [_code_points(reference) for reference in references]
+            self.lengths = np.array([len(c) for c in codes], dtype=np.int64)
+            flat_codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint32)
+            self.vocab_codes, inverse = np.unique(flat_codes, return_inverse=True)
+            flat_ids = inverse.reshape(-1).astype(np.uint64)
+            self.vocab = None
+            vocab_size = len(self.vocab_codes)
+        else:
+            self.vocab = {}
+            encoded = []
+            for reference in references:
+                encoded.append([self.vocab.setdefault(token, len(self.vocab)) for token in tokenize(reference, level)])
+            self.lengths = np.array([len(ids) for ids in encoded], dtype=np.int64)
+            flat_ids = np.array([i for ids in encoded for i in ids], dtype=np.uint64)
+            vocab_size = len(self.vocab)
+
+        # 生成答案中未在参考答案出现的token统一编码为 vocab_size，它们不会产生任何匹配
+        self.unknown_id = vocab_size
+        self.base = vocab_size + 1
+        bounds = np.concatenate([[0], np.cumsum(self.lengths)])
+        encoded = [flat_ids[bounds[i]:bounds[i + 1]].tolist() for i in range(len(self.lengths))]
+
+        self.ngram_pairs = {}
+        self.ngram_offsets = {}
+        for n in range(1, max_order + 1):
+            pairs = _ngram_pairs(flat_ids, self.lengths, n, self.base)
+            self.ngram_pairs[n] = pairs
+            self.ngram_offsets[n] = np.searchsorted(pairs[0], np.arange(len(encoded) + 1))
+
+        self.match_masks = []
+        for ids in encoded:
+            masks = {}
+            for position, token_id in enumerate(ids):
+                masks[token_id] = masks.get(token_id, 0) | (1 << position)
+            self.match_masks.append(masks)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def encode(self, text):
+        """按参考答案词表编码生成文本"""
+        if self.vocab is None:
+            codes = _code_points(text)
+            if len(self.vocab_codes) == 0:
+                return [self.unknown_id] * len(codes)
+            positions = np.minimum(np.searchsorted(self.vocab_codes, codes), len(self.vocab_codes) - 1)
+            known = self.vocab_codes[positions] == codes
+            return np.where(known, positions, self.unknown_id).tolist()
+        return [self.vocab.get(token, self.unknown_id) for token in tokenize(text, self.level)]
+
+    def select_pairs(self, n, indices):
+        """取出指定样本的n-gram计数表，样本下标重新编号为 0..len(indices)-1"""
+        examples, keys, counts = self.ngram_pairs[n]
+        offsets = self.ngram_offsets[n]
+        spans = [np.arange(offsets[i], offsets[i + 1]) for i in indices]
+        selected = np.concatenate(spans) if spans else np.zeros(0, dtype=np.int64)
+        new_examples = np.repeat(np.arange(len(indices), dtype=np.int64), [len(span) for span in spans])
+        return new_examples, keys[selected], counts[selected]
+
+def _reference_key(references, level, max_order):
+    """参考答案集合（及打分代码版本）的内容哈希"""
+    digest = hashlib.sha256(f"{SCORER_VERSION}:{level}:{max_order}:{len(references)}".encode("utf-8"))
+    for reference in references:
+        digest.update(b"\0")
+        digest.update(reference.encode("utf-8"))
+    return digest.hexdigest()
+
+def load_reference_table(references, level="char", max_order=MAX_ORDER, cache_dir=None):
+    """
+    获取参考答案n-gram表，优先使用内存缓存，其次磁盘缓存
+
+    Args:
+        references: 参考答案列表
+        level: 分词粒度，char 或 word
+        max_order: 最高n-gram阶数
+        cache_dir: 磁盘缓存目录，为None时只使用内存缓存
+    """
+    references = list(references)
+    key = _reference_key(references, level, max_order)
+    if key in _REFERENCE_TABLE_CACHE:
+        return _REFERENCE_TABLE_CACHE[key]
+
+    cache_file = os.path.join(cache_dir, f"reference_ngrams_{key[:16]}.pkl") if cache_dir else None
+    table = None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                table = pickle.load(f)
+        except Exception:
+            table = None
+
+    if table is None:
+        table = ReferenceTable(references, level, max_order)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+
+    _REFERENCE_TABLE_CACHE[key] = table
+    return table
+
+def _f1(overlap, hyp_total, ref_total):
+    """F1：分母为0时对应的精确率/召回率记为0，F1的分母加1e-8（沿用rouge库的写法）"""
+    precision = np.divide(overlap, hyp_total, out=np.zeros(len(overlap)), where=hyp_total > 0)
+    recall = np.divide(overlap, ref_total, out=np.zeros(len(overlap)), where=ref_total > 0)
+    return 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+
+def _bleu(matches, hyp_lengths, ref_lengths):
+    """句子级BLEU（4-gram均匀权重，method4平滑，单参考答案）"""
+    num_examples = len(hyp_lengths)
+    log_sum = np.zeros(num_examples)
+    zero_count = np.ones(num_examples)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_hyp_length = np.log(hyp_lengths.astype(float))
+        for n in range(1, MAX_ORDER + 1):
+            numerator = matches[n]
+            denominator = np.maximum(hyp_lengths - n + 1, 1).astype(float)
+            smooth = (numerator == 0) & (hyp_lengths > 1)
+            smoothed = (1.0 / (2.0 ** zero_count * SMOOTHING_K / log_hyp_length)) / denominator
+            precision = np.where(smooth, smoothed, numerator / denominator)
+            zero_count = zero_count + smooth
+            log_sum = log_sum + np.where(precision > 0, np.log(np.where(precision > 0, precision, 1.0)) / MAX_ORDER, 0.0)
+
+        brevity_penalty = np.where(
+            hyp_lengths > ref_lengths,
+            1.0,
+            np.where(hyp_lengths == 0, 0.0, np.exp(1 - ref_lengths / np.maximum(hyp_lengths, 1)))
+        )
+    return np.where(matches[1] == 0, 0.0, brevity_penalty * np.exp(log_sum))
+
+class BatchScorer:
+    """
+    对一组参考答案批量打分
+
+    Example:
+        scorer = BatchScorer(references)
+        scores = scorer.score(generated_answers)  # {"rouge-1": ndarray, ...}
+    """
+
+    def __init__(self, references, level="char", cache_dir=None):
+        self.table = load_reference_table(references, level, MAX_ORDER, cache_dir)
+
+    def score(self, hypotheses, indices=None):
+        """
+        计算生成答案的各项指标
+
+        Args:
+            hypotheses: 生成的答案列表
+            indices: 每个答案对应的参考答案下标，默认与参考答案一一对应
+
+        Returns:
+            指标名到逐样本分数数组的字典
+        """
+        indices = list(range(len(hypotheses))) if indices is None else list(indices)
+        if len(indices) != len(hypotheses):
+            raise ValueError("生成答案与参考答案下标数量不一致")
+
+        encoded = [self.table.encode(hypothesis) for hypothesis in hypotheses]
+        hyp_lengths = np.array([len(ids) for ids in encoded], dtype=np.int64)
+        ref_lengths = self.table.lengths[indices] if indices else np.zeros(0, dtype=np.int64)
+        flat_ids = np.array([i for ids in encoded for i in ids], dtype=np.uint64)
+
+        matches = {}
+        for n in range(1, MAX_ORDER + 1):
+            hyp_pairs = _ngram_pairs(flat_ids, hyp_lengths, n, self.table.base)
+            ref_pairs = self.table.select_pairs(n, indices)
+            span = _packed_span(self.table.base, n, len(hypotheses))
+            matches[n] = _clipped_matches(hyp_pairs, ref_pairs, len(hypotheses), span)
+
+        lcs = np.array([
+            _lcs_length(self.table.match_masks[index], int(self.table.lengths[index]), ids)
+            for index, ids in zip(indices, encoded)
+        ], dtype=float)
+
+        return {
+            "rouge-1": _f1(matches[1], hyp_lengths, ref_lengths),
+            "rouge-2": _f1(matches[2], np.maximum(hyp_lengths - 1, 0), np.maximum(ref_lengths - 1, 0)),
+            "rouge-l": _f1(lcs, hyp_lengths, ref_lengths),
+            "bleu": _bleu(matches, hyp_lengths, ref_lengths),
+        }
+
+def score_batch(hypotheses, references, level="char", cache_dir=None):
+    """一次性计算一组生成答案与参考答案的逐样本指标"""
+    return BatchScorer(references, level, cache_dir).score(hypotheses)
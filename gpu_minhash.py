@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+字符n-gram的MinHash签名与LSH索引
+
+用于查找近似重复的文本：MinHash签名的相同分量比例是两段文本n-gram集合Jaccard相似度的无偏估计，
+LSH把签名分成若干段（band），任意一段完全相同的文本成为候选，避免两两比较。
+哈希使用crc32和固定种子，签名在不同进程和不同运行之间保持一致，可以持久化。
+"""
+
+import unicodedata
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+# 哈希函数族 h(x) = ((a*x + b) mod p) & (2^32-1)，与datasketch相同：uint64乘法按2^64回绕，取低32位
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+class _StripTable(dict):
+    """str.translate 的映射表：空白和标点映射为None（删除），按需计算并缓存每个字符"""
+
+    def __missing__(self, code):
+        char = chr(code)
+        value = None if char.isspace() or unicodedata.category(char).startswith("P") else code
+        self[code] = value
+        return value
+
+_STRIP_TABLE = _StripTable()
+
+def normalize_text(text):
+    """NFKC规范化、统一大小写，并去掉空白和标点（全角/半角的问号等视为相同）"""
+    return unicodedata.normalize("NFKC", text).casefold().translate(_STRIP_TABLE)
+
+def char_ngrams(text, n=3):
+    """字符n-gram集合，短于n的文本整体作为一个n-gram"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def jaccard(a, b):
+    """两个集合的Jaccard相似度"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+class MinHasher:
+    """
+    字符n-gram的MinHash签名
+
+    Args:
+        num_perm: 签名长度（哈希函数个数）
+        ngram: n-gram的字符数
+        seed: 哈希函数参数的随机种子，同一种子的签名才能相互比较
+    """
+
+    def __init__(self, num_perm=64, ngram=3, seed=1):
+        self.num_perm = num_perm
+        self.ngram = ngram
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text=None, ngrams=None):
+        """文本（或已切分的n-gram集合）的签名，形状为 [num_perm] 的uint64数组"""
+        if ngrams is None:
+            ngrams = char_ngrams(text, self.ngram)
+        if not ngrams:
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        hashes = np.array([zlib.crc32(gram.encode("utf-8")) for gram in ngrams], dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            permuted = ((hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=0)
+
+    @staticmethod
+    def similarity(signature_a, signature_b):
+        """由签名估计的Jaccard相似度"""
+        return float(np.mean(signature_a == signature_b))
+
+class MinHashLSH:
+    """
+    MinHash签名的LSH索引
+
+    签名被切成 bands 段，每段 num_perm // bands 个分量；Jaccard相似度为s的两段文本成为候选的概率为
+    1 - (1 - s^rows)^bands。默认64分量、16段时约在s=0.5附近陡升，候选再由调用方精确校验。
+
+    Args:
+        num_perm: 签名长度，须与 MinHasher 一致
+        bands: 分段数，须整除 num_perm
+    """
+
+    def __init__(self, num_perm=64, bands=16):
+        if num_perm % bands:
+            raise ValueError(f"bands ({bands}) 必须整除 num_perm ({num_perm})")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [defaultdict(set) for _ in range(bands)]
+        self.keys = {}
+
+    def _band_hashes(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, key, signature):
+        if key in self.keys:
+            self.remove(key)
+        band_hashes = self._band_hashes(signature)
+        self.keys[key] = band_hashes
+        for bucket, band_hash in zip(self.buckets, band_hashes):
+            bucket[band_hash].add(key)
+
+    def remove(self, key):
+        band_hashes = self.keys.pop(key, None)
+        if band_hashes is None:
+            return
+        for bucket, band_hash in zip(self.buckets, band_hashes):
+            bucket[band_hash].discard(key)
+            if not bucket[band_hash]:
+                del bucket[band_hash]
+
+    def query(self, signature):
+        """与签名至少有一段相同的全部键"""
+        candidates = set()
+        for bucket, band_hash in zip(self.buckets, self._band_hashes(signature)):
+            candidates.update(bucket.get(band_hash, ()))
+        return candidates
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
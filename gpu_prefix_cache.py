@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+系统提示词前缀KV缓存
+
+训练、评估和推理服务的每个提示都以同一段系统提示词开头。这里对套用对话模板后的系统消息
+只计算一次KV缓存，之后的生成（包括批量生成）直接复用，只需编码用户问题部分。
+
+复用时批次的布局为 [系统前缀][填充][问题]：前缀在所有行中位于相同位置，填充夹在前缀和问题之间，
+由 attention_mask 屏蔽，位置编号按 attention_mask 累计，与不使用缓存时完全相同。
+模型参数或当前适配器发生变化（如切换、重新加载适配器）时缓存自动失效并重新计算。
+"""
+
+import weakref
+
+import torch
+from transformers import DynamicCache
+
+# 用于从渲染后的提示中定位用户问题的占位文本
+_QUESTION_MARKER = "\u0000QUESTION\u0000"
+
+def model_fingerprint(model):
+    """
+    模型参数与适配器状态的指纹
+
+    参数被替换或原地修改（如加载新适配器、合并权重）、切换或禁用适配器后改变。
+    """
+    parameters = tuple((p.data_ptr(), p._version) for p in model.parameters())
+    # PEFT的适配器层用 _disable_adapters 标记 disable_adapter() 上下文
+    disabled = tuple(module._disable_adapters for module in model.modules() if hasattr(module, "_disable_adapters"))
+    return hash((parameters, disabled, str(getattr(model, "active_adapter", None))))
+
+class SystemPromptCache:
+    """
+    系统提示词的KV缓存
+
+    Args:
+        model: 因果语言模型（可以是PeftModel）
+        tokenizer: 分词器
+        build_prompt: 构建生成提示的函数 (tokenizer, question) -> str，与生成时使用的相同
+    """
+
+    def __init__(self, model, tokenizer, build_prompt):
+        # 弱引用模型，缓存不延长模型的生命周期
+        self._model = weakref.ref(model)
+        self.tokenizer = tokenizer
+        self.prefix_ids = self._system_prefix_ids(build_prompt)
+        self.fingerprint = None
+        self.layers = None
+        self.stats = {"hits": 0, "misses": 0, "rebuilds": 0}
+
+    @property
+    def model(self):
+        return self._model()
+
+    def _system_prefix_ids(self, build_prompt):
+        """对话模板渲染后的系统消息（到用户消息的 <|im_start|> 之前）的token"""
+        prompt = build_prompt(self.tokenizer, _QUESTION_MARKER)
+        before_question = prompt.split(_QUESTION_MARKER)[0]
+        # 在用户消息的起始特殊token处截断，保证前缀的分词结果是完整提示分词结果的前缀
+        prefix = before_question[:before_question.rfind("<|im_start|>")]
+        return self.tokenizer(prefix, add_special_tokens=False)["input_ids"]
+
+    def _layer_tensors(self):
+        """当前模型下前缀的各层 (keys, values)，模型或适配器变化后重新计算"""
+        fingerprint = model_fingerprint(self.model)
+        if fingerprint != self.fingerprint:
+            input_ids = torch.tensor([self.prefix_ids], device=self.model.device)
+            with torch.no_grad():
+                cache = self.model(input_ids=input_ids, use_cache=True).past_key_values
+            self.layers = [(layer.keys, layer.values) for layer in cache.layers]
+            if self.fingerprint is not None:
+                self.stats["rebuilds"] += 1
+            self.fingerprint = fingerprint
+        return self.layers
+
+    def matches(self, prompt_ids):
+        return len(prompt_ids) > len(self.prefix_ids) and list(prompt_ids[:len(self.prefix_ids)]) == self.prefix_ids
+
+    def expand(self, batch_size):
+        """复制出批大小为 batch_size 的前缀缓存（生成时会原地追加，每次调用都返回新的对象）"""
+        return DynamicCache(ddp_cache_data=[
+            (keys.expand(batch_size, -1, -1, -1).contiguous(), values.expand(batch_size, -1, -1, -1).contiguous())
+            for keys, values in self._layer_tensors()
+        ])
+
+    def prepare_inputs(self, prompt_ids, pad_token_id):
+        """
+        为一批提示构造复用前缀缓存的生成输入
+
+        Args:
+            prompt_ids: 各提示完整的token列表
+            pad_token_id: 填充token
+
+        Returns:
+            含 input_ids、attention_mask、past_key_values 的字典（input_ids 仍包含前缀，
+            生成时只会计算缓存之后的部分）；有提示不以系统前缀开头时返回None
+        """
+        if not all(self.matches(ids) for ids in prompt_ids):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+
+        prefix_length = len(self.prefix_ids)
+        questions = [list(ids[prefix_length:]) for ids in prompt_ids]
+        max_length = max(len(ids) for ids in questions)
+        input_ids, attention_mask = [], []
+        for ids in questions:
+            padding = max_length - len(ids)
+            input_ids.append(self.prefix_ids + [pad_token_id] * padding + ids)
+            attention_mask.append([1] * prefix_length + [0] * padding + [1] * len(ids))
+        return {
+            "input_ids": torch.tensor(input_ids, device=self.model.device),
+            "attention_mask": torch.tensor(attention_mask, device=self.model.device),
+            "past_key_values": self.expand(len(prompt_ids)),
+        }
+
+# 每个模型对象一份前缀缓存，模型被释放时随之释放
+_CACHES = weakref.WeakKeyDictionary()
+
+def get_prefix_cache(model, tokenizer, build_prompt):
+    """获取（必要时创建）模型的系统提示词前缀缓存"""
+    cache = _CACHES.get(model)
+    if cache is None or cache.tokenizer is not tokenizer:
+        cache = SystemPromptCache(model, tokenizer, build_prompt)
+        _CACHES[model] = cache
+    return cache
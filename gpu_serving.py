@@ -0,0 +1,785 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPU知识助手推理服务
+基于asyncio的HTTP服务，提供OpenAI风格的 /v1/chat/completions 接口（支持流式输出）
+
+所有请求进入同一个队列，由连续批处理（continuous batching）引擎统一生成：
+引擎每一步对当前批次中的全部序列解码一个token，新请求在步与步之间加入批次，
+已结束的序列立即移出，不必等待整批完成。提示词使用与训练相同的系统提示词和对话模板。
+
+指定 --adapters 时只加载一份基础模型，请求的 model 字段选择LoRA适配器（见 gpu_adapters），
+使用不同适配器的请求在同一批次中生成。
+
+用法:
+    python gpu_serving.py --model_type qwen3-1.7b --output_dir outputs/qwen3-1.7b --port 8000
+    python gpu_serving.py --model_type qwen3-1.7b --adapters v1=outputs/qwen3-1.7b-gpu-assistant v2=qwen3-output
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+from aiohttp import web
+from transformers import DynamicCache
+
+from gpu_adapters import BASE_ADAPTER, AdapterManager, parse_adapter_specs
+from gpu_answer_cache import AnswerCache, adapter_fingerprint
+from gpu_llm_finetune import SUPPORTED_MODELS, SYSTEM_PROMPT, build_chat_prompt
+from gpu_prefix_cache import get_prefix_cache
+from gpu_speculative import SpeculativeDecoder
+
+logger = logging.getLogger(__name__)
+
+class _Sequence:
+    """一个生成请求在引擎中的状态"""
+
+    def __init__(self, prompt_ids, max_new_tokens, temperature, top_p, adapter=None):
+        self.prompt_ids = prompt_ids
+        self.adapter = adapter
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated = []
+        self.emitted_text = ""
+        self.finish_reason = None
+        self.error = None
+        self.cancelled = False
+        # 引擎线程产出的 (增量文本, 结束原因) 由事件循环放入该队列
+        self.events = asyncio.Queue()
+
+class ContinuousBatchingEngine:
+    """
+    连续批处理生成引擎
+
+    批次状态为左填充对齐的KV缓存及对应的 attention_mask。新请求先单独预填充，
+    再把两部分缓存左填充到相同长度后按批次维拼接；序列结束后从缓存中删除对应的行，
+    并裁掉所有行都是填充的前导列。模型计算在单独的线程中进行，不阻塞事件循环。
+
+    Args:
+        model: 因果语言模型（可以是PeftModel或合并后的模型）
+        tokenizer: 分词器
+        max_batch_size: 同时生成的最大序列数
+        max_new_tokens: 请求未指定时每个回答最多生成的token数
+        prefix_cache: 系统提示词前缀缓存（见 gpu_prefix_cache），预填充时只编码问题部分
+        adapters: 多LoRA适配器管理器（见 gpu_adapters），此时 model 应为 adapters.model，
+            每个请求使用自己的适配器，同一批次中的适配器数不超过其常驻上限
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, max_new_tokens=512, prefix_cache=None, adapters=None):
+        if adapters is not None and prefix_cache is not None:
+            # 前缀缓存的KV由某一个适配器算出，不能给其他适配器的请求复用
+            raise ValueError("多适配器服务不支持前缀缓存")
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.device = model.device
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+        eos_token_ids = model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, (list, tuple)) else [eos_token_ids])
+
+        # 等待加入批次的请求，只在事件循环中访问
+        self.pending = deque()
+        # 以下批次状态只在引擎线程中访问
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.positions = None
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.wakeup = None
+        self.task = None
+        self.stats = {
+            "requests_completed": 0,
+            "requests_failed": 0,
+            "generated_tokens": 0,
+            "decode_steps": 0,
+            "batched_sequences": 0,
+            "max_batch_size_seen": 0,
+        }
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+
+    def metrics(self):
+        """引擎运行统计"""
+        steps = self.stats["decode_steps"]
+        metrics = {
+            **self.stats,
+            "average_batch_size": self.stats["batched_sequences"] / steps if steps else 0.0,
+            "active": len(self.active),
+            "queued": len(self.pending),
+        }
+        if self.prefix_cache is not None:
+            metrics["prefix_cache"] = dict(self.prefix_cache.stats)
+        if self.adapters is not None:
+            metrics["adapters"] = self.adapters.metrics()
+        return metrics
+
+    def submit(self, messages, max_new_tokens=None, temperature=0.0, top_p=1.0, adapter=None):
+        """
+        把一个对话请求加入队列，返回其序列状态，用 stream() 读取生成结果
+
+        adapter 为使用的适配器名称（BASE_ADAPTER 表示基础模型），None时使用默认适配器；没有适配器管理器时忽略。
+        """
+        prompt = build_chat_prompt(self.tokenizer, messages)
+        if self.adapters is not None:
+            adapter = adapter or self.adapters.default
+            if adapter not in self.adapters:
+                raise KeyError(f"未注册的适配器: {adapter}")
+        sequence = _Sequence(
+            self.tokenizer(prompt)["input_ids"],
+            max_new_tokens or self.max_new_tokens,
+            temperature,
+            top_p,
+            adapter,
+        )
+        self.pending.append(sequence)
+        self.wakeup.set()
+        return sequence
+
+    async def stream(self, sequence):
+        """
+        逐步产出序列的 (增量文本, 结束原因)
+
+        结束原因在最后一次产出时为 "stop"（生成了结束符）、"length"（达到最大长度）
+        或 "error"（模型计算出错，错误信息在 sequence.error 中），其余为None。
+        调用方提前停止迭代（如客户端断开）时，该序列在下一步被移出批次。
+        """
+        try:
+            while True:
+                delta, finish_reason = await sequence.events.get()
+                yield delta, finish_reason
+                if finish_reason is not None:
+                    return
+        finally:
+            sequence.cancelled = True
+
+    async def generate(self, messages, **kwargs):
+        """提交请求并逐步产出 (增量文本, 结束原因)"""
+        async for event in self.stream(self.submit(messages, **kwargs)):
+            yield event
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.active and not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            admitted = []
+            adapters = {s.adapter for s in self.active}
+            while self.pending and len(self.active) + len(admitted) < self.max_batch_size:
+                sequence = self.pending.popleft()
+                if sequence.cancelled:
+                    continue
+                if self.adapters is not None and not self.adapters.fits(adapters | {sequence.adapter}):
+                    # 批次中的适配器已达常驻上限，按先来先服务等待批次中的序列结束
+                    self.pending.appendleft(sequence)
+                    break
+                adapters.add(sequence.adapter)
+                admitted.append(sequence)
+            if not self.active and not admitted:
+                continue
+
+            try:
+                events = await loop.run_in_executor(self.executor, self._step, admitted)
+            except Exception as error:
+                # 一步出错（如显存不足）时结束批次中和刚加入的全部请求，清空批次后继续服务新请求
+                logger.exception("生成出错，结束当前批次中的请求")
+                failed = self.active + [s for s in admitted if s not in self.active]
+                await loop.run_in_executor(self.executor, self._reset)
+                events = []
+                for sequence in failed:
+                    sequence.error = f"生成出错: {error}"
+                    sequence.finish_reason = "error"
+                    events.append((sequence, "", "error"))
+                self.stats["requests_failed"] += len(failed)
+            for sequence, delta, finish_reason in events:
+                sequence.events.put_nowait((delta, finish_reason))
+
+    def _reset(self):
+        """引擎线程中清空批次状态和KV缓存"""
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.positions = None
+        self.prefill_state = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _step(self, admitted):
+        """引擎线程中执行一步：有新请求时预填充并加入批次，否则对整个批次解码一个token"""
+        with torch.no_grad():
+            if admitted:
+                if self.adapters is not None:
+                    # 先保证整个批次的适配器常驻，预填充新请求时不会卸载批次中正在使用的适配器
+                    self.adapters.acquire([s.adapter for s in self.active + admitted])
+                rows = self._prefill(admitted)
+                sequences = admitted
+            else:
+                rows = self._decode()
+                sequences = self.active
+            tokens = self._sample(rows, sequences)
+
+        events, keep = [], []
+        for i, (sequence, token) in enumerate(zip(sequences, tokens.tolist())):
+            finish_reason = None
+            if token in self.eos_token_ids:
+                finish_reason = "stop"
+            else:
+                sequence.generated.append(token)
+                if len(sequence.generated) >= sequence.max_new_tokens:
+                    finish_reason = "length"
+            if sequence.cancelled:
+                continue
+            delta = self._text_delta(sequence, final=finish_reason is not None)
+            if finish_reason is not None:
+                sequence.finish_reason = finish_reason
+                self.stats["requests_completed"] += 1
+            if delta or finish_reason is not None:
+                events.append((sequence, delta, finish_reason))
+            if finish_reason is None:
+                keep.append(i)
+        self.stats["generated_tokens"] += len(sequences)
+
+        if admitted:
+            self._merge(admitted, tokens, keep)
+        else:
+            self.next_tokens = tokens
+            self._select(keep)
+        return events
+
+    def _text_delta(self, sequence, final):
+        """新增的文本；末尾是不完整的多字节字符时先不输出"""
+        text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+        if not final and text.endswith("�"):
+            return ""
+        delta = text[len(sequence.emitted_text):]
+        sequence.emitted_text = text
+        return delta
+
+    def _adapter_kwargs(self, sequences):
+        """批次各行适配器对应的前向参数，必要时加载适配器"""
+        if self.adapters is None:
+            return {}
+        return self.adapters.forward_kwargs([s.adapter for s in sequences])
+
+    def _prefill(self, sequences):
+        """
+        对新请求左填充后一次前向，返回最后位置的logits；缓存暂存在 self.prefill_state
+
+        所有新请求都以系统提示词开头时从前缀缓存继续，只编码 [填充][问题] 部分。
+        """
+        prompts = [s.prompt_ids for s in sequences]
+        past_key_values, prefix_length = None, 0
+        if self.prefix_cache is not None:
+            inputs = self.prefix_cache.prepare_inputs(prompts, self.pad_token_id)
+            if inputs is not None:
+                past_key_values = inputs["past_key_values"]
+                prefix_length = len(self.prefix_cache.prefix_ids)
+                prompts = [ids[prefix_length:] for ids in prompts]
+
+        max_length = max(len(ids) for ids in prompts)
+        input_ids = torch.full((len(sequences), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), prefix_length + max_length), dtype=torch.long)
+        attention_mask[:, :prefix_length] = 1
+        for i, ids in enumerate(prompts):
+            input_ids[i, max_length - len(ids):] = torch.tensor(ids)
+            attention_mask[i, prefix_length + max_length - len(ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, prefix_length:]
+
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=past_key_values, use_cache=True, **self._adapter_kwargs(sequences))
+        self.prefill_state = (outputs.past_key_values, attention_mask, attention_mask.sum(-1))
+        return outputs.logits[:, -1, :]
+
+    def _decode(self):
+        """对批次中的每个序列输入上一步的token，返回下一个位置的logits"""
+        batch_size = len(self.active)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((batch_size, 1))], dim=-1)
+        outputs = self.model(
+            input_ids=self.next_tokens[:, None],
+            attention_mask=self.attention_mask,
+            position_ids=self.positions[:, None],
+            past_key_values=self.cache,
+            use_cache=True,
+            **self._adapter_kwargs(self.active),
+        )
+        self.cache = outputs.past_key_values
+        self.positions = self.positions + 1
+        self.stats["decode_steps"] += 1
+        self.stats["batched_sequences"] += batch_size
+        self.stats["max_batch_size_seen"] = max(self.stats["max_batch_size_seen"], batch_size)
+        return outputs.logits[:, -1, :]
+
+    def _sample(self, logits, sequences):
+        """temperature为0时贪心解码，否则按温度和top_p采样"""
+        tokens = logits.argmax(dim=-1)
+        for i, sequence in enumerate(sequences):
+            if sequence.temperature <= 0:
+                continue
+            probs = F.softmax(logits[i].float() / sequence.temperature, dim=-1)
+            if sequence.top_p < 1.0:
+                sorted_probs, sorted_ids = probs.sort(descending=True)
+                outside = sorted_probs.cumsum(-1) - sorted_probs > sequence.top_p
+                sorted_probs[outside] = 0
+                probs = torch.zeros_like(probs).scatter(0, sorted_ids, sorted_probs)
+            tokens[i] = torch.multinomial(probs, 1)[0]
+        return tokens
+
+    @staticmethod
+    def _layer_tensors(cache):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+
+    def _merge(self, admitted, tokens, keep):
+        """把预填充得到的新序列（只保留未结束的）左对齐拼接到当前批次"""
+        cache, attention_mask, positions = self.prefill_state
+        self.prefill_state = None
+        keep = torch.tensor(keep, dtype=torch.long, device=self.device)
+        new_layers = [(k[keep], v[keep]) for k, v in self._layer_tensors(cache)]
+        new_mask, new_positions, new_tokens = attention_mask[keep], positions[keep], tokens[keep]
+        new_sequences = [admitted[i] for i in keep.tolist()]
+        if not new_sequences:
+            return
+
+        if self.cache is None:
+            layers, mask = new_layers, new_mask
+            positions, next_tokens, sequences = new_positions, new_tokens, new_sequences
+        else:
+            length = max(self.attention_mask.shape[1], new_mask.shape[1])
+            old_layers, old_mask = self._left_pad(self._layer_tensors(self.cache), self.attention_mask, length)
+            new_layers, new_mask = self._left_pad(new_layers, new_mask, length)
+            layers = [(torch.cat([ok, nk]), torch.cat([ov, nv]))
+                      for (ok, ov), (nk, nv) in zip(old_layers, new_layers)]
+            mask = torch.cat([old_mask, new_mask])
+            positions = torch.cat([self.positions, new_positions])
+            next_tokens = torch.cat([self.next_tokens, new_tokens])
+            sequences = self.active + new_sequences
+
+        self.cache = DynamicCache(ddp_cache_data=layers)
+        self.attention_mask = mask
+        self.positions = positions
+        self.next_tokens = next_tokens
+        self.active = sequences
+
+    @staticmethod
+    def _left_pad(layers, attention_mask, length):
+        padding = length - attention_mask.shape[1]
+        if padding == 0:
+            return layers, attention_mask
+        layers = [(F.pad(k, (0, 0, padding, 0)), F.pad(v, (0, 0, padding, 0))) for k, v in layers]
+        return layers, F.pad(attention_mask, (padding, 0))
+
+    def _select(self, keep):
+        """只保留未结束的序列，并裁掉所有序列都是填充的前导列"""
+        if len(keep) == len(self.active):
+            return
+        if not keep:
+            self.active = []
+            self.cache = self.attention_mask = self.next_tokens = self.positions = None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = self.attention_mask[index]
+        start = int(mask.any(dim=0).nonzero()[0])
+        self.cache = DynamicCache(ddp_cache_data=[
+            (k[index, :, start:], v[index, :, start:]) for k, v in self._layer_tensors(self.cache)])
+        self.attention_mask = mask[:, start:]
+        self.positions = self.positions[index]
+        self.next_tokens = self.next_tokens[index]
+        self.active = [self.active[i] for i in keep]
+
+class SpeculativeEngine(ContinuousBatchingEngine):
+    """
+    投机解码引擎
+
+    与 ContinuousBatchingEngine 接口相同，但每次只解码一个请求：草稿模型生成若干token后由目标模型一次验证，
+    每一步产出本轮接受的全部token。适合并发低、看重单个请求延迟的场景；总是贪心解码，忽略temperature/top_p。
+
+    Args:
+        model: 目标模型
+        tokenizer: 分词器
+        draft_model: 草稿模型，与目标模型共用词表
+        num_draft_tokens: 每轮的草稿token数
+        max_new_tokens: 请求未指定时每个回答最多生成的token数
+    """
+
+    def __init__(self, model, tokenizer, draft_model, num_draft_tokens=4, max_new_tokens=512):
+        super().__init__(model, tokenizer, max_batch_size=1, max_new_tokens=max_new_tokens)
+        self.decoder = SpeculativeDecoder(model, draft_model, num_draft_tokens)
+        self.state = None
+
+    def metrics(self):
+        return {**super().metrics(), "speculative": self.decoder.metrics()}
+
+    def _reset(self):
+        super()._reset()
+        self.state = None
+
+    def _step(self, admitted):
+        if admitted:
+            sequence = admitted[0]
+            self.active = [sequence]
+            self.state, tokens = self.decoder.start(sequence.prompt_ids)
+        else:
+            sequence = self.active[0]
+            tokens = self.decoder.step(self.state)
+        self.stats["decode_steps"] += 1
+        self.stats["batched_sequences"] += 1
+        self.stats["max_batch_size_seen"] = 1
+
+        finish_reason = None
+        for token in tokens:
+            if token in self.eos_token_ids:
+                finish_reason = "stop"
+                break
+            sequence.generated.append(token)
+            self.stats["generated_tokens"] += 1
+            if len(sequence.generated) >= sequence.max_new_tokens:
+                finish_reason = "length"
+                break
+        if sequence.cancelled or finish_reason is not None:
+            self.active, self.state = [], None
+        if sequence.cancelled:
+            return []
+
+        delta = self._text_delta(sequence, final=finish_reason is not None)
+        if finish_reason is not None:
+            sequence.finish_reason = finish_reason
+            self.stats["requests_completed"] += 1
+        if delta or finish_reason is not None:
+            return [(sequence, delta, finish_reason)]
+        return []
+
+ENGINE_KEY = web.AppKey("engine", ContinuousBatchingEngine)
+MODEL_NAME_KEY = web.AppKey("model_name", str)
+ANSWER_CACHE_KEY = web.AppKey("answer_cache", AnswerCache)
+
+def _error(status, message, error_type="invalid_request_error"):
+    return web.json_response({"error": {"message": message, "type": error_type}}, status=status)
+
+def _chunk(completion_id, created, model_name, delta, finish_reason=None):
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model_name,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+def _cacheable_question(messages, temperature):
+    """
+    可以使用问答缓存的请求返回其问题，否则返回None
+
+    只缓存贪心解码、使用默认系统提示词的单轮问答，其他请求的回答不只取决于问题本身。
+    """
+    if temperature > 0 or not all(isinstance(m["content"], str) for m in messages):
+        return None
+    roles = [m["role"] for m in messages]
+    if roles == ["system", "user"] and messages[0]["content"] == SYSTEM_PROMPT or roles == ["user"]:
+        return messages[-1]["content"]
+    return None
+
+async def _replay(answer):
+    yield answer, "stop"
+
+async def _record(events, cache, question, tokenizer):
+    """转发生成事件，正常结束（非截断）时把完整回答写入问答缓存"""
+    start_time = time.perf_counter()
+    pieces = []
+    try:
+        async for delta, finish_reason in events:
+            pieces.append(delta)
+            if finish_reason == "stop":
+                answer = "".join(pieces)
+                cache.put(question, answer, latency=time.perf_counter() - start_time,
+                          completion_tokens=len(tokenizer(answer, add_special_tokens=False)["input_ids"]))
+            yield delta, finish_reason
+    finally:
+        await events.aclose()
+
+def _resolve_adapter(adapters, model_name, requested):
+    """请求的 model 字段对应的适配器：未指定时为默认适配器，基础模型名称表示不使用适配器，未知的模型返回None"""
+    if not requested:
+        return adapters.default
+    if requested == model_name:
+        return BASE_ADAPTER
+    return requested if requested in adapters else None
+
+async def chat_completions(request):
+    """OpenAI风格的对话补全接口"""
+    engine = request.app[ENGINE_KEY]
+    model_name = request.app[MODEL_NAME_KEY]
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return _error(400, "请求体不是合法的JSON")
+    if not isinstance(body, dict):
+        return _error(400, "请求体必须是JSON对象")
+    if body.get("model") is not None and not isinstance(body["model"], str):
+        return _error(400, "model 必须是字符串")
+
+    # 没有适配器管理器时忽略 model 字段
+    adapter = None
+    if engine.adapters is not None:
+        adapter = _resolve_adapter(engine.adapters, model_name, body.get("model"))
+        if adapter is None:
+            return _error(404, f"模型 {body['model']} 不存在")
+        if adapter != BASE_ADAPTER:
+            model_name = adapter
+
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not messages or \
+            not all(isinstance(m, dict) and "role" in m and "content" in m for m in messages):
+        return _error(400, "messages 必须是包含 role 和 content 的非空列表")
+    max_tokens = body.get("max_tokens")
+    if max_tokens is None:
+        max_tokens = body.get("max_completion_tokens")
+    if max_tokens is not None and (isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1):
+        return _error(400, "max_tokens 必须是正整数")
+    try:
+        temperature = float(body.get("temperature", 0.0))
+        top_p = float(body.get("top_p", 1.0))
+    except (TypeError, ValueError):
+        return _error(400, "temperature 和 top_p 必须是数字")
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    cache = request.app.get(ANSWER_CACHE_KEY)
+    question = _cacheable_question(messages, temperature) if cache is not None else None
+    cached = cache.get(question) if question is not None else None
+    if cached is not None and max_tokens and cached["completion_tokens"] > max_tokens:
+        cached = None
+    if cached is not None:
+        sequence = None
+        events = _replay(cached["answer"])
+    else:
+        sequence = engine.submit(messages, max_new_tokens=max_tokens, temperature=temperature, top_p=top_p,
+                                 adapter=adapter)
+        events = engine.stream(sequence)
+        if question is not None:
+            events = _record(events, cache, question, engine.tokenizer)
+
+    if not body.get("stream", False):
+        pieces, finish_reason = [], None
+        async for delta, finish_reason in events:
+            pieces.append(delta)
+        if finish_reason == "error":
+            return _error(500, sequence.error, "server_error")
+        content = "".join(pieces)
+        if sequence is None:
+            prompt_tokens = len(engine.tokenizer(build_chat_prompt(engine.tokenizer, messages))["input_ids"])
+            completion_tokens = cached["completion_tokens"]
+        else:
+            prompt_tokens = len(sequence.prompt_ids)
+            completion_tokens = len(sequence.generated)
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model_name,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+    # 等到第一个事件再发送响应头，预填充出错时仍可返回500
+    try:
+        first = await events.__anext__()
+    except BaseException:
+        await events.aclose()
+        raise
+    if first[1] == "error":
+        await events.aclose()
+        return _error(500, sequence.error, "server_error")
+
+    async def all_events():
+        yield first
+        async for event in events:
+            yield event
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    await response.write(_chunk(completion_id, created, model_name, {"role": "assistant", "content": ""}))
+    try:
+        async for delta, finish_reason in all_events():
+            if delta:
+                await response.write(_chunk(completion_id, created, model_name, {"content": delta}))
+            if finish_reason == "error":
+                # 响应头已发送，生成中途出错时以错误事件结束，不发送 [DONE]
+                payload = {"error": {"message": sequence.error, "type": "server_error"}}
+                await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+                break
+            if finish_reason is not None:
+                await response.write(_chunk(completion_id, created, model_name, {}, finish_reason))
+        else:
+            await response.write(b"data: [DONE]\n\n")
+    finally:
+        # 客户端断开时关闭生成器，引擎在下一步移出该序列
+        await events.aclose()
+    await response.write_eof()
+    return response
+
+async def list_models(request):
+    """基础模型以及各适配器（parent 为基础模型）"""
+    model_name = request.app[MODEL_NAME_KEY]
+    adapters = request.app[ENGINE_KEY].adapters
+    data = [{"id": model_name, "object": "model", "owned_by": "gpu-qa"}]
+    if adapters is not None:
+        data += [{"id": name, "object": "model", "owned_by": "gpu-qa", "parent": model_name}
+                 for name in adapters.names]
+    return web.json_response({"object": "list", "data": data})
+
+async def health(request):
+    metrics = request.app[ENGINE_KEY].metrics()
+    cache = request.app.get(ANSWER_CACHE_KEY)
+    if cache is not None:
+        metrics["answer_cache"] = cache.metrics()
+    return web.json_response({"status": "ok", **metrics})
+
+def create_app(engine, model_name, answer_cache=None):
+    """创建HTTP应用，应用启动时启动引擎，关闭时停止引擎（并保存问答缓存）"""
+    app = web.Application()
+    app[ENGINE_KEY] = engine
+    app[MODEL_NAME_KEY] = model_name
+    if answer_cache is not None:
+        app[ANSWER_CACHE_KEY] = answer_cache
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/v1/models", list_models)
+    app.router.add_get("/health", health)
+
+    async def start_engine(app):
+        await app[ENGINE_KEY].start()
+
+    async def stop_engine(app):
+        await app[ENGINE_KEY].stop()
+        if answer_cache is not None and answer_cache.path is not None:
+            answer_cache.save()
+
+    app.on_startup.append(start_engine)
+    app.on_cleanup.append(stop_engine)
+    return app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GPU知识助手推理服务")
+    parser.add_argument("--model_type", type=str, default="qwen3-1.7b", choices=SUPPORTED_MODELS.keys(),
+                        help="基础模型类型")
+    parser.add_argument("--output_dir", type=str, default="outputs",
+                        help="微调输出目录（LoRA适配器或gpu_export导出的合并模型）")
+    parser.add_argument("--resume_from_checkpoint", type=str, default=None,
+                        help="加载指定检查点的适配器")
+    parser.add_argument("--load_in_4bit", action="store_true",
+                        help="是否使用4位量化加载基础模型")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="监听地址")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="监听端口")
+    parser.add_argument("--max_batch_size", type=int, default=8,
+                        help="同时生成的最大请求数")
+    parser.add_argument("--max_new_tokens", type=int, default=512,
+                        help="请求未指定max_tokens时最多生成的token数")
+    parser.add_argument("--prefix_cache", action="store_true",
+                        help="预填充时复用系统提示词的KV缓存")
+    parser.add_argument("--answer_cache", type=str, default=None,
+                        help="问答缓存的持久化文件，指定后对重复问题直接返回缓存的回答")
+    parser.add_argument("--answer_cache_size", type=int, default=10000,
+                        help="问答缓存的条目数上限（LRU淘汰）")
+    parser.add_argument("--answer_cache_ttl", type=float, default=None,
+                        help="问答缓存条目的有效期（秒），默认不过期")
+    parser.add_argument("--answer_cache_near_duplicates", type=float, default=None,
+                        help="启用近似重复匹配的Jaccard相似度阈值（如0.8），默认只精确匹配")
+    parser.add_argument("--draft_model_type", type=str, default="qwen3-0.6b", choices=SUPPORTED_MODELS.keys(),
+                        help="投机解码的草稿模型类型")
+    parser.add_argument("--draft_output_dir", type=str, default=None,
+                        help="草稿模型的微调输出目录，指定后使用投机解码逐个处理请求")
+    parser.add_argument("--num_draft_tokens", type=int, default=4,
+                        help="投机解码每轮的草稿token数")
+    parser.add_argument("--adapters", type=str, nargs="+", default=None,
+                        help="多适配器服务：name=path 形式的LoRA适配器列表，第一个为默认适配器，请求的model字段选择适配器")
+    parser.add_argument("--max_resident_adapters", type=int, default=4,
+                        help="同时常驻内存的适配器数上限（LRU淘汰）")
+    args = parser.parse_args()
+    if args.adapters:
+        for option in ("prefix_cache", "answer_cache", "draft_output_dir"):
+            if getattr(args, option):
+                parser.error(f"--adapters 不能与 --{option} 同时使用")
+        if args.max_resident_adapters < 1:
+            parser.error("--max_resident_adapters 必须为正整数")
+        try:
+            args.adapters = parse_adapter_specs(args.adapters)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+def main():
+    from gpu_llm_finetune import build_generation_prompt, get_adapter_path, load_draft_model, load_model_for_eval
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    if args.adapters:
+        from gpu_llm_finetune import create_model_and_tokenizer
+
+        model, tokenizer = create_model_and_tokenizer(args.model_type, args.load_in_4bit)
+        adapters = AdapterManager(model, args.adapters, args.max_resident_adapters)
+        engine = ContinuousBatchingEngine(adapters.model, tokenizer, args.max_batch_size, args.max_new_tokens,
+                                          adapters=adapters)
+        web.run_app(create_app(engine, args.model_type), host=args.host, port=args.port)
+        return
+
+    model, tokenizer = load_model_for_eval(args)
+    if args.draft_output_dir:
+        draft_model, _ = load_draft_model(args, device_map={"": model.device})
+        engine = SpeculativeEngine(model, tokenizer, draft_model, args.num_draft_tokens, args.max_new_tokens)
+    else:
+        prefix_cache = get_prefix_cache(model, tokenizer, build_generation_prompt) if args.prefix_cache else None
+        engine = ContinuousBatchingEngine(model, tokenizer, args.max_batch_size, args.max_new_tokens, prefix_cache)
+    answer_cache = None
+    if args.answer_cache:
+        answer_cache = AnswerCache(
+            args.answer_cache,
+            max_entries=args.answer_cache_size,
+            ttl=args.answer_cache_ttl,
+            near_duplicates=args.answer_cache_near_duplicates is not None,
+            threshold=args.answer_cache_near_duplicates or 0.8,
+            fingerprint=adapter_fingerprint(get_adapter_path(args)),
+        )
+    web.run_app(create_app(engine, args.model_type, answer_cache), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
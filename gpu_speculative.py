@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+投机解码（speculative decoding）
+
+小模型（如微调后的Qwen3-0.6B）先连续贪心生成若干草稿token，大模型（如微调后的Qwen3-1.7B）
+一次前向同时验证全部草稿：从头开始与大模型贪心结果一致的草稿被接受，第一个不一致的位置换成大模型的token，
+全部接受时额外得到一个大模型的token。输出与大模型单独贪心解码完全相同，而大模型的前向次数
+减少为约 生成token数 / (平均接受数 + 1)。两个模型必须使用相同的分词器（Qwen3系列共用词表）。
+
+两个模型各自维护KV缓存：大模型的缓存始终覆盖除最后一个token外的全部序列，
+草稿模型的缓存覆盖其中的一段前缀，未被接受的草稿从缓存中裁掉。
+"""
+
+import time
+
+import torch
+
+def eos_token_ids(model, tokenizer):
+    """生成配置（或分词器）中的结束符集合"""
+    ids = model.generation_config.eos_token_id
+    if ids is None:
+        ids = tokenizer.eos_token_id
+    return set(ids if isinstance(ids, (list, tuple)) else [ids])
+
+class SpeculativeState:
+    """一个序列的解码状态"""
+
+    def __init__(self, tokens, target_cache, draft_cache=None, draft_length=0):
+        # 提示和已生成的全部token
+        self.tokens = tokens
+        self.target_cache = target_cache
+        self.draft_cache = draft_cache
+        # 草稿模型缓存覆盖的token数
+        self.draft_length = draft_length
+
+class SpeculativeDecoder:
+    """
+    贪心投机解码器（每次解码一个序列）
+
+    Args:
+        model: 验证用的大模型
+        draft_model: 生成草稿的小模型，词表须与大模型一致
+        num_draft_tokens: 每轮生成的草稿token数
+    """
+
+    def __init__(self, model, draft_model, num_draft_tokens=4):
+        target_vocab = model.get_output_embeddings().weight.shape[0]
+        draft_vocab = draft_model.get_output_embeddings().weight.shape[0]
+        if target_vocab != draft_vocab:
+            raise ValueError(f"草稿模型的词表大小 ({draft_vocab}) 与目标模型 ({target_vocab}) 不一致")
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.stats = {"drafted": 0, "accepted": 0, "target_forwards": 0, "generated_tokens": 0, "seconds": 0.0}
+
+    def metrics(self):
+        """草稿接受率、每次大模型前向得到的token数和生成速度"""
+        stats = self.stats
+        return {
+            **stats,
+            "acceptance_rate": stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0,
+            "tokens_per_target_forward": stats["generated_tokens"] / stats["target_forwards"]
+            if stats["target_forwards"] else 0.0,
+            "tokens_per_second": stats["generated_tokens"] / stats["seconds"] if stats["seconds"] else 0.0,
+        }
+
+    @torch.no_grad()
+    def start(self, prompt_ids):
+        """预填充提示，返回 (状态, [第一个生成的token])"""
+        start_time = time.perf_counter()
+        input_ids = torch.tensor([list(prompt_ids)], device=self.model.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        token = int(outputs.logits[0, -1].argmax())
+        state = SpeculativeState(list(prompt_ids) + [token], outputs.past_key_values)
+        self.stats["target_forwards"] += 1
+        self.stats["generated_tokens"] += 1
+        self.stats["seconds"] += time.perf_counter() - start_time
+        return state, [token]
+
+    @torch.no_grad()
+    def step(self, state):
+        """生成并验证一轮草稿，返回本轮得到的token（1 到 num_draft_tokens+1 个）"""
+        start_time = time.perf_counter()
+        tokens = state.tokens
+        num_draft = self.num_draft_tokens
+
+        # 草稿模型先补上缓存中缺少的token，再逐个贪心生成草稿
+        drafted = []
+        draft_input = tokens[state.draft_length:]
+        cache = state.draft_cache
+        for _ in range(num_draft):
+            outputs = self.draft_model(input_ids=torch.tensor([draft_input], device=self.draft_model.device),
+                                       past_key_values=cache, use_cache=True)
+            cache = outputs.past_key_values
+            draft_input = [int(outputs.logits[0, -1].argmax())]
+            drafted.extend(draft_input)
+
+        # 大模型一次前向验证：第i个位置的预测对应第i个草稿
+        input_ids = torch.tensor([[tokens[-1]] + drafted], device=self.model.device)
+        outputs = self.model(input_ids=input_ids, past_key_values=state.target_cache, use_cache=True)
+        predictions = outputs.logits[0].argmax(dim=-1).tolist()
+        accepted = 0
+        while accepted < num_draft and drafted[accepted] == predictions[accepted]:
+            accepted += 1
+        new_tokens = drafted[:accepted] + [predictions[accepted]]
+
+        # 裁掉缓存中未被接受的草稿；草稿模型的缓存不含最后一个草稿
+        length = len(tokens)
+        state.target_cache = outputs.past_key_values
+        if accepted < num_draft:
+            state.target_cache.crop(-(num_draft - accepted))
+        state.draft_length = length + min(accepted, num_draft - 1)
+        if accepted < num_draft - 1:
+            cache.crop(-(num_draft - 1 - accepted))
+        state.draft_cache = cache
+        tokens.extend(new_tokens)
+
+        self.stats["drafted"] += num_draft
+        self.stats["accepted"] += accepted
+        self.stats["target_forwards"] += 1
+        self.stats["generated_tokens"] += len(new_tokens)
+        self.stats["seconds"] += time.perf_counter() - start_time
+        return new_tokens
+
+    def generate(self, prompt_ids, max_new_tokens, eos_token_ids):
+        """
+        为一个提示贪心生成回答
+
+        Returns:
+            生成的token列表，遇到结束符（不含结束符）或达到 max_new_tokens 时截断
+        """
+        state, generated = self.start(prompt_ids)
+        while True:
+            for i, token in enumerate(generated):
+                if token in eos_token_ids:
+                    return generated[:i]
+            if len(generated) >= max_new_tokens:
+                return generated[:max_new_tokens]
+            generated = generated + self.step(state)
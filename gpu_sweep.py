@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+超参数扫描调度
+
+把一组训练配置（网格或列表）调度到可用的GPU或CPU槽位上并行运行，每个配置是一个独立的
+gpu_llm_finetune.py 进程，输出到各自的目录。总耗时取决于硬件数量，而不是所有运行时间之和。
+
+- 所有运行共用同一个缓存目录；开始前先按（数据集、分词器、最大长度）各预处理一次，
+  分词器相同的模型（如两个Qwen3模型）命中同一份缓存，运行中不再重复分词
+- 输出目录中已有参数一致的 training_params.json 且已有结果（评估结果或适配器权重）的配置直接跳过，
+  中断后重新运行同一扫描只会补跑未完成的配置
+- 全部结束后汇总各运行的训练/验证损失、训练吞吐量和评估指标，写入 sweep_results.{json,md}
+
+扫描配置为JSON文件:
+    {
+        "name_template": "{model_type}-gpu-assistant",
+        "base": {"dataset_path": "GPU-QA", "max_steps": 2000, "do_train": true, "do_eval": true},
+        "grid": {"model_type": ["qwen3-1.7b", "qwen3-0.6b"], "lora_rank": [8, 16]},
+        "runs": [{"learning_rate": 5e-5}, {"learning_rate": 1e-4, "max_seq_length": 512}]
+    }
+runs 中的每一项叠加在 base 上，再与 grid 的全部组合做笛卡尔积；键为 gpu_llm_finetune.py 的参数名，
+布尔值对应开关参数。
+
+用法:
+    python gpu_sweep.py sweep.json --output_dir outputs/sweep --devices 0,1,2,3
+    python gpu_sweep.py --grid model_type=qwen3-1.7b,qwen3-0.6b --grid lora_rank=8,16 \\
+        --set max_steps=500 --set do_train=true --set do_eval=true --cpu_slots 2
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from gpu_checkpoint import ADAPTER_WEIGHTS_FILE
+from gpu_metrics import LOSS_METRIC_NAMES, METRIC_NAMES
+
+logger = logging.getLogger(__name__)
+
+FINETUNE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gpu_llm_finetune.py")
+
+PARAMS_FILE = "training_params.json"
+RESULTS_FILES = ["evaluation_results.json", "evaluation_summary.json"]
+LOG_FILE = "sweep.log"
+
+# torchrun 多卡运行时各槽位使用不同的主端口
+BASE_MASTER_PORT = 29500
+
+def parse_value(text):
+    """命令行中的取值：能按JSON解析的（数字、true/false、null）按JSON解析，否则为字符串"""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+def expand_configs(base=None, grid=None, runs=None):
+    """runs 中每一项叠加在 base 上，再与 grid 的全部取值组合做笛卡尔积，返回配置字典列表"""
+    base = base or {}
+    grid = grid or {}
+    keys = list(grid)
+    configs = []
+    for run in runs or [{}]:
+        for values in itertools.product(*(grid[key] for key in keys)):
+            configs.append({**base, **run, **dict(zip(keys, values))})
+    return configs
+
+def config_to_argv(config):
+    """配置字典转换为 gpu_llm_finetune.py 的命令行参数：True为开关，False和None省略"""
+    argv = []
+    for key, value in config.items():
+        if value is None or value is False:
+            continue
+        argv.append(f"--{key}")
+        if value is not True:
+            argv.append(str(value))
+    return argv
+
+def _format_value(value):
+    return str(value).replace(os.sep, "_")
+
+def run_names(configs, template=None):
+    """
+    各配置的运行名称（也是输出子目录名）
+
+    未指定模板时由取值不同的参数组成，如 qwen3-1.7b-lora_rank8-learning_rate5e-05；名称重复时报错。
+    """
+    if template is not None:
+        names = [template.format(**config) for config in configs]
+    else:
+        keys = sorted({key for config in configs for key in config})
+        varying = [key for key in keys
+                   if len({json.dumps(config.get(key), sort_keys=True) for config in configs}) > 1]
+        if "model_type" in varying:
+            varying.remove("model_type")
+            varying.insert(0, "model_type")
+        names = []
+        for config in configs:
+            parts = [_format_value(config[key]) if key == "model_type" else f"{key}{_format_value(config[key])}"
+                     for key in varying if config.get(key) is not None]
+            names.append("-".join(parts) or "run")
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"运行名称重复: {', '.join(duplicates)}，请修改 name_template")
+    return names
+
+class Run:
+    """扫描中的一次训练运行"""
+
+    def __init__(self, name, config, argv, args):
+        self.name = name
+        self.config = config
+        self.argv = argv
+        self.args = args
+        self.status = "pending"
+        self.returncode = None
+        self.seconds = None
+        self.slot = None
+
+    @property
+    def output_dir(self):
+        return self.args.output_dir
+
+def build_runs(configs, output_dir, cache_dir=None, template=None):
+    """
+    为每个配置确定输出目录和共享的缓存目录，并用 gpu_llm_finetune 的参数解析检查全部配置
+
+    配置中没有 output_dir 时输出到 output_dir/<运行名称>，没有 cache_dir 时共用 cache_dir（默认 output_dir/cache）。
+    """
+    from gpu_llm_finetune import parse_args as parse_finetune_args
+
+    cache_dir = cache_dir or os.path.join(output_dir, "cache")
+    runs = []
+    for name, config in zip(run_names(configs, template), configs):
+        config = {"output_dir": os.path.join(output_dir, name), "cache_dir": cache_dir, **config}
+        argv = config_to_argv(config)
+        try:
+            args = parse_finetune_args(argv)
+        except SystemExit:
+            raise ValueError(f"运行 {name} 的配置无效: {' '.join(argv)}")
+        runs.append(Run(name, config, argv, args))
+    output_dirs = [run.output_dir for run in runs]
+    if len(set(output_dirs)) != len(output_dirs):
+        raise ValueError("多个运行使用了相同的 output_dir")
+    return runs
+
+def is_complete(run):
+    """输出目录中已有参数一致的 training_params.json 和该运行应产生的结果"""
+    params_file = os.path.join(run.output_dir, PARAMS_FILE)
+    if not os.path.isfile(params_file):
+        return False
+    with open(params_file, "r", encoding="utf-8") as f:
+        params = json.load(f)
+    # 只比较参数文件中有的键，新版本脚本增加的参数不使旧结果失效
+    current = json.loads(json.dumps(vars(run.args)))
+    if any(current.get(key, value) != value for key, value in params.items()):
+        logger.info(f"{run.name}: {params_file} 与当前配置不一致，重新运行")
+        return False
+    if run.args.do_eval:
+        return any(os.path.isfile(os.path.join(run.output_dir, name)) for name in RESULTS_FILES)
+    if run.args.do_train:
+        return os.path.isfile(os.path.join(run.output_dir, ADAPTER_WEIGHTS_FILE))
+    return True
+
+def prepare_datasets(runs):
+    """
+    按（数据集、模型类型、最大长度、缓存目录）预处理一次训练集和验证集，写入共享缓存
+
+    分词器相同的模型得到相同的缓存键，只有第一个真正分词。
+    """
+    from gpu_llm_finetune import load_preprocessed_dataset, load_tokenizer
+
+    tokenizers = {}
+    prepared = set()
+    for run in runs:
+        args = run.args
+        key = (args.dataset_path, args.model_type, args.max_seq_length, args.cache_dir)
+        if not args.do_train or key in prepared:
+            continue
+        prepared.add(key)
+        if args.model_type not in tokenizers:
+            tokenizers[args.model_type] = load_tokenizer(args.model_type)
+        cache_args = Namespace(max_seq_length=args.max_seq_length, cache_dir=args.cache_dir, output_dir=args.output_dir)
+        for split in ("train", "validation"):
+            load_preprocessed_dataset(args.dataset_path, split, tokenizers[args.model_type], cache_args)
+
+def detect_slots(devices=None, devices_per_run=1, cpu_slots=1):
+    """
+    运行槽位：每个槽位是一组GPU编号（元组），CPU槽位为空元组
+
+    devices 为 "cpu" 时只用CPU，为逗号分隔的GPU编号时使用这些GPU，为None时使用全部可见GPU，没有GPU时使用CPU。
+    """
+    if devices is None:
+        import torch
+
+        devices = ",".join(str(i) for i in range(torch.cuda.device_count())) or "cpu"
+        # 子进程的 CUDA_VISIBLE_DEVICES 要用物理编号
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        if devices != "cpu" and visible:
+            devices = ",".join(visible.split(",")[:torch.cuda.device_count()])
+    if devices == "cpu":
+        return [()] * cpu_slots
+    ids = [d.strip() for d in devices.split(",") if d.strip()]
+    if len(ids) < devices_per_run:
+        raise ValueError(f"可用GPU数 ({len(ids)}) 少于每个运行所需的GPU数 ({devices_per_run})")
+    return [tuple(ids[i:i + devices_per_run]) for i in range(0, len(ids) - devices_per_run + 1, devices_per_run)]
+
+def run_command(run, slot, slot_index, threads=1, script=FINETUNE_SCRIPT):
+    """运行在槽位上的命令和环境变量：单卡或CPU直接启动，多卡用 torchrun 启动；CPU槽位限制线程数为 threads"""
+    env = dict(os.environ)
+    env["CUDA_VISIBLE_DEVICES"] = ",".join(slot)
+    if not slot:
+        env["OMP_NUM_THREADS"] = str(threads)
+    if len(slot) > 1:
+        command = [sys.executable, "-m", "torch.distributed.run", "--nproc_per_node", str(len(slot)),
+                   "--master_port", str(BASE_MASTER_PORT + slot_index), script, *run.argv]
+    else:
+        command = [sys.executable, script, *run.argv]
+    return command, env
+
+def _execute(run, slot, slot_index, threads, script):
+    command, env = run_command(run, slot, slot_index, threads, script)
+    os.makedirs(run.output_dir, exist_ok=True)
+    device = f"GPU {','.join(slot)}" if slot else "CPU"
+    logger.info(f"开始运行 {run.name}（{device}），日志: {os.path.join(run.output_dir, LOG_FILE)}")
+    start_time = time.perf_counter()
+    with open(os.path.join(run.output_dir, LOG_FILE), "w", encoding="utf-8") as log:
+        run.returncode = subprocess.run(command, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    run.seconds = time.perf_counter() - start_time
+    run.slot = device
+    run.status = "done" if run.returncode == 0 else "failed"
+    level = logging.INFO if run.returncode == 0 else logging.ERROR
+    logger.log(level, f"{run.name} 结束，退出码 {run.returncode}，用时 {run.seconds:.1f}s")
+
+def run_sweep(runs, slots, prepare=True, script=FINETUNE_SCRIPT):
+    """
+    跳过已完成的运行，其余运行按顺序分配到空闲槽位上并行执行
+
+    Args:
+        runs: build_runs 返回的运行列表
+        slots: detect_slots 返回的槽位列表，同时运行的进程数等于槽位数
+        prepare: 开始前是否预处理共享的数据集缓存
+        script: 训练脚本
+
+    Returns:
+        runs，各运行的 status 为 done/failed/skipped
+    """
+    pending = []
+    for run in runs:
+        if is_complete(run):
+            run.status = "skipped"
+            logger.info(f"{run.name} 已有结果，跳过")
+        else:
+            pending.append(run)
+    if not pending:
+        return runs
+    if prepare:
+        prepare_datasets(pending)
+
+    # CPU槽位平分CPU线程
+    cpu_slots = sum(1 for slot in slots if not slot)
+    threads = max(1, (os.cpu_count() or 1) // max(1, cpu_slots))
+    free_slots = queue.Queue()
+    for slot_index, slot in enumerate(slots):
+        free_slots.put((slot_index, slot))
+
+    def worker(run):
+        slot_index, slot = free_slots.get()
+        try:
+            _execute(run, slot, slot_index, threads, script)
+        finally:
+            free_slots.put((slot_index, slot))
+
+    logger.info(f"共 {len(runs)} 个配置，{len(pending)} 个待运行，{len(slots)} 个槽位")
+    with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+        for future in [executor.submit(worker, run) for run in pending]:
+            future.result()
+    return runs
+
+def _last_logged(log_history, key):
+    values = [entry[key] for entry in log_history if key in entry]
+    return values[-1] if values else None
+
+def _trainer_log_history(output_dir):
+    """最后一个检查点的 trainer_state.json 中的日志记录"""
+    checkpoints = []
+    if os.path.isdir(output_dir):
+        checkpoints = [name for name in os.listdir(output_dir)
+                       if name.startswith("checkpoint-") and name.split("-")[-1].isdigit()]
+    if not checkpoints:
+        return []
+    latest = max(checkpoints, key=lambda name: int(name.split("-")[-1]))
+    state_file = os.path.join(output_dir, latest, "trainer_state.json")
+    if not os.path.isfile(state_file):
+        return []
+    with open(state_file, "r", encoding="utf-8") as f:
+        return json.load(f).get("log_history", [])
+
+def _training_throughput(output_dir):
+    """training_metrics.jsonl 中整个训练过程的真实tokens/s"""
+    path = os.path.join(output_dir, "training_metrics.jsonl")
+    if not os.path.isfile(path):
+        return None
+    tokens = seconds = 0.0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                tokens += record["real_tokens"]
+                seconds += record["step_time"]
+    return tokens / seconds if seconds else None
+
+# 比较表中的评估指标列：生成评估的ROUGE/BLEU和损失评估（--eval_mode loss）的NLL/困惑度
+EVAL_COLUMNS = list(METRIC_NAMES) + list(LOSS_METRIC_NAMES)
+
+def _evaluation_averages(output_dir):
+    """evaluation_summary.json（流式评估、损失评估）或 evaluation_results.json 中的平均分"""
+    summary_file = os.path.join(output_dir, "evaluation_summary.json")
+    if os.path.isfile(summary_file):
+        with open(summary_file, "r", encoding="utf-8") as f:
+            summary = json.load(f)
+        return {name: summary.get(name) for name in EVAL_COLUMNS}
+    results_file = os.path.join(output_dir, "evaluation_results.json")
+    if os.path.isfile(results_file):
+        with open(results_file, "r", encoding="utf-8") as f:
+            results = json.load(f)
+        if results:
+            return {name: float(np.mean([r[name] for r in results])) if name in results[0] else None
+                    for name in EVAL_COLUMNS}
+    return {name: None for name in EVAL_COLUMNS}
+
+def collect_results(runs):
+    """每个运行一行：状态、配置中取值不同的参数、损失、吞吐量和评估指标"""
+    keys = sorted({key for run in runs for key in run.config if key not in ("output_dir", "cache_dir")})
+    varying = [key for key in keys
+               if len({json.dumps(run.config.get(key), sort_keys=True) for run in runs}) > 1]
+    rows = []
+    for run in runs:
+        log_history = _trainer_log_history(run.output_dir)
+        rows.append({
+            "run": run.name,
+            "status": run.status,
+            **{key: run.config.get(key) for key in varying},
+            "train_loss": _last_logged(log_history, "loss"),
+            "eval_loss": _last_logged(log_history, "eval_loss"),
+            "tokens_per_second": _training_throughput(run.output_dir),
+            **_evaluation_averages(run.output_dir),
+            "seconds": run.seconds,
+            "output_dir": run.output_dir,
+        })
+    return rows
+
+def format_table(rows):
+    """Markdown表格，只包含至少有一个运行有值的列"""
+    if not rows:
+        return ""
+    columns = []
+    for row in rows:
+        for key in row:
+            if key not in columns and key != "output_dir" and any(r.get(key) is not None for r in rows):
+                columns.append(key)
+
+    def cell(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.4g}"
+        return str(value)
+
+    lines = ["| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+    lines += ["| " + " | ".join(cell(row.get(key)) for key in columns) + " |" for row in rows]
+    return "\n".join(lines)
+
+def write_results(rows, output_dir):
+    """把比较表写入 output_dir/sweep_results.json 和 sweep_results.md，返回Markdown表格"""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "sweep_results.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    table = format_table(rows)
+    with open(os.path.join(output_dir, "sweep_results.md"), "w", encoding="utf-8") as f:
+        f.write(table + "\n")
+    return table
+
+def load_sweep_config(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _parse_assignments(items, split_values):
+    result = {}
+    for item in items or []:
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            raise ValueError(f"参数 {item!r} 应为 key=value")
+        result[key] = [parse_value(v) for v in value.split(",")] if split_values else parse_value(value)
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="并行运行gpu_llm_finetune.py的超参数扫描并汇总比较")
+    parser.add_argument("config", nargs="?", default=None,
+                        help="扫描配置JSON文件（包含 base/grid/runs/name_template）")
+    parser.add_argument("--grid", action="append", default=None,
+                        help="网格参数 key=v1,v2,...，可重复指定，覆盖配置文件中的同名网格")
+    parser.add_argument("--set", action="append", default=None, dest="overrides",
+                        help="所有运行共用的参数 key=value，可重复指定，覆盖配置文件中的 base")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="扫描输出目录，各运行输出到其下的子目录（默认取配置文件的 output_dir，否则为 outputs/sweep）")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="所有运行共用的预处理缓存目录，默认 output_dir/cache")
+    parser.add_argument("--name_template", type=str, default=None,
+                        help="运行名称模板，如 {model_type}-gpu-assistant")
+    parser.add_argument("--devices", type=str, default=None,
+                        help="使用的GPU编号（如 0,1,2,3），cpu表示只用CPU；默认使用全部可见GPU")
+    parser.add_argument("--devices_per_run", type=int, default=1,
+                        help="每个运行使用的GPU数，大于1时用torchrun数据并行")
+    parser.add_argument("--cpu_slots", type=int, default=1,
+                        help="没有GPU时同时运行的进程数，各进程平分CPU线程")
+    parser.add_argument("--no_prepare", action="store_true",
+                        help="不预先生成共享的预处理缓存")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="只列出各运行的命令和是否跳过，不运行")
+    args = parser.parse_args(argv)
+    if args.devices_per_run < 1:
+        parser.error("--devices_per_run 必须为正整数")
+    if args.cpu_slots < 1:
+        parser.error("--cpu_slots 必须为正整数")
+    try:
+        args.grid = _parse_assignments(args.grid, split_values=True)
+        args.overrides = _parse_assignments(args.overrides, split_values=False)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.config is None and not args.grid and not args.overrides:
+        parser.error("需要扫描配置文件或 --grid/--set 参数")
+    return args
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+    sweep = load_sweep_config(args.config) if args.config else {}
+    output_dir = args.output_dir or sweep.get("output_dir") or os.path.join("outputs", "sweep")
+    configs = expand_configs(
+        {**sweep.get("base", {}), **args.overrides},
+        {**sweep.get("grid", {}), **args.grid},
+        sweep.get("runs"),
+    )
+    runs = build_runs(configs, output_dir, args.cache_dir or sweep.get("cache_dir"),
+                      args.name_template or sweep.get("name_template"))
+
+    if args.dry_run:
+        for run in runs:
+            state = "跳过" if is_complete(run) else "运行"
+            print(f"[{state}] {run.name}: python gpu_llm_finetune.py {' '.join(run.argv)}")
+        return 0
+
+    slots = detect_slots(args.devices, args.devices_per_run, args.cpu_slots)
+    start_time = time.perf_counter()
+    run_sweep(runs, slots, prepare=not args.no_prepare)
+    table = write_results(collect_results(runs), output_dir)
+    print(table)
+    logger.info(f"扫描完成，用时 {time.perf_counter() - start_time:.1f}s，比较表已保存到 "
+                f"{os.path.join(output_dir, 'sweep_results.md')}")
+    return 1 if any(run.status == "failed" for run in runs) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
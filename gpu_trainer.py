@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPU-QA训练器
+在TRL的SFTTrainer上增加按长度分桶采样、分块交叉熵、填充率日志和吞吐量计时
+
+单独成模块，使 gpu_llm_finetune 只在训练时才导入torch、transformers和trl。
+"""
+
+import copy
+import logging
+import os
+import time
+
+import torch
+from peft import PeftModel, get_peft_model_state_dict
+from transformers import Trainer
+from transformers.trainer import TRAINER_STATE_NAME, TRAINING_ARGS_NAME
+from transformers.trainer_callback import ExportableState
+from trl import SFTTrainer
+
+from gpu_batching import LengthBucketSampler, PaddingStatsCollator, dataset_lengths
+from gpu_checkpoint import (ADAPTER_WEIGHTS_FILE, OPTIMIZER_FILE, SCALER_FILE, SCHEDULER_FILE, AsyncCheckpointer,
+                            rotate_checkpoints, snapshot)
+from gpu_chunked_loss import chunked_lm_loss
+
+logger = logging.getLogger(__name__)
+
+class GPUQATrainer(SFTTrainer):
+    """
+    GPU-QA训练器
+    
+    在SFTTrainer基础上支持按长度分桶采样（--group_by_length_buckets），
+    并在每次日志中记录该区间内的填充率（真实token数 / 填充后token数）。
+    开启 chunked_loss 时按块计算LM head与交叉熵（--chunked_loss），见 gpu_chunked_loss。
+    传入 training_metrics（见 gpu_training_metrics）时记录每步的数据加载、前向和反向耗时及token数。
+    async_checkpoints 时检查点只保存适配器和训练状态，由后台线程写盘（见 gpu_checkpoint）；
+    keep_last_checkpoints 限制保留的检查点数，验证损失最好的检查点总是保留。
+    """
+    
+    def __init__(self, *args, group_by_length_buckets=False, chunked_loss=False, loss_chunk_size=1024,
+                 training_metrics=None, async_checkpoints=False, keep_last_checkpoints=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.group_by_length_buckets = group_by_length_buckets
+        self.chunked_loss = chunked_loss
+        self.loss_chunk_size = loss_chunk_size
+        self.data_collator = PaddingStatsCollator(self.data_collator)
+        self.training_metrics = training_metrics
+        if training_metrics is not None:
+            self.add_callback(training_metrics)
+        self.keep_last_checkpoints = keep_last_checkpoints
+        self.checkpointer = None
+        self.checkpoint_steps = set()
+        if async_checkpoints:
+            if self.args.world_size > 1:
+                # 每个进程都有自己的随机数状态要写入检查点，数据并行时使用Trainer的同步保存
+                logger.warning("数据并行训练时检查点使用同步保存")
+            elif not isinstance(self.accelerator.unwrap_model(self.model), PeftModel):
+                logger.warning("模型不是PeftModel，检查点使用同步保存")
+            else:
+                self.checkpointer = AsyncCheckpointer(self.args.output_dir, keep_last_checkpoints)
+    
+    def _get_train_sampler(self, train_dataset=None):
+        if not self.group_by_length_buckets:
+            return super()._get_train_sampler(train_dataset)
+        train_dataset = train_dataset if train_dataset is not None else self.train_dataset
+        return LengthBucketSampler(
+            dataset_lengths(train_dataset),
+            self._train_batch_size,
+            seed=self.args.seed
+        )
+    
+    def _get_eval_sampler(self, eval_dataset):
+        if not self.group_by_length_buckets or self.args.world_size > 1:
+            return super()._get_eval_sampler(eval_dataset)
+        return LengthBucketSampler(dataset_lengths(eval_dataset), self.args.eval_batch_size, shuffle=False)
+    
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        if self.training_metrics is None:
+            return super().get_batch_samples(epoch_iterator, num_batches, device)
+        with self.training_metrics.timed("dataloader"):
+            batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        self.training_metrics.add_batches(batch_samples)
+        return batch_samples, num_items_in_batch
+    
+    def training_step(self, model, inputs, num_items_in_batch=None):
+        if self.training_metrics is None:
+            return super().training_step(model, inputs, num_items_in_batch)
+        with self.training_metrics.timed("forward_backward"):
+            return super().training_step(model, inputs, num_items_in_batch)
+    
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        if self.training_metrics is not None and model.training:
+            with self.training_metrics.timed("forward"):
+                return self._compute_loss(model, inputs, return_outputs, num_items_in_batch)
+        return self._compute_loss(model, inputs, return_outputs, num_items_in_batch)
+    
+    def _compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        if not self.chunked_loss:
+            if not torch.cuda.is_available():
+                # 新版SFTTrainer的默认损失依赖Triton内核，CPU上（如gloo多进程测试）使用Trainer的默认损失
+                return Trainer.compute_loss(self, model, inputs, return_outputs=return_outputs,
+                                            num_items_in_batch=num_items_in_batch)
+            return super().compute_loss(model, inputs, return_outputs=return_outputs,
+                                        num_items_in_batch=num_items_in_batch)
+        # 分块损失不产生完整logits，因此不记录SFTTrainer基于logits的token准确率等指标
+        loss, outputs = chunked_lm_loss(model, inputs, chunk_size=self.loss_chunk_size,
+                                        num_items_in_batch=num_items_in_batch)
+        if self.args.average_tokens_across_devices and self.model_accepts_loss_kwargs \
+                and num_items_in_batch is not None:
+            # 与 Trainer.compute_loss 相同：num_items_in_batch 是所有进程的token总数，
+            # DDP对梯度取平均，因此乘回进程数，使损失和梯度与单进程按token平均一致
+            loss_scale = self.accelerator.num_processes // self.get_tp_size()
+            loss *= loss_scale if self.args.n_gpu <= 1 else self.args.n_gpu
+        return (loss, outputs) if return_outputs else loss
+    
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            # 训练结束（或出错）时等待最后一个检查点写完
+            if self.checkpointer is not None:
+                self.checkpointer.wait()
+    
+    def _load_best_model(self):
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        super()._load_best_model()
+    
+    def _best_checkpoint_step(self):
+        """验证损失最好且保存了检查点的步数"""
+        best_step = self.state.best_global_step
+        return best_step if best_step and best_step in self.checkpoint_steps else None
+    
+    def _save_checkpoint(self, model, trial):
+        if self.checkpointer is None:
+            super()._save_checkpoint(model, trial)
+            self.checkpoint_steps.add(self.state.global_step)
+            if self.args.should_save and self.keep_last_checkpoints:
+                rotate_checkpoints(self._get_output_dir(trial), self.keep_last_checkpoints, self._best_checkpoint_step())
+            return
+        
+        start_time = time.perf_counter()
+        checkpointer = self.checkpointer
+        step = self.state.global_step
+        self.store_flos()
+        self.checkpoint_steps.add(step)
+        
+        # 分词器和训练参数整个训练中不变，只写一次，各检查点硬链接引用
+        if not checkpointer.has_shared_files():
+            def write_shared(directory):
+                if self.processing_class is not None:
+                    self.processing_class.save_pretrained(directory)
+                torch.save(self.args, os.path.join(directory, TRAINING_ARGS_NAME))
+            checkpointer.write_shared_files(write_shared)
+        
+        # 快照：训练继续更新参数和优化器状态，不影响后台写入的内容
+        peft_model = self.accelerator.unwrap_model(self.model)
+        adapter_name = peft_model.active_adapter
+        tensors = {ADAPTER_WEIGHTS_FILE: snapshot(get_peft_model_state_dict(peft_model, adapter_name=adapter_name))}
+        objects = {
+            OPTIMIZER_FILE: snapshot(self.optimizer.state_dict()),
+            SCHEDULER_FILE: snapshot(self.lr_scheduler.state_dict()),
+        }
+        scaler = getattr(self.accelerator, "scaler", None)
+        if scaler is not None:
+            objects[SCALER_FILE] = snapshot(scaler.state_dict())
+        adapter_config = copy.deepcopy(peft_model.peft_config[adapter_name])
+        adapter_config.inference_mode = True
+        
+        # 随机数状态和trainer_state.json很小，直接写入临时目录
+        staging = checkpointer.staging_dir(step)
+        os.makedirs(staging, exist_ok=True)
+        self._save_rng_state(staging)
+        best_step = self._best_checkpoint_step()
+        if best_step is not None:
+            self.state.best_model_checkpoint = checkpointer.checkpoint_dir(best_step)
+        for callback in self.callback_handler.callbacks + [self.control]:
+            if isinstance(callback, ExportableState):
+                name = callback.__class__.__name__
+                if isinstance(self.state.stateful_callbacks[name], list):
+                    self.state.stateful_callbacks[name].append(callback.state())
+                else:
+                    self.state.stateful_callbacks[name] = callback.state()
+        self.state.save_to_json(os.path.join(staging, TRAINER_STATE_NAME))
+        
+        checkpointer.save(step, tensors, objects, adapter_config.save_pretrained, best_step)
+        logger.info(f"第{step}步检查点快照用时 {time.perf_counter() - start_time:.3f}s，后台写入中")
+    
+    def log(self, logs, start_time=None):
+        # 训练日志先于评估记录，两者的填充率自然分开统计
+        efficiency = self.data_collator.pop_efficiency()
+        if efficiency is not None:
+            key = "eval_padding_efficiency" if any(k.startswith("eval_") for k in logs) else "padding_efficiency"
+            logs[key] = round(efficiency, 4)
+        super().log(logs, start_time)
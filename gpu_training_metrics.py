@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练吞吐量监控
+
+以Trainer回调的形式记录每个优化步的：
+- 真实token数/秒与填充后token数/秒，以及填充比例
+- 时间分解：等待数据加载、前向、反向、优化器更新，其余（日志、评估、保存检查点等）记为other
+- 该步的峰值显存（CPU上为进程的峰值常驻内存）
+- 模型FLOPs利用率（MFU），由模型参数量和序列长度估算
+
+每步一条记录写入 output_dir 下的 training_metrics.jsonl（或 .csv），可选通过HTTP以Prometheus文本格式暴露最新值。
+从头开始训练时清空已有的指标文件，从检查点恢复时接着追加。数据并行时每个进程统计自己的批次，由0号进程写文件。
+
+GPU上默认只在优化步的边界同步CUDA，步耗时和吞吐量准确，而不打断每个微批次的计算；此时各阶段的耗时
+（CUDA异步执行，主机侧计时没有意义）记为空。detailed_timing 时在每个阶段边界同步，得到完整的时间分解，
+但同步本身会拖慢训练。CPU上不需要同步，总是记录时间分解。
+"""
+
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from transformers import TrainerCallback
+
+from gpu_distributed import get_world_size, is_main_process
+
+logger = logging.getLogger(__name__)
+
+# 常见GPU的稠密bf16/fp16 Tensor Core峰值算力（TFLOPS），按名称子串匹配，较长的名称优先
+PEAK_TFLOPS = {
+    "H100": 989.0,
+    "H800": 989.0,
+    "A100": 312.0,
+    "A800": 312.0,
+    "L40S": 362.0,
+    "L40": 181.0,
+    "L4": 121.0,
+    "A10G": 70.0,
+    "A10": 125.0,
+    "RTX 4090": 165.0,
+    "RTX 3090": 71.0,
+    "V100": 125.0,
+    "T4": 65.0,
+}
+
+# 记录的字段（CSV的列顺序）
+FIELDS = [
+    "step", "time", "world_size", "step_time", "dataloader_time", "forward_time", "backward_time",
+    "optimizer_time", "other_time", "real_tokens", "padded_tokens", "padding_ratio",
+    "real_tokens_per_second", "padded_tokens_per_second", "peak_memory_mb", "tflops", "mfu",
+]
+
+def peak_device_tflops():
+    """当前GPU的峰值算力（TFLOPS），CPU或未知型号返回None"""
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    for key in sorted(PEAK_TFLOPS, key=len, reverse=True):
+        if key in name:
+            return PEAK_TFLOPS[key]
+    return None
+
+def model_flops_per_token(model, seq_length):
+    """
+    训练时每个token的模型FLOPs估算
+
+    矩阵乘法的前向为 2N；反向对激活求梯度 2N，只有可训练参数（LoRA）再对权重求梯度 2N。
+    注意力的 QK^T 与 AV 每层前向为 4·seq_length·hidden，前向加反向共三倍。
+    不计梯度检查点的重算，与MFU的惯例一致。词嵌入查表不是矩阵乘法，不计入；LM head计入（与词嵌入共享权重时同样计入）。
+    """
+    embedding = model.get_input_embeddings().weight
+    frozen = trainable = 0
+    for parameter in model.parameters():
+        if parameter is embedding:
+            continue
+        if parameter.requires_grad:
+            trainable += parameter.numel()
+        else:
+            frozen += parameter.numel()
+    output_embedding = model.get_output_embeddings().weight
+    if output_embedding is embedding:
+        frozen += embedding.numel()
+
+    config = model.config
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    attention = 12 * config.num_hidden_layers * config.num_attention_heads * head_dim * seq_length
+    return 4 * frozen + 6 * trainable + attention
+
+def peak_memory_mb():
+    """本步的峰值显存（并重置统计）；CPU上为进程至今的峰值常驻内存，没有 resource 模块（Windows）时为None"""
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+        torch.cuda.reset_peak_memory_stats()
+        return peak
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux上ru_maxrss的单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TrainingMetricsCallback(TrainerCallback):
+    """
+    训练吞吐量监控回调
+
+    数据加载、前向和反向的计时由 GPUQATrainer 调用 timed() 记录，批次的token数由 add_batches() 记录，
+    优化器计时和每步汇总在回调事件中完成。
+
+    Args:
+        model: 训练的模型（用于估算FLOPs）
+        output_dir: 指标文件所在目录
+        pad_token_id: 填充token，没有attention_mask的打包批次按它统计真实token数
+        metrics_format: jsonl、csv 或 none（不写文件）
+        prometheus_port: 指定时在该端口提供 /metrics（Prometheus文本格式）
+        prometheus_host: /metrics 的监听地址，默认只监听本机
+        peak_tflops: 设备峰值算力，默认按GPU型号查表，未知时不计算MFU
+        run_name: Prometheus指标的run标签，用于区分不同配置
+        detailed_timing: GPU上在每个阶段边界同步CUDA，记录数据加载、前向、反向和优化器的时间分解
+    """
+
+    def __init__(self, model, output_dir, pad_token_id, metrics_format="jsonl", prometheus_port=None,
+                 peak_tflops=None, run_name=None, prometheus_host="127.0.0.1", detailed_timing=False):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.metrics_format = metrics_format
+        self.path = None if metrics_format == "none" else os.path.join(output_dir, f"training_metrics.{metrics_format}")
+        self.prometheus_port = prometheus_port
+        self.prometheus_host = prometheus_host
+        self.peak_tflops = peak_tflops if peak_tflops is not None else peak_device_tflops()
+        self.run_name = run_name or os.path.basename(os.path.normpath(output_dir))
+        self.breakdown = detailed_timing or not torch.cuda.is_available()
+        self.flops_per_token = {}
+        self.server = None
+        self.latest = {}
+        self.totals = {"steps": 0, "real_tokens": 0, "padded_tokens": 0, "seconds": 0.0}
+        self._reset_step()
+        self.last_step_end = None
+
+    def _reset_step(self):
+        self.timings = {"dataloader": 0.0, "forward": 0.0, "forward_backward": 0.0, "optimizer": 0.0}
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.flops = 0.0
+
+    @staticmethod
+    def _now():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def timed(self, name):
+        """累计本步中某一阶段的耗时；不记录时间分解时不计时，也不同步CUDA"""
+        if not self.breakdown:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.timings[name] += self._now() - start
+
+    def add_batches(self, batches):
+        """记录一个优化步取到的全部批次的token数和FLOPs"""
+        for batch in batches:
+            input_ids = batch["input_ids"]
+            if "attention_mask" in batch:
+                real = int(batch["attention_mask"].sum())
+            else:
+                real = int(input_ids.ne(self.pad_token_id).sum())
+            seq_length = input_ids.shape[-1]
+            if seq_length not in self.flops_per_token:
+                self.flops_per_token[seq_length] = model_flops_per_token(self.model, seq_length)
+            self.real_tokens += real
+            self.padded_tokens += input_ids.numel()
+            self.flops += real * self.flops_per_token[seq_length]
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.last_step_end = self._now()
+        if not is_main_process():
+            return
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if (state is None or state.global_step == 0) and os.path.exists(self.path):
+                # 从头开始的训练不与上一次运行的记录混在一起；从检查点恢复时 global_step > 0，接着追加
+                os.remove(self.path)
+            logger.info(f"训练吞吐量指标将写入 {self.path}")
+        if self.prometheus_port is not None:
+            self.server = ThreadingHTTPServer((self.prometheus_host, self.prometheus_port), _PrometheusHandler)
+            self.server.render = self.render_prometheus
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info(f"Prometheus指标: http://{self.prometheus_host}:{self.server.server_address[1]}/metrics")
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        if self.breakdown:
+            self.optimizer_start = self._now()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self.breakdown:
+            self.timings["optimizer"] += self._now() - self.optimizer_start
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = self._now()
+        step_time = now - self.last_step_end
+        self.last_step_end = now
+
+        timings = self.timings
+        backward = max(timings["forward_backward"] - timings["forward"], 0.0)
+        measured = timings["dataloader"] + timings["forward_backward"] + timings["optimizer"]
+        tflops = self.flops / step_time / 1e12
+        record = {
+            "step": state.global_step,
+            "time": time.time(),
+            "world_size": get_world_size(),
+            "step_time": step_time,
+            "dataloader_time": timings["dataloader"] if self.breakdown else None,
+            "forward_time": timings["forward"] if self.breakdown else None,
+            "backward_time": backward if self.breakdown else None,
+            "optimizer_time": timings["optimizer"] if self.breakdown else None,
+            "other_time": max(step_time - measured, 0.0) if self.breakdown else None,
+            "real_tokens": self.real_tokens,
+            "padded_tokens": self.padded_tokens,
+            "padding_ratio": 1 - self.real_tokens / self.padded_tokens if self.padded_tokens else 0.0,
+            "real_tokens_per_second": self.real_tokens / step_time,
+            "padded_tokens_per_second": self.padded_tokens / step_time,
+            "peak_memory_mb": peak_memory_mb(),
+            "tflops": tflops,
+            "mfu": tflops / self.peak_tflops if self.peak_tflops else None,
+        }
+        self.latest = record
+        self.totals["steps"] += 1
+        self.totals["real_tokens"] += self.real_tokens
+        self.totals["padded_tokens"] += self.padded_tokens
+        self.totals["seconds"] += step_time
+        self._reset_step()
+        if is_main_process() and self.path is not None:
+            self._write(record)
+
+    def _write(self, record):
+        if self.metrics_format == "csv":
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, "a", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(record)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        """整个训练过程的平均吞吐量"""
+        seconds = self.totals["seconds"]
+        padded = self.totals["padded_tokens"]
+        return {
+            **self.totals,
+            "real_tokens_per_second": self.totals["real_tokens"] / seconds if seconds else 0.0,
+            "padded_tokens_per_second": padded / seconds if seconds else 0.0,
+            "padding_ratio": 1 - self.totals["real_tokens"] / padded if padded else 0.0,
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if is_main_process() and self.totals["steps"]:
+            summary = self.summary()
+            logger.info(f"训练吞吐量: {summary['real_tokens_per_second']:.1f} 真实tokens/s，"
+                        f"{summary['padded_tokens_per_second']:.1f} 填充后tokens/s，"
+                        f"填充比例 {summary['padding_ratio']:.2%}")
+
+    def render_prometheus(self):
+        """最新一步的指标及累计计数，Prometheus文本格式"""
+        labels = f'{{run="{self.run_name}"}}'
+        lines = []
+        for name in FIELDS[3:]:
+            value = self.latest.get(name)
+            if value is None:
+                continue
+            metric = f"gpu_qa_train_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{labels} {value}")
+        for name in ("steps", "real_tokens", "padded_tokens"):
+            metric = f"gpu_qa_train_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{labels} {self.totals[name]}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查点评估监视器
+
+训练过程中轮询 output_dir 下新出现的 checkpoint-N，在独立的评估工作进程中对验证集（--eval_split）的
+一个固定子集生成回答并打分（--eval_mode loss 时只计算参考答案的NLL/困惑度，开销小得多），维护按步数排列的
+ROUGE/BLEU/NLL/验证损失排行榜。训练结束时各检查点已评估完毕，不需要在训练后再逐个评估来挑选检查点。
+
+- 评估工作进程只加载一次基础模型，各检查点的LoRA适配器由 AdapterManager 依次加载和卸载
+- 检查点目录是原子地改名出现的（见 gpu_checkpoint），只评估完整的检查点；发现后立即把适配器文件
+  硬链接到 output_dir/checkpoint_eval/checkpoint-N，评估期间训练的保留策略删除原检查点也不受影响
+- 验证损失取自检查点 trainer_state.json 中训练时同一步的 eval_loss
+- 排行榜写入 output_dir/checkpoint_leaderboard.{json,md}；每个检查点的逐条结果写入
+  checkpoint_eval/checkpoint-N/evaluation_results.json，格式与 gpu_llm_finetune.py 相应评估方式的结果相同
+- 指定 --promote 时把排名第一的检查点的适配器保存到 output_dir/best_checkpoint，
+  可直接用 --resume_from_checkpoint 评估或导出
+- 挑选检查点默认使用验证集，测试集留给最终报告，避免用同一份数据既选模型又报告结果
+- 重新启动时跳过排行榜中已评估的检查点；训练保存最终模型后评估完剩余检查点即退出，
+  超过 --idle_timeout 秒既没有新检查点也没有最终模型（训练可能已中断）时同样退出
+
+用法:
+    python gpu_watcher.py --output_dir outputs/qwen3-1.7b-gpu-assistant --eval_subset 50 --promote
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+
+from gpu_checkpoint import ADAPTER_WEIGHTS_FILE, link_or_copy, list_checkpoints
+from gpu_metrics import LOSS_METRIC_NAMES, METRIC_NAMES
+
+logger = logging.getLogger(__name__)
+
+PARAMS_FILE = "training_params.json"
+LEADERBOARD_FILE = "checkpoint_leaderboard"
+EVAL_DIR = "checkpoint_eval"
+PROMOTED_DIR = "best_checkpoint"
+ADAPTER_SUBDIR = "adapter"
+
+# 可用于排名的指标，损失和困惑度越小越好，其余越大越好
+RANK_METRICS = list(METRIC_NAMES) + list(LOSS_METRIC_NAMES) + ["eval_loss"]
+LOWER_IS_BETTER = {"eval_loss", *LOSS_METRIC_NAMES}
+
+# 硬链接检查点时跳过的训练状态文件（优化器、调度器、随机数状态、training_args.bin），
+# 保留适配器、分词器和 trainer_state.json
+TRAINING_STATE_SUFFIXES = (".pt", ".pth", ".bin")
+
+def checkpoint_eval_loss(checkpoint_dir, step):
+    """检查点 trainer_state.json 中第 step 步的验证损失，没有时返回None"""
+    try:
+        with open(os.path.join(checkpoint_dir, "trainer_state.json"), "r", encoding="utf-8") as f:
+            log_history = json.load(f).get("log_history", [])
+    except (OSError, ValueError):
+        return None
+    losses = [entry["eval_loss"] for entry in log_history if entry.get("step") == step and "eval_loss" in entry]
+    return losses[-1] if losses else None
+
+def training_finished(output_dir):
+    """训练是否已保存最终模型：输出目录的适配器权重比本次训练写入的 training_params.json 新"""
+    weights = os.path.join(output_dir, ADAPTER_WEIGHTS_FILE)
+    params = os.path.join(output_dir, PARAMS_FILE)
+    return os.path.isfile(weights) and os.path.getmtime(weights) >= os.path.getmtime(params)
+
+def hold_checkpoint(checkpoint_dir, target_dir):
+    """
+    把检查点中的适配器和分词器文件硬链接到 target_dir
+
+    Returns:
+        是否成功；检查点已被保留策略删除时返回False
+    """
+    tmp_dir = f"{target_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        for name in os.listdir(checkpoint_dir):
+            source = os.path.join(checkpoint_dir, name)
+            if os.path.isfile(source) and not name.endswith(TRAINING_STATE_SUFFIXES):
+                link_or_copy(source, os.path.join(tmp_dir, name))
+    except FileNotFoundError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    if not os.path.isfile(os.path.join(tmp_dir, ADAPTER_WEIGHTS_FILE)):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.replace(tmp_dir, target_dir)
+    return True
+
+def rank_entries(entries, metric):
+    """按 metric 从好到差排序，没有该指标的条目排在最后"""
+    sign = 1 if metric in LOWER_IS_BETTER else -1
+    return sorted(entries, key=lambda e: (e.get(metric) is None, sign * (e.get(metric) or 0), e["step"]))
+
+def load_training_args(output_dir, overrides):
+    """
+    评估参数：以 gpu_llm_finetune.py 的默认值为基础，叠加训练时的 training_params.json 和命令行覆盖值
+    """
+    from gpu_llm_finetune import parse_args
+
+    args = parse_args([])
+    with open(os.path.join(output_dir, PARAMS_FILE), "r", encoding="utf-8") as f:
+        vars(args).update(json.load(f))
+    vars(args).update({key: value for key, value in overrides.items() if value is not None})
+    args.output_dir = output_dir
+    args.resume_from_checkpoint = None
+    return args
+
+def load_base_model(args, device_map=None):
+    """评估工作进程中加载基础模型（不含适配器）"""
+    from gpu_llm_finetune import create_model_and_tokenizer
+
+    model, tokenizer = create_model_and_tokenizer(args.model_type, args.load_in_4bit, device_map=device_map)
+    model.eval()
+    return model, tokenizer
+
+# 评估工作进程中常驻的基础模型、分词器和适配器管理器
+_worker = {}
+
+def _init_worker(load_base, args, device):
+    model, tokenizer = load_base(args, device_map={"": device})
+    _worker.update(model=model, tokenizer=tokenizer, adapters=None)
+
+def _evaluate_checkpoint(name, adapter_dir, questions, answers, args):
+    """
+    评估工作进程：切换到检查点的适配器，为评估子集生成回答；
+    --eval_mode loss 时改为返回各样本的 (NLL之和, token数)
+    """
+    from gpu_adapters import AdapterManager
+    from gpu_llm_finetune import compute_example_nll, generate_answers
+
+    start_time = time.perf_counter()
+    if _worker["adapters"] is None:
+        _worker["adapters"] = AdapterManager(_worker["model"], {name: adapter_dir}, max_resident=1)
+    else:
+        _worker["adapters"].register(name, adapter_dir)
+    model = _worker["adapters"].activate(name)
+    if args.eval_mode == "loss":
+        result = compute_example_nll(model, _worker["tokenizer"], questions, answers, batch_size=args.eval_batch_size,
+                                     max_length=args.max_seq_length)
+    else:
+        # 前缀KV缓存与适配器相关，切换检查点后不能复用，这里不使用
+        result = generate_answers(model, _worker["tokenizer"], questions, batch_size=args.eval_batch_size,
+                                  max_new_tokens=args.max_new_tokens)
+    return result, time.perf_counter() - start_time
+
+def default_device():
+    """评估工作进程的设备：有GPU时用最后一块（训练通常从0号开始占用），否则用CPU"""
+    import torch
+
+    return f"cuda:{torch.cuda.device_count() - 1}" if torch.cuda.is_available() else "cpu"
+
+class CheckpointWatcher:
+    """
+    排行榜与检查点状态
+
+    Args:
+        output_dir: 训练输出目录
+        metric: 排名指标（RANK_METRICS之一）
+        promote: 是否把排名第一的检查点保存到 output_dir/best_checkpoint
+    """
+
+    def __init__(self, output_dir, metric="rouge-l", promote=False):
+        if metric not in RANK_METRICS:
+            raise ValueError(f"不支持的排名指标 {metric}，可选: {', '.join(RANK_METRICS)}")
+        self.output_dir = output_dir
+        self.metric = metric
+        self.promote = promote
+        self.eval_dir = os.path.join(output_dir, EVAL_DIR)
+        self.entries = {}
+        # 评估前已被删除的检查点，不再尝试
+        self.missed = set()
+        path = os.path.join(output_dir, f"{LEADERBOARD_FILE}.json")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = {entry["step"]: entry for entry in json.load(f)["checkpoints"]}
+            logger.info(f"从 {path} 恢复 {len(self.entries)} 个已评估的检查点")
+
+    def pending(self):
+        """尚未评估的完整检查点，按步数排序（越早的检查点越可能被保留策略删除，先评估）"""
+        return [(step, path) for step, path in list_checkpoints(self.output_dir)
+                if step not in self.entries and step not in self.missed]
+
+    def result_dir(self, step):
+        return os.path.join(self.eval_dir, f"checkpoint-{step}")
+
+    def adapter_dir(self, step):
+        return os.path.join(self.result_dir(step), ADAPTER_SUBDIR)
+
+    def hold(self, step, checkpoint_dir):
+        """硬链接检查点的适配器供评估使用，返回适配器目录；检查点已被删除时返回None"""
+        os.makedirs(self.result_dir(step), exist_ok=True)
+        if hold_checkpoint(checkpoint_dir, self.adapter_dir(step)):
+            return self.adapter_dir(step)
+        logger.info(f"检查点 {checkpoint_dir} 在评估前已被删除，跳过")
+        self.missed.add(step)
+        shutil.rmtree(self.result_dir(step), ignore_errors=True)
+        return None
+
+    def best(self):
+        ranked = rank_entries(self.entries.values(), self.metric)
+        return ranked[0] if ranked and ranked[0].get(self.metric) is not None else None
+
+    def record(self, step, checkpoint_dir, averages, eval_loss, eval_seconds, num_examples):
+        """记录一个检查点的评估结果，更新排行榜，必要时提升最好的检查点"""
+        self.entries[step] = {
+            "step": step,
+            "checkpoint": checkpoint_dir,
+            **averages,
+            "eval_loss": eval_loss,
+            "num_examples": num_examples,
+            "eval_seconds": round(eval_seconds, 2),
+        }
+        best = self.best()
+        if self.promote and best is not None and best["step"] == step:
+            self._promote(step)
+        # 评估完即删除硬链接，不占用保留策略释放的空间（被提升的检查点在 best_checkpoint 中另有链接）
+        shutil.rmtree(self.adapter_dir(step), ignore_errors=True)
+        self.write()
+        value = self.entries[step].get(self.metric)
+        logger.info(f"检查点 {step} 评估完成: {self.metric}={value if value is None else f'{value:.4f}'}，"
+                    f"当前最好的检查点为 {best['step'] if best else '-'}")
+
+    def _promote(self, step):
+        target = os.path.join(self.output_dir, PROMOTED_DIR)
+        tmp_dir = f"{target}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(self.adapter_dir(step), tmp_dir, copy_function=link_or_copy)
+        with open(os.path.join(tmp_dir, "checkpoint_eval.json"), "w", encoding="utf-8") as f:
+            json.dump({"metric": self.metric, **self.entries[step]}, f, ensure_ascii=False, indent=2)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+        logger.info(f"已将检查点 {step} 提升到 {target}")
+
+    def leaderboard(self):
+        """按排名排列的排行榜行"""
+        return rank_entries(self.entries.values(), self.metric)
+
+    def write(self):
+        """写入 checkpoint_leaderboard.json（按步数）和 checkpoint_leaderboard.md（按排名）"""
+        from gpu_sweep import format_table
+
+        best = self.best()
+        data = {
+            "metric": self.metric,
+            "best_step": best["step"] if best else None,
+            "promoted": os.path.join(self.output_dir, PROMOTED_DIR) if self.promote and best else None,
+            "checkpoints": [self.entries[step] for step in sorted(self.entries)],
+        }
+        path = os.path.join(self.output_dir, f"{LEADERBOARD_FILE}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(f"{path}.tmp", path)
+        rows = [{key: value for key, value in entry.items() if key != "checkpoint"} for entry in self.leaderboard()]
+        with open(os.path.join(self.output_dir, f"{LEADERBOARD_FILE}.md"), "w", encoding="utf-8") as f:
+            f.write(format_table(rows) + "\n")
+
+def watch(args, metric=None, promote=False, eval_subset=50, poll_interval=30.0, once=False, device=None,
+          load_base=load_base_model, eval_split="validation", idle_timeout=3600.0):
+    """
+    轮询并评估新检查点，直到训练保存最终模型且全部检查点评估完毕（once=True 时只评估当前已有的检查点）
+
+    Args:
+        args: 评估参数（见 load_training_args），output_dir 为训练输出目录
+        metric: 排名指标，默认生成评估按 rouge-l、损失评估（args.eval_mode 为 loss）按 nll
+        promote: 是否提升最好的检查点
+        eval_subset: 评估 eval_split 的前多少条，各检查点使用同一子集
+        poll_interval: 轮询间隔（秒）
+        once: 只评估当前已有的检查点
+        device: 评估工作进程的设备，默认见 default_device
+        load_base: 加载基础模型的函数 (args, device_map) -> (model, tokenizer)，需可pickle
+        eval_split: 评估使用的数据集分割，默认验证集
+        idle_timeout: 训练未结束且超过该秒数没有新检查点时停止监视，None表示一直等待
+
+    Returns:
+        CheckpointWatcher
+    """
+    from gpu_llm_finetune import get_cache_dir, load_gpu_qa_dataset, save_evaluation_results, save_loss_results
+
+    metric = metric or ("nll" if args.eval_mode == "loss" else "rouge-l")
+    watcher = CheckpointWatcher(args.output_dir, metric, promote)
+    eval_dataset = load_gpu_qa_dataset(args.dataset_path, split=eval_split)
+    subset = eval_dataset.select(range(min(eval_subset, len(eval_dataset))))
+    questions = list(subset["question"])
+    answers = list(subset["answer"])
+    logger.info(f"监视 {args.output_dir} 中的检查点，每个检查点评估 {eval_split} 的 {len(questions)} 个问题，"
+                f"按 {metric} 排名")
+
+    # 使用spawn启动，评估工作进程不继承父进程的CUDA状态
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                             initargs=(load_base, args, device or default_device())) as executor:
+        last_progress = time.monotonic()
+        while True:
+            finished = training_finished(args.output_dir)
+            pending = watcher.pending()
+            if pending:
+                last_progress = time.monotonic()
+            for step, checkpoint_dir in pending:
+                adapter_dir = watcher.hold(step, checkpoint_dir)
+                if adapter_dir is None:
+                    continue
+                eval_loss = checkpoint_eval_loss(adapter_dir, step)
+                result, seconds = executor.submit(
+                    _evaluate_checkpoint, f"checkpoint-{step}", adapter_dir, questions, answers, args).result()
+                # 逐条结果写入 checkpoint_eval/checkpoint-N，参考答案n-gram表仍缓存在训练的缓存目录
+                result_args = Namespace(**vars(args))
+                result_args.output_dir = watcher.result_dir(step)
+                result_args.cache_dir = get_cache_dir(args)
+                if args.eval_mode == "loss":
+                    averages = save_loss_results(subset, *result, result_args)
+                else:
+                    averages = save_evaluation_results(subset, result, result_args)
+                watcher.record(step, checkpoint_dir, averages, eval_loss, seconds, len(questions))
+                last_progress = time.monotonic()
+            if once or (finished and not watcher.pending()):
+                break
+            if idle_timeout is not None and time.monotonic() - last_progress > idle_timeout:
+                logger.warning(f"{idle_timeout:.0f}s 内没有新检查点且训练未保存最终模型，训练可能已中断，停止监视")
+                break
+            time.sleep(poll_interval)
+    return watcher
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="训练时并行评估新检查点并维护排行榜")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="训练输出目录（gpu_llm_finetune.py 的 --output_dir）")
+    parser.add_argument("--eval_split", type=str, default="validation", choices=["validation", "test", "train"],
+                        help="挑选检查点使用的数据集分割，默认验证集（测试集留给最终报告）")
+    parser.add_argument("--eval_subset", type=int, default=50,
+                        help="评估 --eval_split 的前多少个问题，各检查点使用同一子集")
+    parser.add_argument("--eval_mode", type=str, default=None, choices=["generate", "loss"],
+                        help="评估方式，默认与训练参数相同：generate生成回答计算ROUGE/BLEU，loss计算NLL/困惑度")
+    parser.add_argument("--metric", type=str, default=None, choices=RANK_METRICS,
+                        help="排名指标，默认生成评估为 rouge-l、损失评估为 nll；nll、perplexity、eval_loss 越小越好")
+    parser.add_argument("--promote", action="store_true",
+                        help="把排名第一的检查点的适配器保存到 output_dir/best_checkpoint")
+    parser.add_argument("--poll_interval", type=float, default=30.0,
+                        help="轮询新检查点的间隔（秒）")
+    parser.add_argument("--once", action="store_true",
+                        help="只评估当前已有的检查点后退出")
+    parser.add_argument("--idle_timeout", type=float, default=3600.0,
+                        help="训练未结束且超过该秒数没有新检查点时退出（训练可能已中断），应大于两次保存的间隔")
+    parser.add_argument("--device", type=str, default=None,
+                        help="评估使用的设备（如 cuda:1、cpu），默认为最后一块GPU")
+    parser.add_argument("--dataset_path", type=str, default=None,
+                        help="数据集路径，默认与训练相同")
+    parser.add_argument("--eval_batch_size", type=int, default=None,
+                        help="批量生成的批次大小，默认与训练参数相同")
+    parser.add_argument("--max_new_tokens", type=int, default=None,
+                        help="每个回答最多生成的token数，默认与训练参数相同")
+    args = parser.parse_args(argv)
+    for name in ("eval_subset", "eval_batch_size", "max_new_tokens"):
+        value = getattr(args, name)
+        if value is not None and value < 1:
+            parser.error(f"--{name} 必须为正整数")
+    if args.poll_interval <= 0:
+        parser.error("--poll_interval 必须大于0")
+    if args.idle_timeout <= 0:
+        parser.error("--idle_timeout 必须大于0")
+    return args
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+
+    # 监视器可以先于训练启动，等待训练写入参数文件
+    params_file = os.path.join(args.output_dir, PARAMS_FILE)
+    start_time = time.monotonic()
+    while not os.path.exists(params_file):
+        if time.monotonic() - start_time > args.idle_timeout:
+            logger.error(f"{args.idle_timeout:.0f}s 内训练没有写入 {params_file}")
+            return 1
+        logger.info(f"等待训练写入 {params_file}")
+        time.sleep(args.poll_interval)
+    eval_args = load_training_args(args.output_dir, {
+        "eval_mode": args.eval_mode,
+        "dataset_path": args.dataset_path,
+        "eval_batch_size": args.eval_batch_size,
+        "max_new_tokens": args.max_new_tokens,
+    })
+
+    watcher = watch(eval_args, metric=args.metric, promote=args.promote, eval_subset=args.eval_subset,
+                    poll_interval=args.poll_interval, once=args.once, device=args.device,
+                    eval_split=args.eval_split, idle_timeout=args.idle_timeout)
+    best = watcher.best()
+    if best is None:
+        logger.warning("没有评估到任何检查点")
+        return 1
+    logger.info(f"最好的检查点: {best['checkpoint']}（{watcher.metric}={best[watcher.metric]:.4f}），"
+                f"排行榜已保存到 {os.path.join(args.output_dir, LEADERBOARD_FILE + '.md')}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,34 +25,23 @@ if [ ! -d "GPU-QA" ]; then
     unzip GPU-QA.zip
 fi
 
-# 微调Qwen3-1.7B模型
-echo "开始微调Qwen3-1.7B模型（GPU知识助手）..."
-python gpu_llm_finetune.py \
-    --model_type qwen3-1.7b \
-    --dataset_path GPU-QA \
-    --output_dir outputs/qwen3-1.7b-gpu-assistant \
-    --lora_rank 16 \
-    --learning_rate 5e-5 \
-    --per_device_train_batch_size 2 \
-    --gradient_accumulation_steps 8 \
-    --max_steps 2000 \
-    --max_seq_length 1024 \
-    --do_train \
-    --do_eval
+# 两个Qwen3模型共用同一分词器，由扫描调度器先预处理一次，共享 outputs/cache 中预处理后的数据集
+# 有多块GPU（或用 --devices cpu --cpu_slots N 在CPU上）时两个模型同时训练；已有结果的模型自动跳过
 
-# 微调Qwen3-0.6B模型
-echo "开始微调Qwen3-0.6B模型（GPU知识助手）..."
-python gpu_llm_finetune.py \
-    --model_type qwen3-0.6b \
-    --dataset_path GPU-QA \
-    --output_dir outputs/qwen3-0.6b-gpu-assistant \
-    --lora_rank 16 \
-    --learning_rate 5e-5 \
-    --per_device_train_batch_size 2 \
-    --gradient_accumulation_steps 8 \
-    --max_steps 2000 \
-    --max_seq_length 1024 \
-    --do_train \
-    --do_eval
+echo "开始微调Qwen3-1.7B与Qwen3-0.6B模型（GPU知识助手）..."
+python gpu_sweep.py \
+    --grid model_type=qwen3-1.7b,qwen3-0.6b \
+    --set dataset_path=GPU-QA \
+    --set lora_rank=16 \
+    --set learning_rate=5e-5 \
+    --set per_device_train_batch_size=2 \
+    --set gradient_accumulation_steps=8 \
+    --set max_steps=2000 \
+    --set max_seq_length=1024 \
+    --set do_train=true \
+    --set do_eval=true \
+    --name_template "{model_type}-gpu-assistant" \
+    --output_dir outputs \
+    "$@"
 
-echo "Qwen3 GPU知识助手模型微调完成！"
\ No newline at end of file
+echo "Qwen3 GPU知识助手模型微调完成！比较结果见 outputs/sweep_results.md"
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多LoRA适配器管理测试
+在CPU上用微型模型和随机初始化的LoRA适配器，验证按需加载、LRU卸载以及混合适配器批次的生成结果
+"""
+
+import asyncio
+import json
+import os
+
+import torch
+from aiohttp.test_utils import TestClient, TestServer
+from peft import LoraConfig, PeftModel, get_peft_model
+
+from gpu_adapters import BASE_ADAPTER, AdapterManager
+from gpu_llm_finetune import generate_answers
+from gpu_serving import ContinuousBatchingEngine, create_app
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = [
+    "什么是GPU？",
+    "What is CUDA?",
+    "显存不足怎么办？",
+    "GPU和CPU有什么区别？",
+]
+
+ADAPTER_NAMES = ["a0", "a1", "a2"]
+
+def _save_adapters(root):
+    """在同一个微型基础模型上保存若干个权重不同的LoRA适配器，返回 名称 -> 目录"""
+    paths = {}
+    for i, name in enumerate(ADAPTER_NAMES):
+        model, _ = create_tiny_model_and_tokenizer(QUESTIONS)
+        torch.manual_seed(100 + i)
+        config = LoraConfig(r=4, lora_alpha=16, target_modules=["q_proj", "v_proj", "down_proj"],
+                            init_lora_weights=False)
+        paths[name] = os.path.join(root, name)
+        get_peft_model(model, config).save_pretrained(paths[name])
+    return paths
+
+def _reference_answers(paths, max_new_tokens):
+    """每个适配器单独用 PeftModel.from_pretrained 加载后逐条生成的回答"""
+    answers = {}
+    for name, path in paths.items():
+        model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+        model = PeftModel.from_pretrained(model, path)
+        model.eval()
+        answers[name] = generate_answers(model, tokenizer, QUESTIONS, batch_size=1, max_new_tokens=max_new_tokens)
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    answers[BASE_ADAPTER] = generate_answers(model, tokenizer, QUESTIONS, batch_size=1, max_new_tokens=max_new_tokens)
+    return answers
+
+def test_mixed_adapter_requests_match_single_adapter_generation(tmp_path):
+    """并发请求使用不同适配器时合并生成，结果与各适配器单独加载时一致，常驻适配器数不超过上限"""
+    paths = _save_adapters(str(tmp_path))
+    expected = _reference_answers(paths, max_new_tokens=10)
+    assert len({tuple(answers) for answers in expected.values()}) == len(expected)
+
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    adapters = AdapterManager(model, paths, max_resident=2)
+    engine = ContinuousBatchingEngine(adapters.model, tokenizer, max_batch_size=4, max_new_tokens=10,
+                                      adapters=adapters)
+    # 每个问题依次使用 a0、a1、a2 和基础模型（model 字段为基础模型名称）
+    models = ADAPTER_NAMES + ["tiny"]
+    requests = [(model_name, question) for model_name in models for question in QUESTIONS]
+
+    async def test(client):
+        async def complete(model_name, question):
+            response = await client.post("/v1/chat/completions", json={
+                "model": model_name, "messages": [{"role": "user", "content": question}]})
+            assert response.status == 200
+            return await response.json()
+
+        responses = await asyncio.gather(*(complete(m, q) for m, q in requests))
+        listed = await (await client.get("/v1/models")).json()
+        missing = await client.post("/v1/chat/completions", json={
+            "model": "unknown", "messages": [{"role": "user", "content": QUESTIONS[0]}]})
+        default = await complete(None, QUESTIONS[0])
+        return responses, listed, missing.status, default, engine.metrics()
+
+    async def run():
+        async with TestClient(TestServer(create_app(engine, "tiny"))) as client:
+            return await test(client)
+
+    responses, listed, missing_status, default, metrics = asyncio.run(run())
+
+    for (model_name, question), response in zip(requests, responses):
+        adapter = BASE_ADAPTER if model_name == "tiny" else model_name
+        assert response["model"] == model_name
+        assert response["choices"][0]["message"]["content"].strip() == expected[adapter][QUESTIONS.index(question)]
+    assert default["model"] == "a0"
+    assert default["choices"][0]["message"]["content"].strip() == expected["a0"][0]
+    assert [m["id"] for m in listed["data"]] == ["tiny"] + ADAPTER_NAMES
+    assert missing_status == 404
+    assert metrics["max_batch_size_seen"] > 1
+    assert metrics["adapters"]["mixed_forwards"] > 0
+    assert metrics["adapters"]["evictions"] > 0
+    assert len(metrics["adapters"]["resident"]) <= 2
+
+def test_lru_eviction_and_memory(tmp_path):
+    """按最近使用顺序卸载适配器，常驻内存只按适配器大小增长，切换常驻适配器不重新加载"""
+    paths = _save_adapters(str(tmp_path))
+    model, _ = create_tiny_model_and_tokenizer(QUESTIONS)
+    base_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    adapters = AdapterManager(model, paths, max_resident=2)
+
+    adapters.activate("a1")
+    adapters.activate("a0")
+    adapters.activate("a2")
+    metrics = adapters.metrics()
+    assert metrics["resident"] == ["a0", "a2"]
+    assert metrics["loads"] == 3 and metrics["evictions"] == 1
+    assert set(adapters.model.peft_config) == {"a0", "a2"}
+    adapter_bytes = adapters.adapter_bytes()["a0"]
+    assert metrics["resident_bytes"] == 2 * adapter_bytes
+    total_bytes = sum(p.numel() * p.element_size() for p in adapters.model.parameters())
+    assert total_bytes == base_bytes + 2 * adapter_bytes
+
+    adapters.activate("a0")
+    assert adapters.model.active_adapter == "a0"
+    assert adapters.metrics()["loads"] == 3
+
+    # 在其他基础模型上训练的适配器在注册时被拒绝
+    with open(os.path.join(paths["a1"], "adapter_config.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config["base_model_name_or_path"] = "deepseek-ai/deepseek-coder-1.3b-base"
+    with open(os.path.join(paths["a1"], "adapter_config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    adapters.base_name = "Qwen/Qwen3-0.6B"
+    try:
+        adapters.register("deepseek", paths["a1"])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("基础模型不一致的适配器应当被拒绝")
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        test_mixed_adapter_requests_match_single_adapter_generation(tmp)
+    with tempfile.TemporaryDirectory() as tmp:
+        test_lru_eviction_and_memory(tmp)
+    print("✅ 多LoRA适配器管理测试通过!")
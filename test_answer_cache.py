@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+问答缓存测试
+验证精确/近似重复匹配、LRU与TTL淘汰、持久化与适配器变化后的失效，以及推理服务中的缓存命中
+"""
+
+import asyncio
+import os
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from gpu_answer_cache import AnswerCache, adapter_fingerprint
+from gpu_minhash import MinHasher, MinHashLSH, char_ngrams, jaccard, normalize_text
+from gpu_serving import ContinuousBatchingEngine, create_app
+from tiny_model import create_tiny_model_and_tokenizer
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_minhash_estimates_jaccard():
+    hasher = MinHasher(num_perm=128, ngram=2)
+    a, b = "如何解决CUDA显存不足的问题", "如何解决CUDA显存不足问题"
+    estimate = MinHasher.similarity(hasher.signature(a), hasher.signature(b))
+    assert abs(estimate - jaccard(char_ngrams(a, 2), char_ngrams(b, 2))) < 0.15
+
+    lsh = MinHashLSH(num_perm=128, bands=32)
+    lsh.add("a", hasher.signature(a))
+    lsh.add("c", hasher.signature("张量核心的计算精度"))
+    assert lsh.query(hasher.signature(b)) == {"a"}
+    lsh.remove("a")
+    assert lsh.query(hasher.signature(b)) == set()
+
+def test_exact_and_near_duplicate_hits():
+    """规范化后相同的问题精确命中；近似重复只在启用后、相似度达到阈值时命中"""
+    assert normalize_text(" 什么是 CUDA？") == normalize_text("什么是cuda?")
+
+    cache = AnswerCache(near_duplicates=False)
+    cache.put("什么是CUDA？", "CUDA是NVIDIA的并行计算平台", latency=2.0)
+    assert cache.get("什么是 cuda?")["answer"] == "CUDA是NVIDIA的并行计算平台"
+    assert cache.get("如何解决CUDA显存不足的问题") is None
+
+    cache = AnswerCache(near_duplicates=True, threshold=0.7)
+    cache.put("如何解决CUDA显存不足的问题？", "减小批大小", latency=3.0)
+    cache.put("什么是CUDA？", "并行计算平台", latency=2.0)
+    assert cache.get("如何解决CUDA显存不足问题")["answer"] == "减小批大小"
+    assert cache.get("GPU和CPU有什么区别？") is None
+    assert cache.get("什么是CUDA") is not None
+
+    metrics = cache.metrics()
+    assert (metrics["exact_hits"], metrics["near_hits"], metrics["misses"]) == (1, 1, 1)
+    assert abs(metrics["hit_rate"] - 2 / 3) < 1e-9
+    assert metrics["latency_saved"] == 5.0
+
+def test_lru_and_ttl_eviction():
+    clock = FakeClock()
+    cache = AnswerCache(max_entries=2, ttl=60, clock=clock)
+    cache.put("问题一", "回答一")
+    cache.put("问题二", "回答二")
+    assert cache.get("问题一") is not None
+    # 问题二最久未使用，被淘汰
+    cache.put("问题三", "回答三")
+    assert cache.get("问题二") is None
+    assert len(cache) == 2 and cache.stats["evictions"] == 1
+
+    clock.now += 61
+    assert cache.get("问题一") is None and cache.get("问题三") is None
+    assert len(cache) == 0 and cache.stats["expirations"] == 2
+
+def test_persistence_and_adapter_invalidation(tmp_path):
+    adapter_dir = tmp_path / "adapter"
+    adapter_dir.mkdir()
+    (adapter_dir / "adapter_config.json").write_text('{"r": 8}')
+    (adapter_dir / "adapter_model.safetensors").write_bytes(b"weights")
+    path = str(tmp_path / "answer_cache.json")
+
+    fingerprint = adapter_fingerprint(str(adapter_dir))
+    cache = AnswerCache(path, near_duplicates=True, fingerprint=fingerprint)
+    cache.put("什么是CUDA？", "并行计算平台", latency=1.5, completion_tokens=6)
+    cache.save()
+
+    reloaded = AnswerCache(path, near_duplicates=True, fingerprint=adapter_fingerprint(str(adapter_dir)))
+    entry = reloaded.get("什么是cuda")
+    assert entry["answer"] == "并行计算平台" and entry["completion_tokens"] == 6
+
+    # 适配器重新训练后缓存失效
+    (adapter_dir / "adapter_model.safetensors").write_bytes(b"new weights")
+    assert adapter_fingerprint(str(adapter_dir)) != fingerprint
+    assert len(AnswerCache(path, fingerprint=adapter_fingerprint(str(adapter_dir)))) == 0
+    assert not os.path.exists(path + ".tmp")
+
+def test_serving_uses_answer_cache():
+    """相同（规范化后）的问题第二次请求直接由缓存返回，不再进入生成引擎"""
+    model, tokenizer = create_tiny_model_and_tokenizer(["什么是CUDA？"])
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=2, max_new_tokens=8)
+    # 微型模型不会生成结束符，把它贪心生成的换行符当作结束符，使回答正常结束并被缓存
+    engine.eos_token_ids.add(tokenizer.convert_tokens_to_ids("\n"))
+    cache = AnswerCache()
+
+    async def complete(client, question, **kwargs):
+        response = await client.post("/v1/chat/completions", json={
+            "messages": [{"role": "user", "content": question}], **kwargs})
+        return await response.json()
+
+    async def run():
+        async with TestClient(TestServer(create_app(engine, "tiny", cache))) as client:
+            first = await complete(client, "什么是CUDA？")
+            second = await complete(client, "什么是 cuda?")
+            sampled = await complete(client, "什么是CUDA？", temperature=0.7)
+            health = await (await client.get("/health")).json()
+            return first, second, sampled, health
+
+    first, second, sampled, health = asyncio.run(run())
+    assert first["choices"][0]["finish_reason"] == "stop"
+    assert second["choices"][0]["message"] == first["choices"][0]["message"]
+    assert second["usage"]["completion_tokens"] == first["usage"]["completion_tokens"]
+    # 采样请求不使用缓存
+    assert health["requests_completed"] == 2
+    assert health["answer_cache"]["exact_hits"] == 1 and health["answer_cache"]["entries"] == 1
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    test_minhash_estimates_jaccard()
+    test_exact_and_near_duplicate_hits()
+    test_lru_and_ttl_eviction()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_persistence_and_adapter_invalidation(pathlib.Path(tmp_dir))
+    test_serving_uses_answer_cache()
+    print("✅ 问答缓存测试通过!")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练批次构造测试
+验证序列打包后每条对话仍被独立训练，以及按长度分桶采样
+"""
+
+import torch
+from datasets import Dataset
+
+from gpu_batching import (
+    IGNORE_INDEX,
+    LengthBucketSampler,
+    PackedSequenceCollator,
+    pack_dataset,
+    pack_sequences,
+)
+from tiny_model import create_tiny_model_and_tokenizer
+
+def test_pack_sequences_respects_capacity():
+    """每条打包序列都不超过最大长度，且每条样本恰好出现一次"""
+    lengths = [5, 3, 8, 2, 7, 1, 4, 6]
+    bins = pack_sequences(lengths, max_length=10)
+    assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+    assert all(sum(lengths[i] for i in b) <= 10 for b in bins)
+    assert len(bins) == 4
+
+def test_packed_forward_matches_unpacked():
+    """打包序列的逐token损失与逐条前向计算一致，样本之间没有注意力泄漏"""
+    texts = ["什么是GPU？GPU是图形处理器。", "CUDA is a platform.", "显存不足怎么办", "warp"]
+    model, tokenizer = create_tiny_model_and_tokenizer(texts)
+    encoded = [tokenizer(text)["input_ids"] for text in texts]
+    dataset = Dataset.from_dict({"input_ids": encoded, "labels": encoded})
+
+    packed = pack_dataset(dataset, max_length=40)
+    assert len(packed) < len(texts)
+    batch = PackedSequenceCollator(tokenizer.pad_token_id)([packed[i] for i in range(len(packed))])
+    assert "attention_mask" not in batch
+
+    with torch.no_grad():
+        # 与训练时一致关闭KV缓存，模型才会根据position_ids构造分段注意力掩码
+        packed_logits = model(input_ids=batch["input_ids"], position_ids=batch["position_ids"],
+                              use_cache=False).logits
+        for row, position_ids in enumerate(batch["position_ids"]):
+            starts = (position_ids == 0).nonzero().flatten().tolist() + [len(position_ids)]
+            for start, end in zip(starts[:-1], starts[1:]):
+                segment = batch["input_ids"][row, start:end]
+                if batch["labels"][row, start + 1:end].eq(IGNORE_INDEX).all():
+                    continue  # 填充段
+                single_logits = model(input_ids=segment.unsqueeze(0), use_cache=False).logits[0]
+                assert torch.allclose(packed_logits[row, start:end], single_logits, atol=1e-5)
+                assert batch["labels"][row, start] == IGNORE_INDEX
+
+def test_length_bucket_sampler():
+    """每个样本每个epoch恰好出现一次，不足一批的零头在最后，批内长度相近"""
+    lengths = [(i * 37) % 101 + 1 for i in range(203)]
+    sampler = LengthBucketSampler(lengths, batch_size=4, bucket_size_multiplier=10, seed=0)
+
+    batches = sampler.batches()
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(len(batch) == 4 for batch in batches[:-1])
+    assert len(batches[-1]) == len(lengths) % 4
+    assert list(sampler) == [i for batch in batches for i in batch]
+
+    bucketed_padding = sum(max(lengths[i] for i in b) * len(b) for b in batches)
+    random_batches = [list(range(i, min(i + 4, len(lengths)))) for i in range(0, len(lengths), 4)]
+    random_padding = sum(max(lengths[i] for i in b) * len(b) for b in random_batches)
+    assert bucketed_padding < random_padding
+
+    sampler.set_epoch(1)
+    assert sampler.batches() != batches
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能基准测试脚本的测试
+验证结果文件的结构，以及与基准结果比较时按指标方向识别回退
+"""
+
+import json
+
+from benchmarks.run_benchmarks import compare_results, main
+
+def _results(**metrics):
+    return {"results": [{"name": "generate/bs1", "params": {}, "metrics": metrics}]}
+
+def test_compare_results_directions():
+    """吞吐量下降和耗时增加都算回退，容差内的波动和变好不算"""
+    baseline = _results(tokens_per_second=100.0, seconds=1.0, peak_memory_mb=50.0)
+    rows = compare_results(_results(tokens_per_second=80.0, seconds=0.95, peak_memory_mb=52.0), baseline, 0.1)
+    regressions = {row["metric"]: row["regression"] for row in rows}
+    assert regressions == {"tokens_per_second": True, "seconds": False, "peak_memory_mb": False}
+
+    rows = compare_results(_results(tokens_per_second=120.0, seconds=1.5, peak_memory_mb=50.0), baseline, 0.1)
+    changes = {row["metric"]: row for row in rows}
+    assert changes["tokens_per_second"]["change"] > 0 and not changes["tokens_per_second"]["regression"]
+    assert changes["seconds"]["regression"]
+
+def test_run_and_compare(tmp_path):
+    """运行一组基准测试并与自身比较，没有回退；基准中的吞吐量更高时以非零状态退出"""
+    output = str(tmp_path / "results.json")
+    assert main(["--suites", "metrics", "--quick", "--repeats", "1", "--output", output]) == 0
+    with open(output, "r", encoding="utf-8") as f:
+        results = json.load(f)
+    assert "torch" in results["metadata"]
+    assert [r["name"] for r in results["results"]] == ["metrics/score"]
+    assert results["results"][0]["metrics"]["rows_per_second"] > 0
+
+    baseline = str(tmp_path / "baseline.json")
+    results["results"][0]["metrics"]["rows_per_second"] *= 100
+    with open(baseline, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+    assert main(["--suites", "metrics", "--quick", "--repeats", "1", "--output", output,
+                 "--baseline", baseline]) == 1
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    test_compare_results_directions()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_run_and_compare(pathlib.Path(tmp_dir))
+    print("✅ 基准测试脚本测试通过!")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步检查点测试
+在CPU上训练微型模型，验证后台写入的检查点可以恢复训练、不变文件只保存一份，以及保留策略
+"""
+
+import json
+import os
+from argparse import Namespace
+
+from datasets import Dataset
+from safetensors.torch import load_file
+
+from gpu_checkpoint import SHARED_DIR, checkpoints_to_delete, list_checkpoints
+from gpu_llm_finetune import preprocess_gpu_qa, train_model
+from tiny_model import create_tiny_model_and_tokenizer
+
+QA_PAIRS = [{"question": f"第{i}个问题" + "？" * (i % 4), "answer": f"回答{i}" + "很长" * (i % 5)} for i in range(8)]
+
+CHECKPOINT_FILES = {"adapter_model.safetensors", "adapter_config.json", "optimizer.pt", "scheduler.pt",
+                    "rng_state.pth", "trainer_state.json", "training_args.bin", "tokenizer.json"}
+
+def _train(output_dir, with_eval=False, **overrides):
+    model, tokenizer = create_tiny_model_and_tokenizer([qa["question"] + qa["answer"] for qa in QA_PAIRS])
+    model.train()
+    raw = Dataset.from_list(QA_PAIRS)
+    dataset = raw.map(preprocess_gpu_qa, batched=True, remove_columns=raw.column_names,
+                      fn_kwargs={"tokenizer": tokenizer, "max_length": 256})
+    args = Namespace(
+        output_dir=str(output_dir), cache_dir=None, lora_rank=4, learning_rate=1e-2,
+        per_device_train_batch_size=2, gradient_accumulation_steps=1, max_steps=4,
+        eval_steps=1, save_steps=2, max_seq_length=256, packing=False, group_by_length_buckets=False,
+        chunked_loss=False, loss_chunk_size=1024, resume_from_checkpoint=None,
+        training_metrics="none", metrics_port=None, metrics_host="127.0.0.1", peak_tflops=None,
+        training_metrics_breakdown=False, sync_checkpoints=False, keep_last_checkpoints=3,
+    )
+    vars(args).update(overrides)
+    train_model(model, tokenizer, dataset, dataset if with_eval else None, args)
+
+def test_resume_from_async_checkpoint(tmp_path):
+    """后台写入的检查点包含恢复训练所需的全部文件，从中恢复后的最终权重与不中断训练一致"""
+    _train(tmp_path / "full")
+    checkpoints = list_checkpoints(str(tmp_path / "full"))
+    assert [step for step, _ in checkpoints] == [2, 4]
+    assert not [name for name in os.listdir(tmp_path / "full") if name.endswith(".tmp")]
+
+    shared = tmp_path / "full" / SHARED_DIR
+    for _, path in checkpoints:
+        assert CHECKPOINT_FILES <= set(os.listdir(path))
+        # 分词器只保存一份，检查点中是硬链接
+        assert os.path.samefile(os.path.join(path, "tokenizer.json"), shared / "tokenizer.json")
+        assert os.path.samefile(os.path.join(path, "training_args.bin"), shared / "training_args.bin")
+    with open(os.path.join(checkpoints[0][1], "trainer_state.json"), encoding="utf-8") as f:
+        assert json.load(f)["global_step"] == 2
+
+    _train(tmp_path / "resumed", resume_from_checkpoint=checkpoints[0][1])
+    expected = load_file(str(tmp_path / "full" / "adapter_model.safetensors"))
+    resumed = load_file(str(tmp_path / "resumed" / "adapter_model.safetensors"))
+    assert expected.keys() == resumed.keys()
+    for name in expected:
+        assert (expected[name] - resumed[name]).abs().max() < 1e-6, name
+
+    # 检查点中的适配器就是第4步训练结束时的权重
+    final_checkpoint = load_file(os.path.join(checkpoints[1][1], "adapter_model.safetensors"))
+    for name in expected:
+        assert (expected[name] - final_checkpoint[name]).abs().max() < 1e-6, name
+
+def test_retention_keeps_last_and_best(tmp_path):
+    """每步保存时只保留最近的检查点和验证损失最好的检查点，训练结束时加载最好的检查点"""
+    assert checkpoints_to_delete([1, 2, 3, 4, 5], keep_last=2, best_step=1) == [2, 3]
+    assert checkpoints_to_delete([1, 2, 3], keep_last=2, best_step=3) == [1]
+    assert checkpoints_to_delete([1, 2], keep_last=None) == []
+
+    _train(tmp_path, with_eval=True, max_steps=5, save_steps=1, keep_last_checkpoints=1, learning_rate=5e-2)
+    with open(tmp_path / "checkpoint-5" / "trainer_state.json", encoding="utf-8") as f:
+        state = json.load(f)
+    eval_losses = {entry["step"]: entry["eval_loss"] for entry in state["log_history"] if "eval_loss" in entry}
+    best_step = min(eval_losses, key=eval_losses.get)
+
+    assert [step for step, _ in list_checkpoints(str(tmp_path))] == sorted({best_step, 5})
+    assert state["best_model_checkpoint"] == str(tmp_path / f"checkpoint-{best_step}")
+    # load_best_model_at_end：输出目录中的最终适配器是最好的检查点
+    best = load_file(str(tmp_path / f"checkpoint-{best_step}" / "adapter_model.safetensors"))
+    final = load_file(str(tmp_path / "adapter_model.safetensors"))
+    for name in best:
+        assert (best[name] - final[name]).abs().max() < 1e-6, name
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp:
+        test_resume_from_async_checkpoint(Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_retention_keeps_last_and_best(Path(tmp))
+    print("✅ 异步检查点测试通过!")
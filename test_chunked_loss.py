@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分块交叉熵测试
+在CPU上用带LoRA的微型Qwen3模型对比分块损失与transformers默认损失的结果和反向所需内存
+"""
+
+import torch
+from peft import LoraConfig, get_peft_model
+
+from gpu_batching import IGNORE_INDEX
+from gpu_chunked_loss import chunked_lm_loss
+from tiny_model import create_tiny_model_and_tokenizer
+
+# 词表远大于隐藏维度时，logits是反向所需内存的主体，与Qwen3的情形一致
+VOCAB_SIZE = 4096
+
+def _peft_model():
+    model, _ = create_tiny_model_and_tokenizer(vocab_size=VOCAB_SIZE)
+    lora_config = LoraConfig(r=4, lora_alpha=8, lora_dropout=0.0, task_type="CAUSAL_LM",
+                             target_modules=["q_proj", "v_proj", "up_proj"])
+    model = get_peft_model(model, lora_config)
+    model.train()
+    return model
+
+def _batch(batch_size=4, seq_length=48):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, VOCAB_SIZE, (batch_size, seq_length), generator=generator)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 40:] = 0
+    labels = input_ids.clone()
+    # 模拟助手掩码：提示词与填充部分不计损失
+    labels[:, :10] = IGNORE_INDEX
+    labels[attention_mask == 0] = IGNORE_INDEX
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+def _saved_bytes(compute_loss):
+    """计算损失，返回 (loss, 为反向传播保留的张量字节数)"""
+    storages = {}
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = compute_loss()
+    return loss, sum(storages.values())
+
+def _lora_grads(model):
+    return {name: param.grad.clone() for name, param in model.named_parameters() if param.requires_grad}
+
+def test_chunked_loss_matches_reference():
+    """分块损失与默认损失的数值和LoRA梯度一致，且反向所需内存更少"""
+    batch = _batch()
+
+    model = _peft_model()
+    reference, reference_bytes = _saved_bytes(lambda: model(**batch, use_cache=False).loss)
+    reference.backward()
+    reference_grads = _lora_grads(model)
+
+    model = _peft_model()
+    (chunked, _), chunked_bytes = _saved_bytes(lambda: chunked_lm_loss(model, batch, chunk_size=32))
+    chunked.backward()
+    chunked_grads = _lora_grads(model)
+
+    assert torch.allclose(chunked, reference, rtol=1e-5, atol=1e-6)
+    assert reference_grads.keys() == chunked_grads.keys()
+    for name, grad in reference_grads.items():
+        assert torch.allclose(chunked_grads[name], grad, rtol=1e-4, atol=1e-7), name
+
+    # 默认损失为反向保留完整的 batch×seq×vocab logits，分块损失只保留隐藏状态
+    assert chunked_bytes < reference_bytes / 2
+
+    # 前向结束后LM head恢复原状
+    with torch.no_grad():
+        logits = model(input_ids=batch["input_ids"][:, :4]).logits
+    assert logits.shape[-1] == VOCAB_SIZE
+
+def test_chunked_loss_with_num_items_in_batch():
+    """给定梯度累积内的标签总数时，损失为 损失和/标签总数"""
+    batch = _batch()
+    model = _peft_model()
+    with torch.no_grad():
+        mean_loss, _ = chunked_lm_loss(model, batch)
+        num_items = int((batch["labels"][:, 1:] != IGNORE_INDEX).sum())
+        scaled_loss, _ = chunked_lm_loss(model, batch, num_items_in_batch=torch.tensor(num_items * 2))
+    assert torch.allclose(scaled_loss * 2, mean_loss)
@@ -3,69 +3,54 @@
 """
 测试GPU-QA数据集格式的脚本
 专门用于验证GPU知识问答数据集的格式是否正确
+
+逐条校验每个文件的全部记录（见 gpu_ingest）：JSON格式、字段、空问题/空回答、
+GPU关键词覆盖率，指定 --tokenizer 时还检查按目标分词器计算的token长度。
 """
 
-import json
+import argparse
 import os
+import sys
 
-def test_gpu_qa_dataset():
-    """测试GPU-QA数据集格式是否正确"""
-    dataset_files = [
-        "GPU-QA/train.jsonl",
-        "GPU-QA/validation.jsonl", 
-        "GPU-QA/test.jsonl"
-    ]
-    
-    for file_path in dataset_files:
+from gpu_ingest import validate_file, load_tokenizer
+
+DATASET_FILES = [
+    "GPU-QA/train.jsonl",
+    "GPU-QA/validation.jsonl", 
+    "GPU-QA/test.jsonl"
+]
+
+def validate_gpu_qa_dataset(tokenizer=None, max_length=1024, num_workers=None):
+    """校验GPU-QA数据集的各个分割，打印每个文件的报告，返回 {文件: ValidationReport}"""
+    reports = {}
+    for file_path in DATASET_FILES:
         if not os.path.exists(file_path):
             print(f"❌ 文件不存在: {file_path}")
             continue
-            
-        print(f"\n📁 检查文件: {file_path}")
         
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                
-            print(f"   📊 总行数: {len(lines)}")
-            
-            # 检查前几行的格式
-            for i, line in enumerate(lines[:3]):
-                try:
-                    data = json.loads(line.strip())
-                    
-                    # 检查是否有question和answer字段
-                    if "question" not in data:
-                        print(f"   ❌ 第{i+1}行缺少question字段")
-                        continue
-                        
-                    if "answer" not in data:
-                        print(f"   ❌ 第{i+1}行缺少answer字段")
-                        continue
-                    
-                    question = data["question"]
-                    answer = data["answer"]
-                    
-                    print(f"   ✅ 第{i+1}行格式正确")
-                    print(f"   📝 GPU问题: {question[:50]}...")
-                    print(f"   💡 专业解答: {answer[:50]}...")
-                    
-                    # 检查是否包含GPU相关关键词
-                    gpu_keywords = ["GPU", "显卡", "图形处理器", "CUDA", "OpenCL", "显存", "渲染", "计算", "并行"]
-                    has_gpu_keyword = any(keyword in question or keyword in answer for keyword in gpu_keywords)
-                    if has_gpu_keyword:
-                        print(f"   ✅ 包含GPU相关关键词")
-                    else:
-                        print(f"   ⚠️  未检测到明显的GPU相关关键词")
-                        
-                except json.JSONDecodeError as e:
-                    print(f"   ❌ 第{i+1}行JSON格式错误: {e}")
-                    
-        except Exception as e:
-            print(f"   ❌ 读取文件失败: {e}")
+        print(f"\n📁 检查文件: {file_path}")
+        report = validate_file(file_path, tokenizer, max_length, num_workers=num_workers, max_examples=3)
+        print(report.format())
+        reports[file_path] = report
     
     print("\n✅ GPU-QA数据集格式检查完成!")
     print("💡 提示: 确保你的数据集包含GPU相关的专业问答内容")
+    return reports
+
+def test_gpu_qa_dataset():
+    """测试GPU-QA数据集格式是否正确"""
+    reports = validate_gpu_qa_dataset()
+    for file_path, report in reports.items():
+        assert report.num_errors == 0, f"{file_path} 存在格式错误"
+        assert report.valid > 0
 
 if __name__ == "__main__":
-    test_gpu_qa_dataset()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="验证GPU-QA数据集格式")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="目标模型类型（如qwen3-1.7b）或分词器路径，指定后检查token长度")
+    parser.add_argument("--max_seq_length", type=int, default=1024,
+                        help="训练的最大序列长度")
+    args = parser.parse_args()
+    tokenizer = load_tokenizer(args.tokenizer) if args.tokenizer else None
+    reports = validate_gpu_qa_dataset(tokenizer, args.max_seq_length)
+    sys.exit(1 if any(report.num_errors for report in reports.values()) else 0)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复检测与泄漏索引测试
+构造含跨数据集重复（近似重复、问题相同回答不同、题集文本中的原题）的小数据集，验证泄漏统计、
+按优先级去重的结果，以及LSH分段找到的重复对与两两比较签名的结果一致
+"""
+
+import itertools
+import json
+
+import numpy as np
+
+from gpu_dedup import DedupIndex, main
+from gpu_ingest import iter_records
+from gpu_minhash import MinHasher, normalize_text
+
+def _qa(i):
+    return {"question": f"第{i}个问题：CUDA中编号{i * 7919}的概念是什么？",
+            "answer": f"这是关于编号{i * 104729}的独立回答，涉及线程块{i}与共享内存{i * 31}的用法。"}
+
+def _write(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return str(path)
+
+def test_leakage_report_and_dedup(tmp_path):
+    test = [_qa(i) for i in range(0, 5)]
+    validation = [_qa(i) for i in range(5, 10)]
+    train = [_qa(i) for i in range(10, 20)]
+    # 近似重复：验证集第0条改一个标点；问题相同回答不同：测试集第1条；训练集内部完全重复
+    train.append({**validation[0], "answer": validation[0]["answer"].replace("。", "！")})
+    train.append({"question": test[1]["question"] + "  ", "answer": "完全不同的另一种说法，讲的是寄存器。"})
+    train.append(dict(train[0]))
+    bank = tmp_path / "基础题集"
+    bank.write_text("第1章 测试\n1.问题：" + validation[2]["question"] + "\n 答案：" + validation[2]["answer"] + "\n",
+                    encoding="utf-8")
+
+    paths = [_write(tmp_path / "test.jsonl", test), _write(tmp_path / "validation.jsonl", validation),
+             _write(tmp_path / "train.jsonl", train), str(bank)]
+    index = DedupIndex(threshold=0.8)
+    index.add_sources(paths)
+    report = index.build().report()
+
+    assert report["leakage"]["validation"] == {"test": 0, "train": 1, "基础题集": 1}
+    assert report["leakage"]["test"]["train"] == 1
+    assert report["overlap"]["train"] == {"test": 1, "validation": 1, "基础题集": 0}
+    assert report["sources"]["train"] == {"path": paths[2], "records": 13, "kept": 10, "duplicates_within": 2}
+    assert report["sources"]["基础题集"]["kept"] == 0
+    examples = {(e["source"], e["line"]): e for e in report["examples"]}
+    assert examples[("train", 12)]["same_question"] and examples[("train", 12)]["duplicate_of"]["line"] == 2
+    assert examples[("基础题集", 2)]["duplicate_of"] == {"source": "validation", "line": 3,
+                                                        "question": validation[2]["question"]}
+
+    counts = index.write_deduplicated(str(tmp_path / "dedup"))
+    assert counts == {"test": 5, "validation": 5, "train": 10, "基础题集": 0}
+    kept_train = [record for _, record, _ in iter_records(str(tmp_path / "dedup" / "train.jsonl"))]
+    assert kept_train == train[:10]
+
+    # 关闭问题匹配后，问题相同但回答不同的记录不再视为重复
+    index = DedupIndex(threshold=0.8, match_questions=False)
+    index.add_sources(paths)
+    assert index.build().report()["leakage"]["test"]["train"] == 0
+
+def test_lsh_matches_pairwise_comparison(tmp_path):
+    """LSH找到的重复簇与两两比较签名得到的簇相同；多进程计算签名的结果与单进程一致"""
+    rng = np.random.RandomState(0)
+    base = [_qa(i) for i in range(30)]
+    records = list(base)
+    for _ in range(40):
+        # 随机删掉回答中的若干字符，得到相似度不同的变体
+        record = dict(base[rng.randint(len(base))])
+        answer = list(record["answer"])
+        for position in sorted(rng.choice(len(answer), rng.randint(1, 12), replace=False), reverse=True):
+            del answer[position]
+        record["answer"] = "".join(answer)
+        records.append(record)
+    path = _write(tmp_path / "corpus.jsonl", records)
+
+    index = DedupIndex(threshold=0.7, match_questions=False)
+    index.add_sources([path])
+    roots = index.build().roots
+
+    hasher = MinHasher(64, 3, 1)
+    signatures = [hasher.signature(normalize_text(r["question"] + r["answer"])) for r in records]
+    parent = list(range(len(records)))
+    for i, j in itertools.combinations(range(len(records)), 2):
+        if MinHasher.similarity(signatures[i], signatures[j]) >= 0.7:
+            ri, rj = parent[i], parent[j]
+            while parent[ri] != ri:
+                ri = parent[ri]
+            while parent[rj] != rj:
+                rj = parent[rj]
+            parent[max(ri, rj)] = min(ri, rj)
+    expected = []
+    for i in range(len(records)):
+        while parent[i] != i:
+            i = parent[i]
+        expected.append(i)
+    assert roots.tolist() == expected
+    assert len(set(expected)) < len(records)
+
+    parallel = DedupIndex(threshold=0.7, match_questions=False, workers=2, batch_size=16)
+    parallel.add_sources([path])
+    assert parallel.build().roots.tolist() == expected
+
+def test_empty_sources(tmp_path):
+    """没有记录时报告为空；命令行找不到任何数据源时给出明确的错误而不是崩溃"""
+    report = DedupIndex().build().report()
+    assert report["records"] == 0 and report["kept"] == 0 and report["examples"] == []
+
+    empty = _write(tmp_path / "empty.jsonl", [])
+    index = DedupIndex()
+    index.add_sources([empty])
+    assert index.build().report()["sources"]["empty"]["records"] == 0
+
+    for argv, message in ((["--dataset_path", str(tmp_path / "nonexistent")], "没有可检查的数据源"),
+                          ([str(tmp_path / "missing.jsonl")], "数据源不存在")):
+        try:
+            main(argv)
+        except SystemExit as error:
+            assert message in str(error)
+        else:
+            raise AssertionError(f"{argv} 应当报错退出")
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_leakage_report_and_dedup, test_lsh_matches_pairwise_comparison, test_empty_sources):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test(pathlib.Path(tmp_dir))
+    print("✅ 近似重复检测测试通过!")
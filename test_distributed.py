@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据并行测试
+用 torchrun 在CPU上以gloo后端启动两个进程训练并评估微型模型；
+本文件同时是被启动的工作进程脚本
+"""
+
+import json
+import os
+import subprocess
+import sys
+from argparse import Namespace
+
+import torch
+from datasets import Dataset
+
+from gpu_distributed import shard_indices
+
+WORLD_SIZE = 2
+
+QA_PAIRS = [{"question": f"第{i}个GPU问题" + "？" * (i % 5), "answer": f"回答{i}：GPU" + "很快" * (i % 3)}
+            for i in range(16)]
+
+# 构建微型分词器词表所需的全部文本
+TEXTS = [qa["question"] + qa["answer"] for qa in QA_PAIRS]
+
+def _args(output_dir):
+    return Namespace(
+        output_dir=output_dir, cache_dir=None, lora_rank=4, learning_rate=1e-3,
+        per_device_train_batch_size=2, gradient_accumulation_steps=1, max_steps=4,
+        eval_steps=2, save_steps=4, max_seq_length=256, packing=False, group_by_length_buckets=True,
+        chunked_loss=False, loss_chunk_size=1024, resume_from_checkpoint=None,
+        eval_batch_size=3, max_new_tokens=6, metric_level="char", prefix_cache=False, draft_output_dir=None,
+        training_metrics="jsonl", metrics_port=None, metrics_host="127.0.0.1", peak_tflops=None,
+        training_metrics_breakdown=False, sync_checkpoints=False, keep_last_checkpoints=3,
+    )
+
+def run_worker(output_dir):
+    """每个rank训练4步并参与分布式评估，记录本rank训练时见过的样本"""
+    from gpu_distributed import get_rank, init_distributed
+    from gpu_llm_finetune import evaluate_model, preprocess_gpu_qa, train_model
+    from tiny_model import create_tiny_model_and_tokenizer
+
+    init_distributed()
+    model, tokenizer = create_tiny_model_and_tokenizer(TEXTS)
+    model.train()
+    raw = Dataset.from_list(QA_PAIRS)
+    dataset = raw.map(preprocess_gpu_qa, batched=True, remove_columns=raw.column_names,
+                      fn_kwargs={"tokenizer": tokenizer, "max_length": 256})
+
+    seen = []
+
+    def record_batch(module, args):
+        if module.training:
+            seen.extend(tokenizer.decode(ids, skip_special_tokens=True) for ids in args[0])
+
+    model.get_input_embeddings().register_forward_pre_hook(record_batch)
+
+    args = _args(output_dir)
+    model = train_model(model, tokenizer, dataset, dataset, args)
+    model.eval()
+    evaluate_model(model, tokenizer, raw, args)
+
+    with open(os.path.join(output_dir, f"seen_rank{get_rank()}.json"), "w", encoding="utf-8") as f:
+        json.dump(seen, f, ensure_ascii=False)
+
+def run_chunked_loss_worker(output_dir):
+    """每个rank在同一批次上分别以完整损失和分块损失执行一次训练步，记录损失和LoRA梯度"""
+    from peft import get_peft_model
+    from trl import SFTConfig
+
+    from gpu_batching import AssistantMaskCollator
+    from gpu_distributed import get_rank, init_distributed
+    from gpu_llm_finetune import preprocess_gpu_qa, setup_lora_config
+    from gpu_trainer import GPUQATrainer
+    from tiny_model import create_tiny_model_and_tokenizer
+
+    init_distributed()
+    results = {}
+    for chunked in (False, True):
+        model, tokenizer = create_tiny_model_and_tokenizer(TEXTS)
+        model = get_peft_model(model, setup_lora_config(4))
+        raw = Dataset.from_list(QA_PAIRS)
+        dataset = raw.map(preprocess_gpu_qa, batched=True, remove_columns=raw.column_names,
+                          fn_kwargs={"tokenizer": tokenizer, "max_length": 256})
+        training_args = SFTConfig(output_dir=output_dir, use_cpu=True, bf16=False, report_to="none",
+                                  remove_unused_columns=False, max_length=256, dataset_text_field="text")
+        trainer = GPUQATrainer(model=model, train_dataset=dataset, args=training_args,
+                               data_collator=AssistantMaskCollator(tokenizer.pad_token_id),
+                               processing_class=tokenizer, chunked_loss=chunked, loss_chunk_size=16)
+        # 两个rank使用不同的样本，token数不同
+        rank = get_rank()
+        batch = trainer.data_collator([dataset[i] for i in range(rank * 4, rank * 4 + 3 + rank)])
+        batch = trainer._prepare_inputs(batch)
+        num_items_in_batch = trainer._get_num_items_in_batch([batch], trainer.args.device)
+        model.train()
+        loss = trainer.training_step(model, batch, num_items_in_batch)
+        results[chunked] = {
+            "loss": loss.item(),
+            "num_items_in_batch": int(num_items_in_batch),
+            "grads": {name: param.grad.flatten().tolist() for name, param in model.named_parameters()
+                      if param.requires_grad},
+        }
+
+    with open(os.path.join(output_dir, f"loss_rank{rank}.json"), "w", encoding="utf-8") as f:
+        json.dump({"full": results[False], "chunked": results[True]}, f)
+
+def _torchrun(*args):
+    env = dict(os.environ, OMP_NUM_THREADS="1", CUDA_VISIBLE_DEVICES="")
+    command = [sys.executable, "-m", "torch.distributed.run", "--standalone", "--nproc_per_node", str(WORLD_SIZE),
+               os.path.abspath(__file__), *args]
+    completed = subprocess.run(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True, timeout=600)
+    assert completed.returncode == 0, completed.stderr[-3000:]
+
+def test_shard_indices_cover_all_items():
+    shards = [shard_indices(7, rank, 3) for rank in range(3)]
+    assert sorted(i for shard in shards for i in shard) == list(range(7))
+    assert [len(shard) for shard in shards] == [3, 2, 2]
+
+def test_data_parallel_train_and_eval(tmp_path):
+    """两个进程各取不同的训练样本；0号进程保存适配器，并收集全部回答写入评估结果"""
+    from peft import PeftModel
+
+    from gpu_llm_finetune import generate_answers
+    from tiny_model import create_tiny_model_and_tokenizer
+
+    _torchrun(str(tmp_path))
+
+    # 每步两个rank各处理一个批次，4步恰好覆盖全部16条样本且互不重复
+    seen = [json.load(open(tmp_path / f"seen_rank{rank}.json", encoding="utf-8")) for rank in range(WORLD_SIZE)]
+    assert len(seen[0]) == len(seen[1]) == 8
+    assert not set(seen[0]) & set(seen[1])
+    assert len(set(seen[0]) | set(seen[1])) == len(QA_PAIRS)
+
+    assert (tmp_path / "adapter_model.safetensors").exists()
+    # 吞吐量指标只由0号进程写入，每个优化步一条
+    with open(tmp_path / "training_metrics.jsonl", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [r["step"] for r in records] == [1, 2, 3, 4]
+    assert all(r["world_size"] == WORLD_SIZE for r in records)
+    with open(tmp_path / "evaluation_results.json", encoding="utf-8") as f:
+        results = json.load(f)
+    assert [r["question"] for r in results] == [qa["question"] for qa in QA_PAIRS]
+
+    # 分布式评估的回答与单进程加载同一适配器生成的回答一致
+    model, tokenizer = create_tiny_model_and_tokenizer(TEXTS)
+    model = PeftModel.from_pretrained(model, str(tmp_path))
+    model.eval()
+    with torch.no_grad():
+        expected = generate_answers(model, tokenizer, [qa["question"] for qa in QA_PAIRS], batch_size=3, max_new_tokens=6)
+    assert [r["generated_answer"] for r in results] == expected
+
+def test_chunked_loss_matches_full_loss_across_ranks(tmp_path):
+    """数据并行时按所有进程的token数归一化：分块损失与完整损失的数值和梯度一致"""
+    _torchrun("--chunked_loss", str(tmp_path))
+    for rank in range(WORLD_SIZE):
+        with open(tmp_path / f"loss_rank{rank}.json", encoding="utf-8") as f:
+            results = json.load(f)
+        full, chunked = results["full"], results["chunked"]
+        # num_items_in_batch 是两个rank的token总数，损失需要乘回进程数
+        assert full["num_items_in_batch"] == chunked["num_items_in_batch"] > 0
+        assert abs(full["loss"] - chunked["loss"]) < 1e-4 * abs(full["loss"])
+        assert full["grads"].keys() == chunked["grads"].keys()
+        for name in full["grads"]:
+            expected, actual = torch.tensor(full["grads"][name]), torch.tensor(chunked["grads"][name])
+            assert torch.allclose(actual, expected, rtol=1e-4, atol=1e-7), name
+        assert any(any(value != 0 for value in grads) for grads in full["grads"].values())
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--chunked_loss":
+        run_chunked_loss_worker(sys.argv[2])
+    else:
+        run_worker(sys.argv[1])
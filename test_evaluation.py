@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+评估流程测试
+使用随机初始化的微型Qwen3模型在CPU上验证批量生成等评估逻辑
+"""
+
+import json
+import math
+import os
+from argparse import Namespace
+
+from datasets import Dataset
+from peft import LoraConfig, PeftModel, get_peft_model
+
+from gpu_batching import AssistantMaskCollator
+from gpu_llm_finetune import (evaluate_loss, evaluate_model, evaluate_model_parallel, evaluate_model_streaming,
+                              generate_answers, preprocess_gpu_qa)
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = [
+    "什么是GPU？",
+    "What is CUDA?",
+    "显存不足怎么办？请给出详细的解决方案",
+    "GPU和CPU有什么区别？",
+    "Why do warps diverge on branches inside a kernel?",
+]
+
+def test_batched_generation_matches_serial():
+    """贪心解码下批量生成与逐条生成的结果一致，且按输入顺序返回"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+
+    serial = generate_answers(model, tokenizer, QUESTIONS, batch_size=1, max_new_tokens=16)
+    batched = generate_answers(model, tokenizer, QUESTIONS, batch_size=4, max_new_tokens=16)
+
+    assert len(serial) == len(QUESTIONS)
+    assert batched == serial
+    assert tokenizer.padding_side == "right"
+
+def test_streaming_evaluation_resumes_from_partial_results(tmp_path):
+    """流式评估中断后续评，只补齐缺失的样本（按行号，重复的问题各自评估），汇总与一次性评估一致"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    rows = [{"question": q, "answer": q[::-1]} for q in QUESTIONS] + [{"question": QUESTIONS[0], "answer": "GPU"}]
+    dataset = Dataset.from_list(rows)
+    args = Namespace(output_dir=str(tmp_path), eval_batch_size=2, max_new_tokens=8,
+                     metric_level="char", cache_dir=None, prefix_cache=False, draft_output_dir=None)
+    results_file = os.path.join(tmp_path, "evaluation_results.jsonl")
+
+    full = evaluate_model_streaming(model, tokenizer, dataset, args)
+    with open(results_file, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    assert len(lines) == len(rows)
+
+    # 模拟中断：保留两条完整记录和一条写了一半的记录
+    with open(results_file, "w", encoding="utf-8") as f:
+        f.writelines(lines[:2])
+        f.write(lines[2][:10])
+
+    resumed = evaluate_model_streaming(model, tokenizer, dataset, args)
+    with open(results_file, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+
+    assert sorted(r["index"] for r in records) == list(range(len(rows)))
+    assert all(r["question"] == rows[r["index"]]["question"] for r in records)
+    assert all(abs(resumed[name] - full[name]) < 1e-9 for name in full)
+    with open(os.path.join(tmp_path, "evaluation_summary.json"), "r", encoding="utf-8") as f:
+        assert json.load(f)["num_examples"] == len(rows)
+
+    # 旧版本写的记录没有 index，按问题文本依次对应，重复的问题不会被当作已评估
+    with open(results_file, "w", encoding="utf-8") as f:
+        for line in lines[:2]:
+            record = json.loads(line)
+            del record["index"]
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    evaluate_model_streaming(model, tokenizer, dataset, args)
+    with open(results_file, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(r["question"] for r in records) == sorted(row["question"] for row in rows)
+
+def _load_tiny_peft_model(args, device_map=None):
+    """并行评估工作进程中加载微型模型及保存的适配器"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    return PeftModel.from_pretrained(model, args.output_dir).eval(), tokenizer
+
+def test_parallel_evaluation_matches_single_process(tmp_path):
+    """多进程并行评估按原始顺序合并结果，与单进程评估完全一致"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    # 随机初始化LoRA的B矩阵，使适配器真正改变输出
+    lora_config = LoraConfig(r=4, target_modules=["q_proj", "v_proj"], init_lora_weights=False)
+    model = get_peft_model(model, lora_config)
+    model.save_pretrained(str(tmp_path))
+    model.eval()
+
+    dataset = Dataset.from_list([{"question": q, "answer": q[::-1]} for q in QUESTIONS])
+    args = Namespace(output_dir=str(tmp_path), eval_batch_size=2, max_new_tokens=8,
+                     metric_level="char", cache_dir=None, prefix_cache=False, draft_output_dir=None)
+    results_file = os.path.join(tmp_path, "evaluation_results.json")
+
+    expected_averages = evaluate_model(model, tokenizer, dataset, args)
+    with open(results_file, "r", encoding="utf-8") as f:
+        expected = json.load(f)
+
+    averages = evaluate_model_parallel(dataset, args, num_workers=2, load_model=_load_tiny_peft_model)
+    with open(results_file, "r", encoding="utf-8") as f:
+        assert json.load(f) == expected
+    assert averages == expected_averages
+
+def test_loss_evaluation_matches_model_loss(tmp_path):
+    """教师强制评估的逐条NLL与模型对单条样本计算的助手损失一致，不受批内填充影响，汇总按token加权"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    lora_config = LoraConfig(r=4, target_modules=["q_proj", "v_proj"], init_lora_weights=False)
+    model = get_peft_model(model, lora_config)
+    model.train()
+    dataset = Dataset.from_list([{"question": q, "answer": q[::-1] * 2} for q in QUESTIONS])
+    args = Namespace(output_dir=str(tmp_path), eval_batch_size=3, max_seq_length=256)
+
+    averages = evaluate_loss(model, tokenizer, dataset, args)
+    assert model.training
+    with open(os.path.join(tmp_path, "evaluation_results.json"), "r", encoding="utf-8") as f:
+        results = json.load(f)
+    with open(os.path.join(tmp_path, "evaluation_summary.json"), "r", encoding="utf-8") as f:
+        summary = json.load(f)
+
+    model.eval()
+    features = preprocess_gpu_qa(dataset[:], tokenizer, max_length=256)
+    collator = AssistantMaskCollator(tokenizer.pad_token_id)
+    total_nll, total_tokens = 0.0, 0
+    for i, record in enumerate(results):
+        assert record["question"] == QUESTIONS[i]
+        batch = collator([{"input_ids": features["input_ids"][i], "assistant_mask": features["assistant_mask"][i]}])
+        expected = model(**batch).loss.item()
+        assert record["num_tokens"] == sum(features["assistant_mask"][i][1:])
+        assert abs(record["nll"] - expected) < 1e-4
+        assert abs(record["perplexity"] - math.exp(expected)) < 1e-3 * math.exp(expected)
+        total_nll += record["nll"] * record["num_tokens"]
+        total_tokens += record["num_tokens"]
+    assert abs(averages["nll"] - total_nll / total_tokens) < 1e-6
+    assert summary == {"num_examples": len(QUESTIONS), "num_tokens": total_tokens, **averages}
+
+    # 逐条计算与批量计算一致
+    single = evaluate_loss(model, tokenizer, dataset, Namespace(output_dir=str(tmp_path), eval_batch_size=1,
+                                                                max_seq_length=256))
+    assert abs(single["nll"] - averages["nll"]) < 1e-5
+
+if __name__ == "__main__":
+    import tempfile
+    test_batched_generation_matches_serial()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_streaming_evaluation_resumes_from_partial_results(tmp_dir)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_parallel_evaluation_matches_single_process(tmp_dir)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_loss_evaluation_matches_model_loss(tmp_dir)
+    print("✅ 评估流程测试通过!")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合并模型导出测试
+在CPU上用微型模型验证合并导出后的输出与LoRA模型一致，并能被评估代码自动识别
+"""
+
+import os
+from argparse import Namespace
+
+import torch
+from peft import LoraConfig, get_peft_model
+
+from gpu_export import DEFAULT_EXPORT_SUBDIR, MERGED_MODEL_MARKER, export_merged_model, find_merged_model
+from gpu_llm_finetune import generate_answers, load_model_for_eval
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = ["什么是GPU？", "What is CUDA?", "显存不足怎么办？"]
+
+def _peft_model(adapter_dir):
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    lora_config = LoraConfig(r=4, target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj"],
+                             init_lora_weights=False)
+    model = get_peft_model(model, lora_config)
+    model.save_pretrained(adapter_dir)
+    model.eval()
+    return model, tokenizer
+
+def test_merged_export_matches_adapter(tmp_path):
+    """导出为单个safetensors文件，评估时自动加载，生成结果与LoRA模型一致"""
+    adapter_dir = str(tmp_path)
+    model, tokenizer = _peft_model(adapter_dir)
+    input_ids = tokenizer(QUESTIONS[0], return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        expected_logits = model(input_ids).logits
+    expected_answers = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=8)
+
+    export_dir = os.path.join(adapter_dir, DEFAULT_EXPORT_SUBDIR)
+    export_merged_model(model, tokenizer, export_dir, adapter_dir=adapter_dir)
+    files = os.listdir(export_dir)
+    assert [name for name in files if name.endswith(".safetensors")] == ["model.safetensors"]
+    assert "tokenizer.json" in files and MERGED_MODEL_MARKER in files
+
+    # 指定适配器目录即可识别其中的导出，加载的是不含LoRA模块的普通模型
+    args = Namespace(output_dir=adapter_dir, resume_from_checkpoint=None)
+    merged, merged_tokenizer = load_model_for_eval(args)
+    assert not any("lora" in name for name, _ in merged.named_parameters())
+    with torch.no_grad():
+        assert torch.allclose(merged(input_ids).logits, expected_logits, atol=1e-4)
+    assert generate_answers(merged, merged_tokenizer, QUESTIONS, batch_size=2, max_new_tokens=8) == expected_answers
+
+def test_stale_export_is_ignored(tmp_path):
+    """适配器重新训练后，旧的导出不再被识别"""
+    adapter_dir = str(tmp_path)
+    model, tokenizer = _peft_model(adapter_dir)
+    export_dir = export_merged_model(model, tokenizer, os.path.join(adapter_dir, DEFAULT_EXPORT_SUBDIR),
+                                     quantize="fp16", adapter_dir=adapter_dir)
+    assert find_merged_model(adapter_dir) == export_dir
+    assert find_merged_model(export_dir) == export_dir
+
+    with open(os.path.join(adapter_dir, "adapter_model.safetensors"), "ab") as f:
+        f.write(b"\0")
+    assert find_merged_model(adapter_dir) is None
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式读取与校验测试
+验证按字节区间切块后逐块校验与整体校验结果一致、行号正确，多进程下按字符级分词器统计超长样本，
+以及格式转换与数据集写入复用同一套解析逻辑
+"""
+
+import json
+
+from convert_dataset_format import convert_messages_to_qa
+from gpu_ingest import chunk_ranges, iter_records, validate_file, validate_range, write_jsonl
+from tiny_model import create_tiny_tokenizer
+
+def _write_corpus(path, repeat=1):
+    """每组10行：正常、messages格式、空行、JSON错误、缺字段、空回答、非UTF-8、超长、无关键词、正常"""
+    good = {"question": "什么是CUDA？", "answer": "CUDA是NVIDIA的并行计算平台。"}
+    lines = [
+        json.dumps(good, ensure_ascii=False).encode("utf-8"),
+        json.dumps({"messages": [{"role": "system", "content": "s"}, {"role": "user", "content": "GPU是什么？"},
+                                 {"role": "assistant", "content": "图形处理器"}]}, ensure_ascii=False).encode("utf-8"),
+        b"",
+        b'{"question": "broken',
+        json.dumps({"question": "显存"}, ensure_ascii=False).encode("utf-8"),
+        json.dumps({"question": "显存不足？", "answer": "  "}, ensure_ascii=False).encode("utf-8"),
+        b'{"question": "\xff\xfe", "answer": "x"}',
+        json.dumps({"question": "GPU" * 100, "answer": "并行" * 200}, ensure_ascii=False).encode("utf-8"),
+        json.dumps({"question": "今天天气如何？", "answer": "晴"}, ensure_ascii=False).encode("utf-8"),
+        json.dumps(good, ensure_ascii=False).encode("utf-8"),
+    ]
+    with open(path, "wb") as f:
+        for _ in range(repeat):
+            f.write(b"\n".join(lines) + b"\n")
+    return len(lines)
+
+def test_chunked_validation_matches_sequential(tmp_path):
+    """任意切块都对齐行首，合并后的统计和全局行号与顺序校验一致"""
+    path = str(tmp_path / "corpus.jsonl")
+    group = _write_corpus(path, repeat=5)
+
+    ranges = chunk_ranges(path, 7)
+    assert ranges[0][0] == 0
+    with open(path, "rb") as f:
+        data = f.read()
+    assert ranges[-1][1] == len(data)
+    for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+        assert end == next_start and data[next_start - 1:next_start] == b"\n"
+
+    sequential = validate_file(path, num_workers=1, chunk_size=1 << 30).to_dict()
+    chunked = validate_file(path, num_workers=1, chunk_size=97).to_dict()
+    assert chunked == sequential
+    assert sequential["records"] == 45 and sequential["valid"] == 25
+    assert sequential["errors"] == {"encoding": 5, "json": 5, "schema": 5, "empty_question": 0, "empty_answer": 5}
+    assert sequential["warnings"]["no_keyword"] == 5 and sequential["tokens"] is None
+    assert [e["line"] for e in sequential["examples"] if e["type"] == "json"] == [4 + i * group for i in range(5)]
+
+def test_parallel_token_lengths(tmp_path):
+    """多进程校验时按目标分词器渲染完整对话计算token数，超过最大长度的样本计为警告"""
+    path = str(tmp_path / "corpus.jsonl")
+    group = _write_corpus(path, repeat=3)
+    tokenizer = create_tiny_tokenizer(["GPU并行什么是显存不足今天天气如何晴图形处理器"])
+
+    report = validate_file(path, tokenizer, max_length=256, num_workers=2, chunk_size=200).to_dict()
+    assert report["valid"] == 15
+    assert report["warnings"]["too_long"] == 3
+    assert [e["line"] for e in report["examples"] if e["type"] == "too_long"] == [8 + i * group for i in range(3)]
+    assert report["tokens"]["max"] > 500 and report["tokens"]["histogram"][">4096"] == 0
+
+    # 单个区间的校验可直接传入分词器
+    single = validate_range(path, 0, chunk_ranges(path, 1)[0][1], max_length=256, tokenizer=tokenizer)
+    assert single.warnings["too_long"] == 3
+
+def test_convert_and_write_share_parser(tmp_path):
+    """格式转换把messages格式规范为question-answer，跳过错误行；写入的数据集可被原样读回"""
+    source = str(tmp_path / "corpus.jsonl")
+    _write_corpus(source)
+    output = str(tmp_path / "converted.jsonl")
+    assert convert_messages_to_qa(source, output) == 5
+    records = [record for _, record, error in iter_records(output)]
+    assert records[1] == {"question": "GPU是什么？", "answer": "图形处理器"}
+
+    path = str(tmp_path / "nested" / "train.jsonl")
+    assert write_jsonl(records, path) == 5
+    assert [record for _, record, _ in iter_records(path)] == records
+
+    # 带UTF-8 BOM的文件（如Windows记事本保存）第一行正常解析，question-answer格式的行连同其他字段原样复制
+    bom_record = {"question": "什么是SM？", "answer": "GPU的流式多处理器", "source": "manual"}
+    bom_source = tmp_path / "bom.jsonl"
+    bom_source.write_bytes(b"\xef\xbb\xbf" + json.dumps(bom_record, ensure_ascii=False).encode("utf-8") + b"\n")
+    assert [error for _, _, error in iter_records(str(bom_source))] == [None]
+    assert validate_file(str(bom_source), num_workers=1).to_dict()["valid"] == 1
+    assert convert_messages_to_qa(str(bom_source), output) == 1
+    with open(output, "r", encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == [bom_record]
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_chunked_validation_matches_sequential, test_parallel_token_lengths,
+                 test_convert_and_write_share_parser):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test(pathlib.Path(tmp_dir))
+    print("✅ 流式读取与校验测试通过!")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量评估指标测试
+在ASCII输入上与原有的逐样本实现（rouge库 + nltk sentence_bleu）对比打分结果；
+含重复token的输入与按多重集定义的ROUGE参考实现对比（rouge库按集合统计，此时结果不同）
+"""
+
+import random
+from collections import Counter
+
+from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
+from rouge import Rouge
+
+import gpu_metrics
+from gpu_metrics import BatchScorer, load_reference_table, score_batch
+
+WORDS = ["gpu", "cuda", "kernel", "warp", "thread", "block", "memory", "shared",
+         "global", "cache", "tensor", "core", "sm", "latency", "bandwidth", "stream"]
+
+def _random_pairs(count, seed=0):
+    """生成随机的ASCII问答对；ROUGE对比要求句内单词不重复（rouge库按集合统计n-gram）"""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(count):
+        reference = " ".join(rng.sample(WORDS, rng.randint(1, 10)))
+        hypothesis = " ".join(rng.sample(WORDS, rng.randint(1, 10)))
+        pairs.append((hypothesis, reference))
+    return pairs
+
+def _repeated_pairs(count, seed=0):
+    """单词可以重复的随机问答对"""
+    rng = random.Random(seed)
+    words = WORDS[:5]
+    return [(" ".join(rng.choices(words, k=rng.randint(1, 12))), " ".join(rng.choices(words, k=rng.randint(1, 12))))
+            for _ in range(count)]
+
+def _f1(overlap, hyp_total, ref_total):
+    precision = overlap / hyp_total if hyp_total else 0.0
+    recall = overlap / ref_total if ref_total else 0.0
+    return 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+
+def _multiset_rouge(hypothesis, reference):
+    """按ROUGE原始定义的参考实现：n-gram截断计数，ROUGE-L为最长公共子序列长度"""
+    hyp, ref = hypothesis.split(), reference.split()
+    scores = {}
+    for n in (1, 2):
+        hyp_ngrams = Counter(tuple(hyp[i:i + n]) for i in range(len(hyp) - n + 1))
+        ref_ngrams = Counter(tuple(ref[i:i + n]) for i in range(len(ref) - n + 1))
+        overlap = sum((hyp_ngrams & ref_ngrams).values())
+        scores[f"rouge-{n}"] = _f1(overlap, sum(hyp_ngrams.values()), sum(ref_ngrams.values()))
+    table = [[0] * (len(ref) + 1) for _ in range(len(hyp) + 1)]
+    for i, h in enumerate(hyp):
+        for j, r in enumerate(ref):
+            table[i + 1][j + 1] = table[i][j] + 1 if h == r else max(table[i][j + 1], table[i + 1][j])
+    scores["rouge-l"] = _f1(table[-1][-1], len(hyp), len(ref))
+    return scores
+
+def test_rouge_with_repeated_tokens():
+    """有重复单词时按多重集统计，与参考实现一致；rouge库按集合统计，分数与之不同"""
+    pairs = _repeated_pairs(200) + [("gpu gpu gpu", "gpu"), ("gpu", "gpu gpu cuda")]
+    scores = score_batch([h for h, _ in pairs], [r for _, r in pairs], level="word")
+    for i, (hypothesis, reference) in enumerate(pairs):
+        expected = _multiset_rouge(hypothesis, reference)
+        for name in ["rouge-1", "rouge-2", "rouge-l"]:
+            assert abs(scores[name][i] - expected[name]) < 1e-9, (name, hypothesis, reference)
+
+    # "gpu gpu gpu" 对 "gpu"：多重集下精确率为1/3，rouge库去重后为1
+    assert abs(scores["rouge-1"][-2] - 0.5) < 1e-6
+    assert abs(Rouge().get_scores("gpu gpu gpu", "gpu")[0]["rouge-1"]["f"] - 1.0) < 1e-6
+
+def test_rouge_matches_rouge_library():
+    """按空格分词且没有重复单词时，ROUGE-1/2/L与rouge库的F值一致"""
+    pairs = _random_pairs(200)
+    hypotheses = [h for h, _ in pairs]
+    references = [r for _, r in pairs]
+
+    scores = score_batch(hypotheses, references, level="word")
+
+    rouge = Rouge()
+    for i, (hypothesis, reference) in enumerate(pairs):
+        expected = rouge.get_scores(hypothesis, reference)[0]
+        for name in ["rouge-1", "rouge-2", "rouge-l"]:
+            assert abs(scores[name][i] - expected[name]["f"]) < 1e-9, (name, hypothesis, reference)
+
+def test_bleu_matches_nltk():
+    """按字符切分时，BLEU与nltk sentence_bleu + method4平滑一致"""
+    pairs = _random_pairs(200, seed=1) + [("a", "abc"), ("ab", "ab"), ("xyz", "gpu"), ("warp", "w")]
+    hypotheses = [h for h, _ in pairs]
+    references = [r for _, r in pairs]
+
+    scores = score_batch(hypotheses, references, level="char")
+
+    smoothing = SmoothingFunction().method4
+    for i, (hypothesis, reference) in enumerate(pairs):
+        expected = sentence_bleu([list(reference)], list(hypothesis), smoothing_function=smoothing)
+        assert abs(scores["bleu"][i] - expected) < 1e-9, (hypothesis, reference)
+
+def test_subset_scoring_and_reference_cache(tmp_path):
+    """按下标对部分样本打分与整体打分一致，参考答案表可从磁盘缓存加载"""
+    references = ["什么是GPU？", "显存不足怎么办", "CUDA是并行计算平台"]
+    hypotheses = ["GPU是图形处理器", "显存不足可以减小batch", "CUDA平台"]
+
+    scorer = BatchScorer(references, cache_dir=str(tmp_path))
+    full = scorer.score(hypotheses)
+    subset = scorer.score([hypotheses[2], hypotheses[0]], indices=[2, 0])
+    for name in full:
+        assert abs(subset[name][0] - full[name][2]) < 1e-12
+        assert abs(subset[name][1] - full[name][0]) < 1e-12
+
+    assert len(list(tmp_path.iterdir())) == 1
+    assert load_reference_table(references, cache_dir=str(tmp_path)) is scorer.table
+
+    # 打分代码版本变化后不复用旧的缓存表
+    version = gpu_metrics.SCORER_VERSION
+    try:
+        gpu_metrics.SCORER_VERSION = version + 1
+        assert load_reference_table(references, cache_dir=str(tmp_path)) is not scorer.table
+        assert len(list(tmp_path.iterdir())) == 2
+    finally:
+        gpu_metrics.SCORER_VERSION = version
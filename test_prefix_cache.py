@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+系统提示词前缀缓存测试
+在CPU上用微型模型验证复用前缀KV缓存的生成结果与完整编码一致，且模型变化后缓存失效
+"""
+
+import asyncio
+
+import torch
+from peft import LoraConfig, get_peft_model
+
+from gpu_llm_finetune import build_generation_prompt, generate_answers
+from gpu_prefix_cache import get_prefix_cache
+from gpu_serving import ContinuousBatchingEngine
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = [
+    "什么是GPU？",
+    "What is CUDA?",
+    "显存不足怎么办？请给出详细的解决方案",
+    "GPU和CPU有什么区别？",
+    "什么是Tensor Core？",
+]
+
+def _peft_model():
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    lora_config = LoraConfig(r=4, target_modules=["q_proj", "v_proj"], init_lora_weights=False)
+    return get_peft_model(model, lora_config).eval(), tokenizer
+
+def _count_forward_tokens(model):
+    """记录每次前向输入的token数"""
+    counts = []
+    model.get_base_model().model.register_forward_pre_hook(
+        lambda module, args, kwargs: counts.append(kwargs["input_ids"].shape[1]), with_kwargs=True)
+    return counts
+
+def test_prefix_cache_matches_full_prompt():
+    """批量生成复用前缀缓存，结果与完整编码提示一致，预填充只编码问题部分"""
+    model, tokenizer = _peft_model()
+    expected = generate_answers(model, tokenizer, QUESTIONS, batch_size=3, max_new_tokens=8)
+
+    cache = get_prefix_cache(model, tokenizer, build_generation_prompt)
+    assert get_prefix_cache(model, tokenizer, build_generation_prompt) is cache
+    full_lengths = [len(ids) for ids in tokenizer([build_generation_prompt(tokenizer, q) for q in QUESTIONS])["input_ids"]]
+    assert 0 < len(cache.prefix_ids) < min(full_lengths)
+
+    counts = _count_forward_tokens(model)
+    answers = generate_answers(model, tokenizer, QUESTIONS, batch_size=3, max_new_tokens=8, prefix_cache=cache)
+    assert answers == expected
+    # 前缀只计算一次，之后每个批次的预填充都不再包含前缀
+    assert counts[0] == len(cache.prefix_ids)
+    assert max(counts[1:]) == max(full_lengths) - len(cache.prefix_ids)
+    assert cache.stats == {"hits": 2, "misses": 0, "rebuilds": 0}
+
+def test_prefix_cache_rebuilds_after_adapter_change():
+    """适配器权重变化后前缀缓存重新计算，生成结果与新权重下的完整编码一致"""
+    model, tokenizer = _peft_model()
+    cache = get_prefix_cache(model, tokenizer, build_generation_prompt)
+    generate_answers(model, tokenizer, QUESTIONS[:2], batch_size=2, max_new_tokens=8, prefix_cache=cache)
+
+    with torch.no_grad():
+        for name, parameter in model.named_parameters():
+            if "lora_B" in name:
+                parameter.mul_(-3.0)
+    expected = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=8)
+    answers = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=8, prefix_cache=cache)
+    assert answers == expected
+    assert cache.stats["rebuilds"] == 1
+
+    # 禁用适配器同样使缓存失效
+    with model.disable_adapter():
+        expected = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=8)
+        answers = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=8, prefix_cache=cache)
+    assert answers == expected
+
+def test_serving_engine_with_prefix_cache():
+    """连续批处理引擎的预填充复用前缀缓存，结果与逐条生成一致"""
+    model, tokenizer = _peft_model()
+    cache = get_prefix_cache(model, tokenizer, build_generation_prompt)
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=3, max_new_tokens=8, prefix_cache=cache)
+
+    async def complete(question, max_new_tokens):
+        return "".join([delta async for delta, _ in engine.generate(
+            [{"role": "user", "content": question}], max_new_tokens=max_new_tokens)])
+
+    async def run():
+        await engine.start()
+        try:
+            return await asyncio.gather(*[complete(q, 8 - i) for i, q in enumerate(QUESTIONS)])
+        finally:
+            await engine.stop()
+
+    results = asyncio.run(run())
+    for i, (question, text) in enumerate(zip(QUESTIONS, results)):
+        expected = generate_answers(model, tokenizer, [question], batch_size=1, max_new_tokens=8 - i)[0]
+        assert text.strip() == expected
+    assert engine.metrics()["prefix_cache"]["hits"] >= 1
+
+if __name__ == "__main__":
+    test_prefix_cache_matches_full_prompt()
+    test_prefix_cache_rebuilds_after_adapter_change()
+    test_serving_engine_with_prefix_cache()
+    print("✅ 前缀缓存测试通过!")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据预处理测试
+使用字符级微型分词器在CPU上验证预处理、助手掩码及磁盘缓存
+"""
+
+import json
+import os
+from argparse import Namespace
+
+from gpu_llm_finetune import (
+    build_generation_prompt,
+    check_assistant_mask,
+    load_preprocessed_dataset,
+    preprocess_gpu_qa,
+)
+from tiny_model import create_tiny_tokenizer
+
+QA_PAIRS = [
+    {"question": "什么是GPU？", "answer": "GPU是图形处理器。"},
+    {"question": "What is CUDA?", "answer": "CUDA is a parallel computing platform."},
+    {"question": "显存不足怎么办？", "answer": "减小batch size或使用梯度累积。"},
+]
+
+# 构建微型分词器词表所需的全部文本
+TEXTS = [qa["question"] + qa["answer"] for qa in QA_PAIRS]
+
+def _write_split(dataset_dir, split, records):
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(os.path.join(dataset_dir, f"{split}.jsonl"), "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def test_preprocessed_dataset_cache(tmp_path):
+    """第二次加载直接命中缓存；数据内容或最大长度变化时重新预处理"""
+    dataset_dir = os.path.join(tmp_path, "GPU-QA")
+    _write_split(dataset_dir, "train", QA_PAIRS)
+    tokenizer = create_tiny_tokenizer()
+    args = Namespace(output_dir=str(tmp_path), cache_dir=None, max_seq_length=64)
+
+    def cache_entries():
+        return sorted(os.listdir(os.path.join(tmp_path, "cache", "preprocessed")))
+
+    first = load_preprocessed_dataset(dataset_dir, "train", tokenizer, args)
+    entries = cache_entries()
+    assert len(entries) == 1
+    assert max(len(ids) for ids in first["input_ids"]) <= 64
+
+    # 同一分词器的不同实例共享缓存
+    second = load_preprocessed_dataset(dataset_dir, "train", create_tiny_tokenizer(), args)
+    assert cache_entries() == entries
+    assert second["input_ids"] == first["input_ids"]
+
+    args.max_seq_length = 32
+    load_preprocessed_dataset(dataset_dir, "train", tokenizer, args)
+    assert len(cache_entries()) == 2
+
+    _write_split(dataset_dir, "train", QA_PAIRS[:2])
+    changed = load_preprocessed_dataset(dataset_dir, "train", tokenizer, args)
+    assert len(cache_entries()) == 3
+    assert len(changed) == 2
+
+def _masked_texts(tokenizer, example):
+    input_ids, mask = example["input_ids"], example["assistant_mask"]
+    masked = tokenizer.decode([t for t, keep in zip(input_ids, mask) if keep])
+    unmasked = tokenizer.decode([t for t, keep in zip(input_ids, mask) if not keep])
+    return masked, unmasked
+
+def test_assistant_mask_boundaries():
+    """对话模板路径和硬编码<|im_start|>备用路径下，掩码都恰好覆盖回答及其<|im_end|>"""
+    batch = {"question": [qa["question"] for qa in QA_PAIRS], "answer": [qa["answer"] for qa in QA_PAIRS]}
+
+    for use_chat_template in (True, False):
+        tokenizer = create_tiny_tokenizer(TEXTS)
+        if not use_chat_template:
+            tokenizer.chat_template = None
+        features = preprocess_gpu_qa(batch, tokenizer, max_length=256)
+
+        for i, qa in enumerate(QA_PAIRS):
+            example = {name: values[i] for name, values in features.items()}
+            masked, unmasked = _masked_texts(tokenizer, example)
+            assert masked == qa["answer"] + "<|im_end|>"
+            assert unmasked.startswith("<|im_start|>system\n")
+            # 对话模板在<|im_end|>后追加的换行不属于回答
+            assert unmasked.rstrip("\n").endswith(f"<|im_start|>user\n{qa['question']}<|im_end|>\n<|im_start|>assistant")
+            assert check_assistant_mask(tokenizer, example, qa["answer"])
+
+def test_assistant_mask_truncated_answer():
+    """回答被截断时，掩码覆盖截断后剩余的回答部分"""
+    tokenizer = create_tiny_tokenizer(TEXTS)
+    qa = QA_PAIRS[1]
+    prompt_length = len(tokenizer(build_generation_prompt(tokenizer, qa["question"]))["input_ids"])
+    features = preprocess_gpu_qa({"question": [qa["question"]], "answer": [qa["answer"]]},
+                                 tokenizer, max_length=prompt_length + 8)
+    example = {name: values[0] for name, values in features.items()}
+    masked, _ = _masked_texts(tokenizer, example)
+    assert masked == qa["answer"][:8]
+    assert sum(example["assistant_mask"]) == 8
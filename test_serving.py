@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推理服务测试
+在CPU上用微型模型启动HTTP服务，验证并发请求的连续批处理结果与逐条生成一致
+"""
+
+import asyncio
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from gpu_llm_finetune import generate_answers
+from gpu_serving import ContinuousBatchingEngine, create_app
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = [
+    "什么是GPU？",
+    "What is CUDA?",
+    "显存不足怎么办？请给出详细的解决方案",
+    "GPU和CPU有什么区别？",
+    "Why do warps diverge on branches inside a kernel?",
+    "什么是Tensor Core？",
+]
+
+def _serve(test, max_batch_size=4, max_new_tokens=12):
+    """启动服务并运行 test(client, engine)，返回其结果"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=max_batch_size, max_new_tokens=max_new_tokens)
+
+    async def run():
+        async with TestClient(TestServer(create_app(engine, "tiny"))) as client:
+            return await test(client, engine)
+
+    return asyncio.run(run()), model, tokenizer
+
+async def _complete(client, question, **kwargs):
+    response = await client.post("/v1/chat/completions", json={
+        "model": "tiny", "messages": [{"role": "user", "content": question}], **kwargs})
+    assert response.status == 200
+    return await response.json()
+
+def test_concurrent_requests_match_serial_generation():
+    """并发请求被合并到同一批次中生成，结果与逐条贪心生成一致"""
+
+    async def test(client, engine):
+        # 不同的最大长度让序列在不同的步结束，新请求在批次进行中加入
+        tasks = [_complete(client, q, max_tokens=12 - i) for i, q in enumerate(QUESTIONS)]
+        return await asyncio.gather(*tasks), engine.metrics()
+
+    (responses, metrics), model, tokenizer = _serve(test)
+
+    for i, (question, response) in enumerate(zip(QUESTIONS, responses)):
+        expected = generate_answers(model, tokenizer, [question], batch_size=1, max_new_tokens=12 - i)[0]
+        message = response["choices"][0]["message"]
+        assert message["role"] == "assistant"
+        assert message["content"].strip() == expected
+        assert response["usage"]["completion_tokens"] <= 12 - i
+    assert metrics["requests_completed"] == len(QUESTIONS)
+    assert metrics["max_batch_size_seen"] > 1
+    assert metrics["active"] == 0
+
+def test_streaming_matches_non_streaming():
+    """流式输出的增量拼接后与非流式结果一致，并以 [DONE] 结束"""
+
+    async def test(client, engine):
+        complete = await _complete(client, QUESTIONS[2])
+        response = await client.post("/v1/chat/completions", json={
+            "messages": [{"role": "user", "content": QUESTIONS[2]}], "stream": True})
+        assert response.headers["Content-Type"].startswith("text/event-stream")
+        lines = [line for line in (await response.text()).split("\n") if line.startswith("data: ")]
+        return complete, lines
+
+    (complete, lines), _, _ = _serve(test)
+
+    assert lines[-1] == "data: [DONE]"
+    chunks = [json.loads(line[len("data: "):]) for line in lines[:-1]]
+    assert chunks[0]["choices"][0]["delta"]["role"] == "assistant"
+    content = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks)
+    assert content == complete["choices"][0]["message"]["content"]
+    assert chunks[-1]["choices"][0]["finish_reason"] == complete["choices"][0]["finish_reason"]
+
+def test_invalid_request():
+    """格式错误的请求返回400，而不是在解析参数时抛出异常返回500"""
+    messages = [{"role": "user", "content": QUESTIONS[0]}]
+    bodies = [
+        {"messages": []},
+        [messages],
+        {"model": [], "messages": messages},
+        {"messages": messages, "temperature": None},
+        {"messages": messages, "top_p": "x"},
+        {"messages": messages, "max_tokens": "12"},
+        {"messages": messages, "max_tokens": 1.5},
+        {"messages": messages, "max_tokens": 0, "max_completion_tokens": 12},
+    ]
+
+    async def test(client, engine):
+        results = []
+        for body in bodies:
+            response = await client.post("/v1/chat/completions", json=body)
+            results.append((response.status, await response.json()))
+        return results
+
+    results, _, _ = _serve(test)
+    for body, (status, response) in zip(bodies, results):
+        assert status == 400, body
+        assert "error" in response
+
+def test_step_error_fails_requests_but_engine_keeps_serving():
+    """某一步出错（如显存不足）时批次中的请求返回500，引擎清空批次后继续处理之后的请求"""
+    question = {"messages": [{"role": "user", "content": QUESTIONS[0]}]}
+
+    def fail_once(engine, name, when=lambda: True):
+        original = getattr(engine, name)
+
+        def failing(*args):
+            if not when():
+                return original(*args)
+            setattr(engine, name, original)
+            raise RuntimeError("CUDA out of memory")
+
+        setattr(engine, name, failing)
+
+    async def test(client, engine):
+        statuses = []
+        # 解码出错：正在生成的两个请求都失败
+        fail_once(engine, "_decode", when=lambda: len(engine.active) == 2)
+        responses = await asyncio.gather(*[client.post("/v1/chat/completions", json=question) for _ in range(2)])
+        statuses += [(response.status, await response.json()) for response in responses]
+        # 预填充出错：流式请求在发送响应头之前失败
+        fail_once(engine, "_prefill")
+        response = await client.post("/v1/chat/completions", json={**question, "stream": True})
+        statuses.append((response.status, await response.json()))
+        return statuses, await _complete(client, QUESTIONS[1]), engine.metrics()
+
+    (statuses, complete, metrics), model, tokenizer = _serve(test)
+
+    for status, body in statuses:
+        assert status == 500
+        assert body["error"]["type"] == "server_error" and "CUDA out of memory" in body["error"]["message"]
+    expected = generate_answers(model, tokenizer, [QUESTIONS[1]], batch_size=1, max_new_tokens=12)[0]
+    assert complete["choices"][0]["message"]["content"].strip() == expected
+    assert metrics["requests_failed"] == 3 and metrics["requests_completed"] == 1
+    assert metrics["active"] == 0
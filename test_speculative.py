@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+投机解码测试
+在CPU上用微型模型验证投机解码的输出与目标模型单独贪心解码一致，并统计草稿接受率
+"""
+
+import asyncio
+
+import torch
+
+from gpu_llm_finetune import generate_answers
+from gpu_serving import SpeculativeEngine
+from gpu_speculative import SpeculativeDecoder
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = [
+    "什么是GPU？",
+    "What is CUDA?",
+    "显存不足怎么办？请给出详细的解决方案",
+    "GPU和CPU有什么区别？",
+]
+
+def _models(noise=0.02, **draft_overrides):
+    """目标模型及其加噪声的副本（模拟在同一数据上微调的小模型）作为草稿模型"""
+    # 较大的初始化范围让微型模型的贪心输出不再是重复的同一个token
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS, initializer_range=0.5)
+    draft_model, _ = create_tiny_model_and_tokenizer(QUESTIONS, initializer_range=0.5, **draft_overrides)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        for parameter in draft_model.parameters():
+            parameter.add_(torch.randn_like(parameter) * noise)
+    return model, draft_model, tokenizer
+
+def test_speculative_matches_greedy():
+    """接受部分草稿时输出与贪心解码一致，目标模型的前向次数少于生成的token数"""
+    model, draft_model, tokenizer = _models()
+    expected = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=20)
+
+    decoder = SpeculativeDecoder(model, draft_model, num_draft_tokens=4)
+    answers = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=20, speculative=decoder)
+    assert answers == expected
+
+    metrics = decoder.metrics()
+    assert 0 < metrics["acceptance_rate"] < 1
+    assert metrics["target_forwards"] < metrics["generated_tokens"]
+    assert metrics["tokens_per_second"] > 0
+
+def test_unrelated_and_identical_drafts():
+    """草稿全部被拒绝时每轮仍得到一个正确的token；草稿模型与目标模型相同时全部接受"""
+    model, draft_model, tokenizer = _models(noise=0.0, num_hidden_layers=1, seed=3)
+    expected = generate_answers(model, tokenizer, QUESTIONS, batch_size=2, max_new_tokens=12)
+    decoder = SpeculativeDecoder(model, draft_model, num_draft_tokens=3)
+    assert generate_answers(model, tokenizer, QUESTIONS, max_new_tokens=12, speculative=decoder) == expected
+
+    decoder = SpeculativeDecoder(model, model, num_draft_tokens=3)
+    assert generate_answers(model, tokenizer, QUESTIONS, max_new_tokens=12, speculative=decoder) == expected
+    assert decoder.metrics()["acceptance_rate"] == 1.0
+
+def test_speculative_engine():
+    """推理服务的投机解码引擎逐个处理请求，结果与贪心解码一致"""
+    model, draft_model, tokenizer = _models()
+    engine = SpeculativeEngine(model, tokenizer, draft_model, num_draft_tokens=4, max_new_tokens=16)
+
+    async def complete(question, max_new_tokens):
+        return "".join([delta async for delta, _ in engine.generate(
+            [{"role": "user", "content": question}], max_new_tokens=max_new_tokens)])
+
+    async def run():
+        await engine.start()
+        try:
+            return await asyncio.gather(*[complete(q, 16 - i) for i, q in enumerate(QUESTIONS)])
+        finally:
+            await engine.stop()
+
+    results = asyncio.run(run())
+    for i, (question, text) in enumerate(zip(QUESTIONS, results)):
+        expected = generate_answers(model, tokenizer, [question], max_new_tokens=16 - i)[0]
+        assert text.strip() == expected
+    metrics = engine.metrics()
+    assert metrics["requests_completed"] == len(QUESTIONS)
+    assert metrics["generated_tokens"] == sum(16 - i for i in range(len(QUESTIONS)))
+    assert metrics["speculative"]["accepted"] > 0
+
+if __name__ == "__main__":
+    test_speculative_matches_greedy()
+    test_unrelated_and_identical_drafts()
+    test_speculative_engine()
+    print("✅ 投机解码测试通过!")
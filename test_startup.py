@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动速度测试
+在子进程中分阶段计时：导入命令行模块、解析参数、导入训练和评估依赖；
+验证命令行阶段不加载torch等重依赖、不访问网络，--help 和参数错误不加载重依赖即返回。
+耗时只打印供参考，不作为断言（负载高的CI机器上不稳定）
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+HEAVY_MODULES = ["torch", "transformers", "trl", "peft", "datasets", "evaluate", "nltk", "rouge"]
+
+# 在子进程中运行：禁止网络连接，依次执行各阶段并记录耗时及新加载的重依赖
+STAGE_SCRIPT = """
+import json, socket, sys, time
+
+def _no_network(*args, **kwargs):
+    raise RuntimeError("导入阶段不应访问网络")
+socket.socket.connect = _no_network
+socket.create_connection = _no_network
+
+HEAVY = %r
+STAGES = %r
+report = []
+for name, code in STAGES:
+    before = {m for m in HEAVY if m in sys.modules}
+    start = time.perf_counter()
+    exec(code)
+    report.append({"stage": name, "seconds": time.perf_counter() - start,
+                   "loaded": sorted(m for m in HEAVY if m in sys.modules and m not in before)})
+print(json.dumps(report))
+"""
+
+STAGES = [
+    ("cli", "import gpu_llm_finetune"),
+    ("parse_args", "gpu_llm_finetune.parse_args(['--do_eval', '--eval_workers', '2'])"),
+    ("eval", "import gpu_export, gpu_distributed, peft"),
+    ("train", "import gpu_trainer"),
+]
+
+def _run_stages(stages):
+    script = STAGE_SCRIPT % (HEAVY_MODULES, stages)
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=REPO_ROOT).stdout
+    return {entry["stage"]: entry for entry in json.loads(output.strip().splitlines()[-1])}
+
+def test_import_stages():
+    """命令行阶段只用标准库和numpy；重依赖在评估、训练阶段才加载"""
+    report = _run_stages(STAGES)
+    for entry in report.values():
+        print(f"{entry['stage']:>10}: {entry['seconds']:.3f}s {entry['loaded']}")
+    assert report["cli"]["loaded"] == [] and report["parse_args"]["loaded"] == []
+    assert "torch" in report["eval"]["loaded"] and "peft" in report["eval"]["loaded"]
+    assert "trl" in report["train"]["loaded"]
+
+# 在子进程中以 __main__ 运行脚本，退出后最后一行输出退出码和已加载的重依赖
+MAIN_SCRIPT = """
+import json, runpy, sys
+
+HEAVY = %r
+sys.argv = %r
+code = 0
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit as e:
+    code = e.code
+print(json.dumps({"code": code, "loaded": sorted(m for m in HEAVY if m in sys.modules)}))
+"""
+
+def _run_main(argv):
+    """运行命令行脚本，返回 (退出码, 已加载的重依赖, stdout, stderr)"""
+    result = subprocess.run([sys.executable, "-c", MAIN_SCRIPT % (HEAVY_MODULES, argv)], capture_output=True,
+                            text=True, cwd=REPO_ROOT)
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report["code"], report["loaded"], result.stdout, result.stderr
+
+def test_help_and_argument_errors_skip_heavy_imports():
+    """--help 和参数检查错误在加载模型依赖之前退出"""
+    code, loaded, stdout, _ = _run_main(["gpu_llm_finetune.py", "--help"])
+    assert code == 0 and "--model_type" in stdout
+    assert loaded == []
+
+    code, loaded, _, stderr = _run_main(["gpu_llm_finetune.py", "--eval_workers", "0"])
+    assert code == 2 and "--eval_workers" in stderr
+    assert loaded == []
+
+    # 损失评估不支持只对生成有效的选项，直接报错而不是静默忽略
+    code, loaded, _, stderr = _run_main(["gpu_llm_finetune.py", "--eval_mode", "loss", "--stream_eval",
+                                         "--eval_workers", "2"])
+    assert code == 2 and "--stream_eval" in stderr and "--eval_workers" in stderr
+    assert loaded == []
+
+if __name__ == "__main__":
+    test_import_stages()
+    test_help_and_argument_errors_skip_heavy_imports()
+    print("✅ 启动速度测试通过!")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+超参数扫描调度测试
+用本文件代替训练脚本（写出与 gpu_llm_finetune.py 相同布局的结果文件），验证配置展开、
+多槽位并行、跳过已完成的运行以及比较表；本文件同时是被启动的训练脚本
+"""
+
+import json
+import os
+import sys
+import time
+
+from gpu_sweep import build_runs, collect_results, config_to_argv, expand_configs, format_table, run_sweep
+
+SCRIPT = os.path.abspath(__file__)
+
+# 训练“耗时”，用于检查运行在时间上的重叠
+RUN_SECONDS = 0.5
+
+# max_steps 为该值的运行以非零状态退出
+FAILING_MAX_STEPS = 13
+
+def run_fake_training(argv):
+    """解析与 gpu_llm_finetune.py 相同的参数，写出参数文件、训练日志、吞吐量和评估结果"""
+    from gpu_llm_finetune import parse_args
+
+    args = parse_args(argv)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "training_params.json"), "w") as f:
+        json.dump(vars(args), f, indent=2)
+    start = time.time()
+    time.sleep(RUN_SECONDS)
+    with open(os.path.join(args.output_dir, "run.json"), "w") as f:
+        json.dump({"start": start, "end": time.time(), "cuda_visible_devices": os.environ["CUDA_VISIBLE_DEVICES"],
+                   "omp_num_threads": os.environ.get("OMP_NUM_THREADS")}, f)
+    if args.max_steps == FAILING_MAX_STEPS:
+        sys.exit(1)
+
+    checkpoint = os.path.join(args.output_dir, f"checkpoint-{args.max_steps}")
+    os.makedirs(checkpoint, exist_ok=True)
+    with open(os.path.join(checkpoint, "trainer_state.json"), "w") as f:
+        json.dump({"log_history": [{"loss": 2.0, "step": 1}, {"loss": 1.0 / args.lora_rank, "step": 2},
+                                   {"eval_loss": 0.5, "step": 2}]}, f)
+    with open(os.path.join(args.output_dir, "training_metrics.jsonl"), "w") as f:
+        f.write(json.dumps({"step": 1, "real_tokens": 100, "step_time": 0.5}) + "\n")
+    with open(os.path.join(args.output_dir, "evaluation_results.json"), "w") as f:
+        json.dump([{"rouge-1": args.lora_rank / 10, "rouge-2": 0.1, "rouge-l": 0.2, "bleu": 0.3}], f)
+
+def test_expand_configs_and_names(tmp_path):
+    """runs 叠加在 base 上再与 grid 做笛卡尔积，名称由取值不同的参数组成，无效配置在运行前报错"""
+    configs = expand_configs(
+        base={"max_steps": 10, "do_train": True, "packing": False},
+        grid={"model_type": ["qwen3-1.7b", "qwen3-0.6b"], "lora_rank": [8, 16]},
+        runs=[{"learning_rate": 5e-5}, {"learning_rate": 1e-4, "max_seq_length": 512}],
+    )
+    assert len(configs) == 8
+    assert configs[-1] == {"max_steps": 10, "do_train": True, "packing": False, "learning_rate": 1e-4,
+                           "max_seq_length": 512, "model_type": "qwen3-0.6b", "lora_rank": 16}
+    assert config_to_argv(configs[0])[:3] == ["--max_steps", "10", "--do_train"]
+
+    runs = build_runs(configs, str(tmp_path))
+    assert runs[0].name == "qwen3-1.7b-learning_rate5e-05-lora_rank8"
+    assert runs[-1].name == "qwen3-0.6b-learning_rate0.0001-lora_rank16-max_seq_length512"
+    assert runs[0].args.output_dir == os.path.join(str(tmp_path), runs[0].name)
+    assert {run.args.cache_dir for run in runs} == {os.path.join(str(tmp_path), "cache")}
+    assert runs[-1].args.max_seq_length == 512 and runs[0].args.max_seq_length == 1024
+
+    named = build_runs(configs[:2], str(tmp_path), template="{model_type}-r{lora_rank}")
+    assert [run.name for run in named] == ["qwen3-1.7b-r8", "qwen3-1.7b-r16"]
+    for bad_configs, template in [(configs, "{model_type}"), ([{"lora_rank": 0}], None)]:
+        try:
+            build_runs(bad_configs, str(tmp_path), template=template)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("重复的名称和无效的参数应当在运行前报错")
+
+def test_sweep_runs_in_parallel_and_skips_completed(tmp_path):
+    """运行同时占满全部槽位，结果汇总为比较表；再次运行时跳过已完成的配置，只重跑失败的配置"""
+    configs = expand_configs(base={"do_eval": True}, grid={"lora_rank": [4, 8, 16], "max_steps": [5, FAILING_MAX_STEPS]})
+    runs = build_runs(configs, str(tmp_path))
+    run_sweep(runs, slots=[(), ()], prepare=False, script=SCRIPT)
+
+    assert [run.status for run in runs] == ["done", "failed"] * 3
+    records = [json.load(open(os.path.join(run.output_dir, "run.json"))) for run in runs]
+    assert all(r["cuda_visible_devices"] == "" for r in records)
+    assert {r["omp_num_threads"] for r in records} == {str(max(1, (os.cpu_count() or 1) // 2))}
+    # 任意时刻最多两个运行，且确实有运行同时进行
+    events = sorted([(r["start"], 1) for r in records] + [(r["end"], -1) for r in records])
+    running, peak = 0, 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    assert peak <= 2
+    intervals = sorted((r["start"], r["end"]) for r in records)
+    assert any(b[0] < a[1] for a, b in zip(intervals, intervals[1:]))
+
+    rows = collect_results(runs)
+    assert [row["lora_rank"] for row in rows] == [4, 4, 8, 8, 16, 16]
+    assert rows[2]["status"] == "done" and rows[2]["rouge-1"] == 0.8 and rows[2]["train_loss"] == 1.0 / 8
+    assert rows[2]["eval_loss"] == 0.5 and rows[2]["tokens_per_second"] == 200.0
+    assert rows[1]["status"] == "failed" and rows[1]["rouge-1"] is None
+    table = format_table(rows)
+    assert table.splitlines()[0].startswith("| run | status | lora_rank | max_steps | train_loss")
+    assert len(table.splitlines()) == 2 + len(rows)
+
+    runs = build_runs(configs, str(tmp_path))
+    run_sweep(runs, slots=[(), ()], prepare=False, script=SCRIPT)
+    assert [run.status for run in runs] == ["skipped", "failed"] * 3
+
+if __name__ == "__main__":
+    run_fake_training(sys.argv[1:])
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练吞吐量监控测试
+在CPU上训练微型模型几步，验证每步的token数、时间分解和Prometheus输出
+"""
+
+import csv
+import json
+import os
+import urllib.request
+from argparse import Namespace
+
+from datasets import Dataset
+
+from gpu_llm_finetune import preprocess_gpu_qa, train_model
+from gpu_training_metrics import FIELDS, TrainingMetricsCallback, model_flops_per_token
+from tiny_model import create_tiny_model_and_tokenizer
+
+QA_PAIRS = [{"question": f"第{i}个问题" + "？" * (i % 4), "answer": f"回答{i}" + "很长" * (i % 5)} for i in range(8)]
+
+def _train(tmp_path, **overrides):
+    model, tokenizer = create_tiny_model_and_tokenizer([qa["question"] + qa["answer"] for qa in QA_PAIRS])
+    model.train()
+    raw = Dataset.from_list(QA_PAIRS)
+    dataset = raw.map(preprocess_gpu_qa, batched=True, remove_columns=raw.column_names,
+                      fn_kwargs={"tokenizer": tokenizer, "max_length": 256})
+    args = Namespace(
+        output_dir=str(tmp_path), cache_dir=None, lora_rank=4, learning_rate=1e-3,
+        per_device_train_batch_size=2, gradient_accumulation_steps=2, max_steps=2,
+        eval_steps=2, save_steps=2, max_seq_length=256, packing=False, group_by_length_buckets=False,
+        chunked_loss=False, loss_chunk_size=1024, resume_from_checkpoint=None,
+        training_metrics="jsonl", metrics_port=None, metrics_host="127.0.0.1", peak_tflops=1.0,
+        training_metrics_breakdown=False, sync_checkpoints=False, keep_last_checkpoints=3,
+    )
+    vars(args).update(overrides)
+    expected_tokens = sum(len(ids) for ids in dataset["input_ids"])
+    train_model(model, tokenizer, dataset, None, args)
+    return expected_tokens
+
+def test_training_metrics_jsonl(tmp_path):
+    """每个优化步一条记录：2步×2个微批次×2条样本恰好覆盖全部8条样本；重新训练时不保留旧记录"""
+    expected_tokens = _train(tmp_path)
+    with open(os.path.join(tmp_path, "training_metrics.jsonl"), encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+
+    assert [r["step"] for r in records] == [1, 2]
+    assert set(records[0]) == set(FIELDS)
+    assert sum(r["real_tokens"] for r in records) == expected_tokens
+    for r in records:
+        assert r["real_tokens"] <= r["padded_tokens"]
+        assert abs(r["padding_ratio"] - (1 - r["real_tokens"] / r["padded_tokens"])) < 1e-9
+        parts = r["dataloader_time"] + r["forward_time"] + r["backward_time"] + r["optimizer_time"]
+        assert r["forward_time"] > 0 and r["backward_time"] > 0 and r["optimizer_time"] > 0
+        assert parts <= r["step_time"] + 1e-6
+        assert abs(parts + r["other_time"] - r["step_time"]) < 1e-6
+        assert r["peak_memory_mb"] > 0
+        assert 0 < r["mfu"] < 1
+
+    # 在同一目录重新从头训练时清空上一次的记录，而不是接着追加
+    _train(tmp_path)
+    with open(os.path.join(tmp_path, "training_metrics.jsonl"), encoding="utf-8") as f:
+        assert [json.loads(line)["step"] for line in f] == [1, 2]
+
+def test_training_metrics_csv_and_packing(tmp_path):
+    """打包批次没有attention_mask时按填充token统计真实token数"""
+    expected_tokens = _train(tmp_path, training_metrics="csv", packing=True, max_seq_length=256, max_steps=1,
+                             gradient_accumulation_steps=1)
+    with open(os.path.join(tmp_path, "training_metrics.csv"), encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 1 and rows[0]["step"] == "1"
+    assert 0 < int(rows[0]["real_tokens"]) <= min(int(rows[0]["padded_tokens"]), expected_tokens)
+
+def test_prometheus_endpoint():
+    model, tokenizer = create_tiny_model_and_tokenizer()
+    flops = model_flops_per_token(model, 128)
+    assert flops > 4 * sum(p.numel() for p in model.parameters() if p is not model.get_input_embeddings().weight)
+
+    callback = TrainingMetricsCallback(model, "outputs/qwen3-tiny", tokenizer.pad_token_id,
+                                       metrics_format="none", prometheus_port=0)
+    callback.on_train_begin(None, None, None)
+    try:
+        callback.latest = {"real_tokens_per_second": 123.5, "mfu": None}
+        callback.totals["steps"] = 3
+        port = callback.server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            text = response.read().decode("utf-8")
+    finally:
+        callback.on_train_end(None, None, None)
+    assert 'gpu_qa_train_real_tokens_per_second{run="qwen3-tiny"} 123.5' in text
+    assert 'gpu_qa_train_steps_total{run="qwen3-tiny"} 3' in text
+    assert "gpu_qa_train_mfu" not in text
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_training_metrics_jsonl(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_training_metrics_csv_and_packing(pathlib.Path(tmp_dir))
+    test_prometheus_endpoint()
+    print("✅ 训练吞吐量监控测试通过!")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查点评估监视器测试
+在CPU上用微型模型和随机初始化的LoRA适配器模拟训练输出目录，验证排行榜、检查点提升以及训练进行中的轮询
+"""
+
+import json
+import os
+import threading
+import time
+from argparse import Namespace
+
+import torch
+from datasets import Dataset
+from peft import LoraConfig, PeftModel, get_peft_model
+
+from gpu_llm_finetune import evaluate_model, parse_args
+from gpu_watcher import EVAL_DIR, PROMOTED_DIR, CheckpointWatcher, load_training_args, watch
+from tiny_model import create_tiny_model_and_tokenizer
+
+QUESTIONS = [
+    "什么是GPU？",
+    "What is CUDA?",
+    "显存不足怎么办？",
+    "GPU和CPU有什么区别？",
+    "Why do warps diverge?",
+]
+
+# 所有问题的参考答案相同，包含随机适配器常生成的字符，使各检查点的得分有差别
+ANSWER = "显存存储问题：助手给出的回答"
+
+EVAL_LOSSES = {1: 3.0, 2: 1.0, 3: 2.0}
+
+def _load_tiny_base(args, device_map=None):
+    """评估工作进程中加载微型基础模型"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    return model.eval(), tokenizer
+
+def _save_checkpoint(output_dir, step):
+    """像训练一样原子地写出 checkpoint-N：随机LoRA适配器、含验证损失的 trainer_state.json 和优化器状态"""
+    model, _ = create_tiny_model_and_tokenizer(QUESTIONS)
+    torch.manual_seed(step)
+    config = LoraConfig(r=4, lora_alpha=16, target_modules=["q_proj", "v_proj", "down_proj"], init_lora_weights=False)
+    staging = os.path.join(output_dir, f".checkpoint-{step}.tmp")
+    get_peft_model(model, config).save_pretrained(staging)
+    with open(os.path.join(staging, "trainer_state.json"), "w", encoding="utf-8") as f:
+        json.dump({"global_step": step, "log_history": [{"loss": 5.0, "step": step},
+                                                        {"eval_loss": EVAL_LOSSES.get(step, 4.0), "step": step}]}, f)
+    torch.save({"state": {}}, os.path.join(staging, "optimizer.pt"))
+    path = os.path.join(output_dir, f"checkpoint-{step}")
+    os.replace(staging, path)
+    return path
+
+def _prepare_output_dir(tmp_path):
+    """验证集、测试集和训练开始时写入的 training_params.json；挑选检查点只应使用验证集"""
+    dataset_path = os.path.join(tmp_path, "data")
+    os.makedirs(dataset_path)
+    with open(os.path.join(dataset_path, "validation.jsonl"), "w", encoding="utf-8") as f:
+        for question in QUESTIONS:
+            f.write(json.dumps({"question": question, "answer": ANSWER}, ensure_ascii=False) + "\n")
+    with open(os.path.join(dataset_path, "test.jsonl"), "w", encoding="utf-8") as f:
+        for question in QUESTIONS:
+            f.write(json.dumps({"question": "测试集" + question, "answer": "测试集"}, ensure_ascii=False) + "\n")
+    output_dir = os.path.join(tmp_path, "output")
+    os.makedirs(output_dir)
+    params = parse_args(["--output_dir", output_dir, "--dataset_path", dataset_path,
+                         "--eval_batch_size", "2", "--max_new_tokens", "16"])
+    with open(os.path.join(output_dir, "training_params.json"), "w") as f:
+        json.dump(vars(params), f, indent=2)
+    return output_dir
+
+def _expected_averages(checkpoint_dir, questions, tmp_path):
+    """单独加载检查点的适配器后用 evaluate_model 评估子集的平均分"""
+    model, tokenizer = create_tiny_model_and_tokenizer(QUESTIONS)
+    model = PeftModel.from_pretrained(model, checkpoint_dir).eval()
+    dataset = Dataset.from_list([{"question": q, "answer": ANSWER} for q in questions])
+    os.makedirs(tmp_path, exist_ok=True)
+    args = Namespace(output_dir=str(tmp_path), eval_batch_size=2, max_new_tokens=16,
+                     metric_level="char", cache_dir=None, prefix_cache=False, draft_output_dir=None)
+    return evaluate_model(model, tokenizer, dataset, args)
+
+def test_leaderboard_and_promotion(tmp_path):
+    """各检查点在评估子集上的得分与单独评估一致，按指标排名，最好的检查点被提升，重新启动时不重复评估"""
+    output_dir = _prepare_output_dir(str(tmp_path))
+    checkpoints = {step: _save_checkpoint(output_dir, step) for step in EVAL_LOSSES}
+    args = load_training_args(output_dir, {})
+    assert args.eval_batch_size == 2 and args.max_new_tokens == 16
+
+    watcher = watch(args, promote=True, eval_subset=4, once=True, device="cpu", load_base=_load_tiny_base)
+
+    with open(os.path.join(output_dir, "checkpoint_leaderboard.json"), "r", encoding="utf-8") as f:
+        leaderboard = json.load(f)
+    entries = {entry["step"]: entry for entry in leaderboard["checkpoints"]}
+    assert sorted(entries) == [1, 2, 3]
+    for step, path in checkpoints.items():
+        expected = _expected_averages(path, QUESTIONS[:4], tmp_path / f"expected-{step}")
+        assert all(abs(entries[step][name] - expected[name]) < 1e-9 for name in expected)
+        assert entries[step]["eval_loss"] == EVAL_LOSSES[step]
+        assert entries[step]["num_examples"] == 4
+        with open(os.path.join(output_dir, EVAL_DIR, f"checkpoint-{step}", "evaluation_results.json"),
+                  "r", encoding="utf-8") as f:
+            assert len(json.load(f)) == 4
+    assert len({entry["rouge-l"] for entry in entries.values()}) > 1
+
+    best_step = max(sorted(entries), key=lambda step: entries[step]["rouge-l"])
+    assert leaderboard["best_step"] == best_step == watcher.best()["step"]
+    with open(os.path.join(output_dir, "checkpoint_leaderboard.md"), "r", encoding="utf-8") as f:
+        assert f.read().splitlines()[2].startswith(f"| {best_step} |")
+
+    # 提升的检查点与原检查点共享适配器文件，不含优化器状态；评估用的硬链接已清理
+    promoted = os.path.join(output_dir, PROMOTED_DIR)
+    assert os.path.samefile(os.path.join(promoted, "adapter_model.safetensors"),
+                            os.path.join(checkpoints[best_step], "adapter_model.safetensors"))
+    assert not os.path.exists(os.path.join(promoted, "optimizer.pt"))
+    assert not any(os.path.exists(os.path.join(output_dir, EVAL_DIR, f"checkpoint-{step}", "adapter"))
+                   for step in entries)
+
+    # 按验证损失排名；排行榜中已有的检查点不再评估
+    results_file = os.path.join(output_dir, EVAL_DIR, "checkpoint-1", "evaluation_results.json")
+    mtime = os.path.getmtime(results_file)
+    rerun = CheckpointWatcher(output_dir, metric="eval_loss")
+    assert rerun.pending() == []
+    assert [entry["step"] for entry in rerun.leaderboard()] == [2, 3, 1]
+
+    # 训练没有保存最终模型（如中途崩溃）时，超过 idle_timeout 没有新检查点即退出，而不是一直轮询
+    start_time = time.monotonic()
+    watch(args, poll_interval=0.1, idle_timeout=0.5, device="cpu", load_base=_load_tiny_base)
+    assert time.monotonic() - start_time < 120
+    assert os.path.getmtime(results_file) == mtime
+
+def test_watch_follows_training(tmp_path):
+    """训练进行中陆续出现的检查点被依次以损失评估，训练保存最终模型后监视器自行退出；评估前被删除的检查点跳过"""
+    output_dir = _prepare_output_dir(str(tmp_path))
+    _save_checkpoint(output_dir, 1)
+    args = load_training_args(output_dir, {"eval_mode": "loss"})
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(watcher=watch(
+        args, eval_subset=2, poll_interval=0.1, device="cpu", load_base=_load_tiny_base)))
+    thread.start()
+
+    leaderboard_file = os.path.join(output_dir, "checkpoint_leaderboard.json")
+    deadline = time.time() + 300
+    while not os.path.exists(leaderboard_file) and time.time() < deadline:
+        time.sleep(0.1)
+    assert os.path.exists(leaderboard_file)
+    assert thread.is_alive()
+
+    _save_checkpoint(output_dir, 3)
+    model, _ = create_tiny_model_and_tokenizer(QUESTIONS)
+    get_peft_model(model, LoraConfig(r=4, target_modules=["q_proj", "v_proj"])).save_pretrained(output_dir)
+    thread.join(timeout=300)
+    assert not thread.is_alive()
+
+    watcher = result["watcher"]
+    assert sorted(watcher.entries) == [1, 3]
+    assert watcher.metric == "nll"
+    assert watcher.best()["step"] == min(watcher.entries, key=lambda step: watcher.entries[step]["nll"])
+    for step, entry in watcher.entries.items():
+        assert entry["perplexity"] > 1 and entry["eval_loss"] == EVAL_LOSSES[step]
+        with open(os.path.join(output_dir, EVAL_DIR, f"checkpoint-{step}", "evaluation_results.json"),
+                  "r", encoding="utf-8") as f:
+            records = json.load(f)
+        assert [record["question"] for record in records] == QUESTIONS[:2]
+        assert all(record["num_tokens"] > 0 and record["nll"] > 0 for record in records)
+
+    assert watcher.hold(5, os.path.join(output_dir, "checkpoint-5")) is None
+    assert 5 in watcher.missed
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp:
+        test_leaderboard_and_promotion(Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_watch_follows_training(Path(tmp))
+    print("✅ 检查点评估监视器测试通过!")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微型Qwen3模型工具
+构建随机初始化的Qwen3结构模型和字符级分词器，用于在CPU上测试评估与生成流程
+"""
+
+import torch
+from tokenizers import Tokenizer, Regex, decoders, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+# 与Qwen系列一致的特殊token
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<unk>"]
+
+# 与Qwen系列一致的对话模板（不含思考模式等扩展）
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+def create_tiny_tokenizer(texts=()):
+    """
+    创建字符级分词器
+
+    Args:
+        texts: 用于构建词表的文本，未出现的字符会被映射为<unk>
+
+    Returns:
+        带有Qwen风格对话模板的PreTrainedTokenizerFast
+    """
+    from gpu_llm_finetune import SYSTEM_PROMPT
+
+    chars = set(SYSTEM_PROMPT)
+    chars.update(chr(i) for i in range(32, 127))
+    chars.update("\n\t")
+    for text in texts:
+        chars.update(text)
+
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS)}
+    for char in sorted(chars):
+        vocab.setdefault(char, len(vocab))
+
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Split(Regex(r"[\s\S]"), behavior="isolated")
+    backend.decoder = decoders.Fuse()
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        unk_token="<unk>",
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=["<|im_start|>"],
+        clean_up_tokenization_spaces=False,
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    return tokenizer
+
+def create_tiny_model_and_tokenizer(texts=(), seed=0, **config_overrides):
+    """
+    创建随机初始化的微型Qwen3模型和分词器
+
+    Args:
+        texts: 用于构建分词器词表的文本
+        seed: 随机种子，保证多次创建得到相同的权重
+        config_overrides: 覆盖默认Qwen3Config的参数
+
+    Returns:
+        (model, tokenizer)
+    """
+    tokenizer = create_tiny_tokenizer(texts)
+
+    config_kwargs = {
+        "vocab_size": len(tokenizer),
+        "hidden_size": 64,
+        "intermediate_size": 128,
+        "num_hidden_layers": 2,
+        "num_attention_heads": 4,
+        "num_key_value_heads": 2,
+        "head_dim": 16,
+        "max_position_embeddings": 2048,
+        "tie_word_embeddings": True,
+        "pad_token_id": tokenizer.pad_token_id,
+        "eos_token_id": tokenizer.eos_token_id,
+        "bos_token_id": None,
+    }
+    config_kwargs.update(config_overrides)
+
+    torch.manual_seed(seed)
+    model = Qwen3ForCausalLM(Qwen3Config(**config_kwargs))
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.eval()
+    return model, tokenizer